@@ -0,0 +1,813 @@
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import random
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import aiohttp
+import psycopg2
+
+# Бенчмарки работают только с отдельной базой из BENCH_DATABASE_URL:
+# таблицы в ней очищаются, поэтому рабочую базу сюда не указывать
+BENCH_DATABASE_URL = os.getenv('BENCH_DATABASE_URL')
+if BENCH_DATABASE_URL:
+    os.environ['DATABASE_URL'] = BENCH_DATABASE_URL
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCH')
+# Заполнение больших синтетических таблиц не укладывается в рабочий таймаут запроса
+os.environ.setdefault('DB_STATEMENT_TIMEOUT_MS', '600000')
+
+import bot
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from client_index import ClientIndex
+from db import connect_params
+from export import EXPORT_QUERY, WRITERS, export_clients
+from fsm_storage import CachedDatabaseStorage, PostgresFSMBackend, SQLiteFSMBackend
+from migrations import HOT_PATH_INDEXES
+from restore_clients import CLIENT_HEADER, MERGE_SET, PREFIXES, RESTORE_COLUMNS, parse_clients, restore
+
+GENDERS = ["Мужской", "Женский"]
+AGES = ["До 22", "22-30", "Более 30"]
+VISITS = ["До 3 раз", "3-8 раз", "Более 8 раз"]
+
+def synthetic_row(user_id):
+    return (
+        user_id,
+        f"user{user_id}",
+        f"Клиент {user_id}",
+        "Ассортимент и вежливый персонал",
+        "Очереди по вечерам",
+        "Больше акций",
+        random.choice(GENDERS),
+        random.choice(AGES),
+        random.choice(VISITS),
+        False
+    )
+
+# Обновления, которые присылает Telegram, пока пользователь проходит анкету
+def questionnaire_updates(user_id, update_ids):
+    answers = [
+        "/start", "Да", "Да",
+        "Ассортимент и вежливый персонал", "Очереди по вечерам", "Больше акций",
+        random.choice(GENDERS), random.choice(AGES), random.choice(VISITS)
+    ]
+    user = {"id": user_id, "is_bot": False, "first_name": f"Клиент {user_id}", "username": f"user{user_id}"}
+    return [{
+        "update_id": next(update_ids),
+        "message": {
+            "message_id": next(update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text
+        }
+    } for text in answers]
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+# Считаем транзакции (= коммиты), проходящие через пул
+class TransactionCounter:
+    def __init__(self, db):
+        self.count = 0
+        self._run = db.run
+        db.run = self
+
+    async def __call__(self, func, *args):
+        self.count += 1
+        return await self._run(func, *args)
+
+async def bench_upsert(args):
+    counter = TransactionCounter(bot.db)
+    results = {}
+
+    # Прежний путь: каждая анкета — отдельный INSERT ... ON CONFLICT и коммит
+    async def per_row(rows, latencies):
+        for row in rows:
+            started = time.perf_counter()
+            await bot.db.run(bot.upsert_clients, [row])
+            latencies.append(time.perf_counter() - started)
+
+    # Отложенная запись: обработчик только кладёт анкету в буфер
+    async def write_behind(rows, latencies):
+        for row in rows:
+            started = time.perf_counter()
+            bot.client_writer.add(row)
+            latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(0)
+
+    for name, submit in (("per_row", per_row), ("write_behind", write_behind)):
+        await bot.db.execute('TRUNCATE clients')
+        rows = [synthetic_row(1_000_000 + i) for i in range(args.rows)]
+        chunks = [rows[i::args.concurrency] for i in range(args.concurrency)]
+        latencies = []
+        counter.count = 0
+
+        writer_task = asyncio.create_task(bot.client_writer.run_forever())
+        started = time.perf_counter()
+        await asyncio.gather(*(submit(chunk, latencies) for chunk in chunks))
+        await bot.client_writer.flush()
+        elapsed = time.perf_counter() - started
+        commits = counter.count
+        writer_task.cancel()
+
+        stored = (await bot.db.fetchone('SELECT COUNT(*) FROM clients'))[0]
+        results[name] = {
+            "rows": args.rows,
+            "stored": stored,
+            "seconds": round(elapsed, 3),
+            "rows_per_sec": round(args.rows / elapsed, 1),
+            "commits": commits,
+            "handler_p50_ms": round(statistics.median(latencies) * 1000, 3),
+            "handler_p95_ms": round(percentile(latencies, 0.95) * 1000, 3)
+        }
+
+    results["commit_reduction"] = round(
+        results["per_row"]["commits"] / max(1, results["write_behind"]["commits"]), 1
+    )
+    await bot.db.execute('TRUNCATE clients')
+    return results
+
+def latency_stats(latencies):
+    return {
+        "p50_us": round(statistics.median(latencies) * 1e6, 1),
+        "p99_us": round(percentile(latencies, 0.99) * 1e6, 1)
+    }
+
+async def bench_fsm(args):
+    results = {}
+    keys = [StorageKey(bot_id=1, chat_id=1_000_000 + i, user_id=1_000_000 + i) for i in range(args.sessions)]
+    data = {"appreciate": "Ассортимент", "dislike": "Очереди", "improve": "Акции", "gender": "Женский"}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        storages = {
+            "memory": lambda: MemoryStorage(),
+            "postgres": lambda: CachedDatabaseStorage(PostgresFSMBackend(bot.db), cache_size=args.sessions),
+            "sqlite": lambda: CachedDatabaseStorage(SQLiteFSMBackend(os.path.join(tmp, "fsm.db")), cache_size=args.sessions)
+        }
+        for name, make_storage in storages.items():
+            await bot.db.execute('TRUNCATE fsm_states')
+            storage = make_storage()
+            writes, misses, hits = [], [], []
+
+            # Анкета в процессе: состояние и ответы пишутся сквозь кэш в БД
+            for key in keys:
+                started = time.perf_counter()
+                await storage.set_state(bot.bot, key, bot.Questionnaire.GENDER)
+                await storage.set_data(bot.bot, key, data)
+                writes.append(time.perf_counter() - started)
+
+            # Холодный кэш (как после перезапуска): чтение из БД
+            if isinstance(storage, CachedDatabaseStorage):
+                storage._cache.clear()
+                for key in keys:
+                    started = time.perf_counter()
+                    await storage.get_state(bot.bot, key)
+                    misses.append(time.perf_counter() - started)
+
+            # Горячий кэш: так читается состояние на каждом апдейте
+            for _ in range(args.fsm_reads // len(keys)):
+                for key in keys:
+                    started = time.perf_counter()
+                    await storage.get_state(bot.bot, key)
+                    await storage.get_data(bot.bot, key)
+                    hits.append(time.perf_counter() - started)
+
+            results[name] = {
+                "sessions": len(keys),
+                "write": latency_stats(writes),
+                "cold_read": latency_stats(misses) if misses else None,
+                "cached_read": latency_stats(hits)
+            }
+            await storage.close()
+
+    await bot.db.execute('TRUNCATE fsm_states')
+    return results
+
+# Прежний отчёт: полный проход по clients на каждое нажатие кнопки
+def legacy_report_stats(cursor):
+    cursor.execute('SELECT COUNT(*) FROM clients')
+    total_clients = cursor.fetchone()[0]
+    cursor.execute('SELECT COUNT(*) FROM admins')
+    cursor.execute('SELECT MIN(timestamp), MAX(timestamp) FROM clients')
+    first_date, last_date = cursor.fetchone()
+    cursor.execute('''
+    SELECT COUNT(*), gender, age_group, visit_freq
+    FROM clients
+    GROUP BY gender, age_group, visit_freq
+    ORDER BY gender, age_group, visit_freq
+    ''')
+    return total_clients, first_date, last_date, cursor.fetchall()
+
+async def timed(func, repeat):
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = await bot.db.run(func)
+        latencies.append(time.perf_counter() - started)
+    return result, {
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3)
+    }
+
+async def bench_report(args):
+    await bot.db.execute('TRUNCATE clients')
+    await bot.db.execute('''
+    INSERT INTO clients (user_id, username, full_name, gender, age_group, visit_freq, timestamp)
+    SELECT g, 'user' || g, 'Клиент ' || g,
+           (ARRAY['Мужской', 'Женский'])[1 + mod(g, 2)],
+           (ARRAY['До 22', '22-30', 'Более 30'])[1 + mod(g, 3)],
+           (ARRAY['До 3 раз', '3-8 раз', 'Более 8 раз'])[1 + mod(mod(g, 5), 3)],
+           CURRENT_TIMESTAMP - g * INTERVAL '1 second'
+    FROM generate_series(1, %s) g
+    ''', (args.clients,))
+    await bot.db.execute('ANALYZE clients')
+
+    # Повторные анкеты меняют сегмент клиента — сводка должна переносить счётчики
+    resubmitted = [synthetic_row(random.randint(1, args.clients)) for _ in range(args.rows)]
+    for start in range(0, len(resubmitted), 500):
+        batch = {row[0]: row for row in resubmitted[start:start + 500]}
+        await bot.db.run(bot.upsert_clients, list(batch.values()))
+
+    legacy, legacy_latency = await timed(legacy_report_stats, args.repeat)
+    rollup, rollup_latency = await timed(bot.collect_report_stats, args.repeat)
+    consistent = legacy == rollup
+
+    await bot.db.execute('DELETE FROM clients WHERE mod(user_id, 10) = 0')
+    after_delete = await bot.db.run(legacy_report_stats) == await bot.db.run(bot.collect_report_stats)
+    await bot.db.execute('DELETE FROM clients')
+    cleared = (await bot.db.run(bot.collect_report_stats))[0] == 0
+
+    return {
+        "clients": args.clients,
+        "resubmissions": len(resubmitted),
+        "legacy": legacy_latency,
+        "rollup": rollup_latency,
+        "speedup": round(legacy_latency["p50_ms"] / max(rollup_latency["p50_ms"], 0.001), 1),
+        "consistent": consistent and after_delete and cleared
+    }
+
+# Горячие запросы к clients из обработчиков админ-панели и рассылки
+HOT_QUERIES = {
+    "chat_with_client_start": '''
+    SELECT user_id, full_name FROM clients WHERE is_admin = FALSE ORDER BY timestamp DESC LIMIT 50
+    ''',
+    "detailed_clients_report": '''
+    SELECT user_id, username, full_name, timestamp, appreciate, dislike,
+           improve, gender, age_group, visit_freq
+    FROM clients
+    WHERE is_admin = FALSE
+    ORDER BY timestamp DESC
+    LIMIT 50
+    ''',
+    "broadcast_recipients": '''
+    SELECT user_id FROM clients WHERE is_admin = FALSE
+    ''',
+    "database_report_dates": '''
+    SELECT MIN(timestamp), MAX(timestamp) FROM clients
+    ''',
+}
+
+# VACUUM нельзя выполнить в транзакции, поэтому отдельное соединение в autocommit
+def vacuum_analyze(table):
+    conn = psycopg2.connect(**connect_params())
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f'VACUUM ANALYZE {table}')
+    finally:
+        conn.close()
+
+async def explain(query, repeat):
+    def run(cursor):
+        cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + query)
+        return [row[0] for row in cursor.fetchall()]
+
+    plans = [await bot.db.run(run) for _ in range(repeat)]
+    timings = sorted(
+        float(line.split(':')[1].split()[0])
+        for plan in plans for line in plan if line.startswith('Execution Time')
+    )
+    return {"execution_ms": round(statistics.median(timings), 3), "plan": plans[-1]}
+
+async def bench_indexes(args):
+    await bot.db.execute('TRUNCATE clients')
+    await bot.db.execute('''
+    INSERT INTO clients (user_id, username, full_name, appreciate, dislike, improve,
+                         gender, age_group, visit_freq, is_admin, timestamp)
+    SELECT g, 'user' || g, 'Клиент ' || g,
+           'Ассортимент и вежливый персонал', 'Очереди по вечерам', 'Больше акций',
+           (ARRAY['Мужской', 'Женский'])[1 + mod(g, 2)],
+           (ARRAY['До 22', '22-30', 'Более 30'])[1 + mod(g, 3)],
+           (ARRAY['До 3 раз', '3-8 раз', 'Более 8 раз'])[1 + mod(g, 3)],
+           mod(g, 1000) = 0,
+           TIMESTAMP '2024-01-01' + random() * INTERVAL '700 days'
+    FROM generate_series(1, %s) g
+    ''', (args.index_rows,))
+
+    results = {"clients": args.index_rows}
+    for phase in ("before", "after"):
+        if phase == "before":
+            for name in HOT_PATH_INDEXES:
+                await bot.db.execute(f'DROP INDEX IF EXISTS {name}')
+        else:
+            for sql in HOT_PATH_INDEXES.values():
+                await bot.db.execute(sql)
+        vacuum_analyze('clients')
+        for name, query in HOT_QUERIES.items():
+            results.setdefault(name, {})[phase] = await explain(query, args.repeat)
+
+    for name in HOT_QUERIES:
+        before, after = results[name]["before"]["execution_ms"], results[name]["after"]["execution_ms"]
+        results[name]["speedup"] = round(before / max(after, 0.001), 1)
+    await bot.db.execute('TRUNCATE clients')
+    return results
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+async def wait_healthy(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} не ответил за {timeout} сек.")
+
+# Один прогон: приёмник с вебхуком и N воркеров (при N = 1 — обычный режим одного процесса).
+# Обновления шлём на вебхук, как Telegram: по каждому пользователю последовательно
+async def run_cluster(workers, api_url, args):
+    port = args.port
+    env = dict(
+        os.environ,
+        TELEGRAM_API_URL=api_url,
+        WEBHOOK_URL="https://bench.invalid",
+        PORT=str(port),
+        WORKERS=str(workers),
+        CLIENT_FLUSH_INTERVAL="0.1",
+        FSM_STORAGE="postgres"
+    )
+    env.pop("WORKER_ID", None)
+    commands = [env]
+    if workers > 1:
+        commands += [dict(env, WORKER_ID=str(shard)) for shard in range(workers)]
+    processes = [
+        subprocess.Popen([sys.executable, os.path.join(HERE, "bot.py")], env=process_env, cwd=HERE,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for process_env in commands
+    ]
+
+    try:
+        await wait_healthy(f"http://127.0.0.1:{port}/health")
+        await asyncio.sleep(args.warmup)
+
+        update_ids = itertools.count(1)
+        users = [questionnaire_updates(2_000_000 + i, update_ids) for i in range(args.users)]
+        total = sum(len(updates) for updates in users)
+        secret = hashlib.sha256(env["TELEGRAM_BOT_TOKEN"].encode()).hexdigest()
+        semaphore = asyncio.Semaphore(args.concurrency)
+        duplicates = 0
+
+        async with aiohttp.ClientSession(headers={"X-Telegram-Bot-Api-Secret-Token": secret}) as session:
+            async def post(update):
+                async with session.post(f"http://127.0.0.1:{port}/webhook", json=update) as response:
+                    response.raise_for_status()
+
+            async def send_user(updates):
+                nonlocal duplicates
+                async with semaphore:
+                    for update in updates:
+                        await post(update)
+                        # Telegram иногда доставляет одно обновление повторно
+                        if workers > 1 and random.random() < args.duplicate_rate:
+                            duplicates += 1
+                            await post(update)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(send_user(updates) for updates in users))
+            received = time.perf_counter() - started
+
+        # Анкета последнего шага сохраняется в clients — ждём все
+        deadline = time.monotonic() + args.timeout
+        while True:
+            done = (await bot.db.fetchone('SELECT COUNT(*) FROM clients WHERE user_id >= 2000000'))[0]
+            if done >= args.users or time.monotonic() > deadline:
+                break
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+
+        queued = None
+        if workers > 1:
+            queued = (await bot.db.fetchone('SELECT COUNT(*) FROM update_queue'))[0]
+        return {
+            "processes": len(processes),
+            "updates": total,
+            "completed_questionnaires": done,
+            "seconds": round(elapsed, 3),
+            "receive_seconds": round(received, 3),
+            "updates_per_sec": round(total / elapsed, 1),
+            "duplicates_sent": duplicates,
+            "updates_queued": queued
+        }
+    finally:
+        for process in processes:
+            process.send_signal(signal.SIGTERM)
+        for process in processes:
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+async def bench_workers(args):
+    from fake_bot_api import FakeBotAPI
+
+    api = FakeBotAPI(latency=args.api_latency)
+    api_url = await api.start(port=args.api_port)
+    results = {}
+    try:
+        for workers in [int(n) for n in args.workers.split(",")]:
+            await bot.db.execute('TRUNCATE clients, update_queue, fsm_states')
+            results[f"workers_{workers}"] = await run_cluster(workers, api_url, args)
+    finally:
+        await api.stop()
+
+    baseline = next(iter(results.values()))["updates_per_sec"]
+    results["scaling"] = {
+        name: round(result["updates_per_sec"] / baseline, 2) for name, result in list(results.items())
+    }
+    results["cpu_count"] = os.cpu_count()
+    await bot.db.execute('TRUNCATE clients, update_queue, fsm_states')
+    return results
+
+# Прежний подход: все строки в списке Python, затем запись файла
+def buffered_export(cursor, fmt):
+    fd, path = tempfile.mkstemp(suffix=".export")
+    os.close(fd)
+    cursor.execute(EXPORT_QUERY)
+    return path, WRITERS[fmt](cursor.fetchall(), path)
+
+# Скорость и память меряем разными прогонами: tracemalloc сильно замедляет выгрузку
+async def measure_export(export, fmt):
+    started = time.perf_counter()
+    path, count = await bot.db.run(export, fmt)
+    elapsed = time.perf_counter() - started
+    size = os.path.getsize(path)
+    os.remove(path)
+
+    tracemalloc.start()
+    path, _ = await bot.db.run(export, fmt)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    os.remove(path)
+    return {
+        "rows": count,
+        "seconds": round(elapsed, 2),
+        "rows_per_sec": round(count / elapsed),
+        "file_kb": round(size / 1024),
+        "peak_python_mb": round(peak / 1024 / 1024, 1),
+    }
+
+async def bench_export(args):
+    await bot.db.execute('TRUNCATE clients')
+    await bot.db.execute('''
+    INSERT INTO clients (user_id, username, full_name, appreciate, dislike, improve,
+                         gender, age_group, visit_freq, timestamp)
+    SELECT g, 'user' || g, 'Клиент ' || g,
+           repeat('Нравится кофе и атмосфера. ', 3), 'Долго ждать заказ', 'Больше десертов',
+           (ARRAY['Мужской', 'Женский'])[1 + mod(g, 2)],
+           (ARRAY['До 22', '22-30', 'Более 30'])[1 + mod(g, 3)],
+           (ARRAY['До 3 раз', '3-8 раз', 'Более 8 раз'])[1 + mod(g, 3)],
+           CURRENT_TIMESTAMP - g * INTERVAL '1 second'
+    FROM generate_series(1, %s) g
+    ''', (args.export_rows,))
+
+    results = {
+        "streaming_csv": await measure_export(export_clients, "csv"),
+        "buffered_csv": await measure_export(buffered_export, "csv"),
+    }
+    if bot.XLSX_AVAILABLE:
+        results["streaming_xlsx"] = await measure_export(export_clients, "xlsx")
+    await bot.db.execute('TRUNCATE clients')
+    return results
+
+# Запросы поиска клиента: частые имя и префикс, редкие username и ID, пустой результат
+def search_queries(clients):
+    return {
+        "common_name": "Иванова",
+        "common_prefix": "ма",
+        "full_name": "Ольга Попова",
+        "rare_username": f"user{clients // 2 + 1}",
+        "id_prefix": str(clients // 3)[:-1],
+        "no_match": "Зюзя",
+    }
+
+async def bench_search(args):
+    results = {}
+    for clients in [int(n) for n in args.search_sizes.split(",")]:
+        await bot.db.execute('TRUNCATE clients')
+        await bot.db.execute('''
+        INSERT INTO clients (user_id, username, full_name, timestamp)
+        SELECT g, CASE WHEN mod(g, 2) = 1 THEN 'user' || g END,
+               (ARRAY['Мария', 'Иван', 'Ольга', 'Сергей', 'Анна', 'Дмитрий'])[1 + mod(g, 6)] || ' ' ||
+               (ARRAY['Иванова', 'Петров', 'Смирнова', 'Кузнецов', 'Попова', 'Соколов', 'Лебедева'])[1 + mod(g / 6, 7)],
+               TIMESTAMP '2024-01-01' + g * INTERVAL '1 minute'
+        FROM generate_series(1, %s) g
+        ''', (clients,))
+        vacuum_analyze('clients')
+
+        size = results[f"clients_{clients}"] = {}
+        for name, query in search_queries(clients).items():
+            found, latency = await timed(lambda cursor: bot.search_clients(cursor, query), args.repeat)
+            size[name] = {"query": query, "found": len(found), **latency}
+    await bot.db.execute('TRUNCATE clients')
+    return results
+
+def lookup_ns(container, user_ids):
+    started = time.perf_counter()
+    for user_id in user_ids:
+        user_id in container
+    return round((time.perf_counter() - started) / len(user_ids) * 1e9)
+
+async def bench_client_index(args):
+    await bot.db.execute('TRUNCATE clients')
+    # Разреженные ID, как у Telegram
+    await bot.db.execute(
+        'INSERT INTO clients (user_id) SELECT 100000000 + g::bigint * 6007 FROM generate_series(1, %s) g',
+        (args.index_rows,)
+    )
+    vacuum_analyze('clients')
+
+    index = ClientIndex(bot.db)
+    tracemalloc.start()
+    started = time.perf_counter()
+    await index.refresh()
+    load_seconds = time.perf_counter() - started
+    _, load_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    as_set = set(index._ids)
+    set_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    hits = random.sample(list(index._ids), min(100_000, len(index)))
+    misses = [user_id + 1 for user_id in hits]
+    clients = len(index)
+    per_million = 1_000_000 / clients / 1024 / 1024
+
+    db_hits = hits[:args.repeat * 10]
+    async def db_lookup():
+        latencies = []
+        for user_id in db_hits:
+            started = time.perf_counter()
+            await bot.db.fetchone('SELECT 1 FROM clients WHERE user_id = %s', (user_id,))
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    started = time.perf_counter()
+    for user_id in range(1, 1001):
+        index.add(user_id * 6007 + 100000001)
+    add_us = (time.perf_counter() - started) / 1000 * 1e6
+
+    result = {
+        "clients": clients,
+        "load_seconds": round(load_seconds, 2),
+        "load_peak_mb": round(load_peak / 1024 / 1024, 1),
+        "array_mb_per_million": round(index.nbytes * per_million, 1),
+        "set_mb_per_million": round(set_bytes * per_million, 1),
+        "array_hit_ns": lookup_ns(index, hits),
+        "array_miss_ns": lookup_ns(index, misses),
+        "set_hit_ns": lookup_ns(as_set, hits),
+        "db_lookup": latency_stats(await db_lookup()),
+        "array_add_us": round(add_us, 1),
+    }
+    await bot.db.execute('TRUNCATE clients')
+    return result
+
+# Отчёт в формате «📋 Подробный отчёт»: многострочные ответы, пустые поля,
+# клиенты без username и повторы одного клиента с дозаполненными полями
+def write_synthetic_report(path, clients, duplicate_rate):
+    rng = random.Random(42)
+    id_, date, gender, age, visits, appreciate, dislike, improve = PREFIXES
+
+    def write_client(f, user_id, username, filled):
+        f.write(f"👤 Клиент {user_id} (@{username})\n")
+        f.write(f"{id_} {user_id}\n")
+        f.write(f"{date} {datetime(2024, 1, 1) + timedelta(minutes=user_id % 500_000)}\n")
+        f.write(f"{gender} {rng.choice(GENDERS)}\n{age} {rng.choice(AGES)}\n{visits} {rng.choice(VISITS)}\n")
+        f.write(f"{appreciate} Ассортимент\nи вежливый персонал\n" if filled else f"{appreciate} \n")
+        f.write(f"{dislike} Очереди по вечерам\n{improve} {'Больше акций' if filled else ''}\n")
+        f.write("=" * 40 + "\n")
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('"ДЫМ" — отчёты\n📋 Подробный отчёт по клиентам:\n\n')
+        for user_id in range(1, clients + 1):
+            write_client(f, user_id, f"user{user_id}" if user_id % 7 else "None", user_id % 5 != 0)
+        for user_id in rng.sample(range(1, clients + 1), int(clients * duplicate_rate)):
+            write_client(f, user_id, f"renamed{user_id}", True)
+
+# Часть клиентов уже в базе с незаполненными полями
+def seed_restore_clients(cursor, clients):
+    cursor.execute('TRUNCATE clients')
+    cursor.execute('''
+    INSERT INTO clients (user_id, username, full_name, appreciate, gender, timestamp)
+    SELECT g, NULL, 'Старое имя ' || g, CASE WHEN mod(g, 2) = 0 THEN 'Уже заполнено' ELSE '' END,
+           NULL, TIMESTAMP '2023-01-01'
+    FROM generate_series(1, %s, 10) g
+    ''', (clients,))
+
+def clients_checksum(cursor):
+    cursor.execute("SELECT md5(string_agg(c::text, ',' ORDER BY user_id)), COUNT(*) FROM clients c")
+    return cursor.fetchone()
+
+LEGACY_RESTORE_SQL = f'''
+INSERT INTO clients ({", ".join(RESTORE_COLUMNS)}, is_admin)
+VALUES ({", ".join(f"%({column})s" for column in RESTORE_COLUMNS)}, FALSE)
+ON CONFLICT (user_id) DO UPDATE SET
+{MERGE_SET}
+'''
+
+# Прежний restore_clients.py: весь отчёт в памяти и INSERT на каждого клиента
+def legacy_restore(conn, path):
+    with open(path, "r", encoding="utf-8") as f:
+        clients = list(parse_clients(f.read().splitlines()))
+    with conn:
+        with conn.cursor() as cursor:
+            for client in clients:
+                cursor.execute(LEGACY_RESTORE_SQL, client)
+    return len(clients)
+
+def parse_peak_mb(parse):
+    tracemalloc.start()
+    parse()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(peak / 1024 / 1024, 1)
+
+async def run_restore(conn, paths, clients, legacy=False, dry_run=False, seed=True):
+    if seed:
+        await bot.db.run(seed_restore_clients, clients)
+    started = time.perf_counter()
+    if legacy:
+        parsed = await asyncio.to_thread(legacy_restore, conn, paths[0])
+        counts = {}
+    else:
+        stats = await asyncio.to_thread(restore, conn, paths, dry_run)
+        parsed = stats["parsed"]
+        counts = {key: stats[key] for key in ("files", "chunks", "workers", "unique", "inserted", "updated", "unchanged")}
+    elapsed = time.perf_counter() - started
+    return await bot.db.run(clients_checksum), {
+        "parsed": parsed, "seconds": round(elapsed, 2), "clients_per_sec": round(parsed / elapsed), **counts
+    }
+
+# Отчёты нескольких админов: клиенты полного отчёта по очереди раскладываются
+# по файлам, повторы одного клиента оказываются в разных файлах
+def split_report(path, directory, parts):
+    paths = [os.path.join(directory, f"admin_{i + 1}.txt") for i in range(parts)]
+    files = [open(part, "w", encoding="utf-8") for part in paths]
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            client = -1
+            for line in f:
+                if CLIENT_HEADER.match(line.rstrip("\n")):
+                    client += 1
+                if client >= 0:
+                    files[client % parts].write(line)
+    finally:
+        for file in files:
+            file.close()
+    return paths
+
+# Построчная вставка слишком медленная для полного отчёта, поэтому с ней сравниваем
+# на меньшем отчёте, а полный восстанавливаем только через COPY
+async def bench_restore(args):
+    directory = tempfile.mkdtemp()
+    full_path = os.path.join(directory, "clients_report.txt")
+    small_path = os.path.join(directory, "clients_report_small.txt")
+    write_synthetic_report(full_path, args.restore_clients, args.duplicate_rate)
+    write_synthetic_report(small_path, args.legacy_restore_clients, args.duplicate_rate)
+    sources_dir = os.path.join(directory, "reports")
+    os.mkdir(sources_dir)
+    split_report(full_path, sources_dir, args.restore_files)
+
+    def legacy_parse():
+        with open(small_path, "r", encoding="utf-8") as f:
+            return list(parse_clients(f.read().splitlines()))
+
+    def streaming_parse(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return sum(1 for _ in parse_clients(f))
+
+    conn = psycopg2.connect(**connect_params())
+    try:
+        legacy_checksum, legacy = await run_restore(conn, [small_path], args.legacy_restore_clients, legacy=True)
+        copy_checksum, copy = await run_restore(conn, [small_path], args.legacy_restore_clients)
+        _, full = await run_restore(conn, [full_path], args.restore_clients)
+        # Пробный прогон по каталогу отчётов не меняет базу и предсказывает итог настоящего
+        await bot.db.run(seed_restore_clients, args.restore_clients)
+        seeded_checksum = await bot.db.run(clients_checksum)
+        dry_checksum, dry_run = await run_restore(conn, [sources_dir], args.restore_clients, dry_run=True, seed=False)
+        _, sources = await run_restore(conn, [sources_dir], args.restore_clients, seed=False)
+        results = {
+            f"clients_{args.legacy_restore_clients}": {
+                "parse_peak_mb": {
+                    "legacy": parse_peak_mb(legacy_parse),
+                    "streaming": parse_peak_mb(lambda: streaming_parse(small_path)),
+                },
+                "legacy": legacy,
+                "copy": copy,
+                "speedup": round(legacy["seconds"] / copy["seconds"], 1),
+                # Повторы клиента сливаются по-разному (построчно — поле за полем, COPY —
+                # самая полная запись целиком), поэтому сверяем только состав клиентов
+                "same_clients": legacy_checksum[1] == copy_checksum[1],
+            },
+            f"clients_{args.restore_clients}": {
+                "report_mb": round(os.path.getsize(full_path) / 1024 / 1024, 1),
+                "parse_peak_mb": {"streaming": parse_peak_mb(lambda: streaming_parse(full_path))},
+                "copy": full,
+                "sources": {
+                    "dry_run": dry_run,
+                    "restore": sources,
+                    "dry_run_untouched": dry_checksum == seeded_checksum,
+                    "dry_run_matches": all(dry_run[key] == sources[key]
+                                           for key in ("unique", "inserted", "updated", "unchanged")),
+                },
+            },
+        }
+    finally:
+        conn.close()
+        shutil.rmtree(directory)
+    await bot.db.execute('TRUNCATE clients')
+    return results
+
+BENCHMARKS = {
+    "upsert": bench_upsert,
+    "fsm": bench_fsm,
+    "report": bench_report,
+    "indexes": bench_indexes,
+    "workers": bench_workers,
+    "export": bench_export,
+    "search": bench_search,
+    "client_index": bench_client_index,
+    "restore": bench_restore,
+}
+
+async def main(args):
+    if not BENCH_DATABASE_URL:
+        raise SystemExit("Укажите BENCH_DATABASE_URL (отдельная база, её таблицы будут очищены)")
+    if not bot.init_db():
+        raise SystemExit("Не удалось подключиться к базе данных")
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        raise SystemExit(f"Неизвестные бенчмарки: {', '.join(sorted(unknown))}")
+    try:
+        results = {}
+        for name in args.benchmarks or BENCHMARKS:
+            results[name] = await BENCHMARKS[name](args)
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+    finally:
+        bot.db.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Бенчмарки горячих путей бота")
+    parser.add_argument('benchmarks', nargs='*', help=f"что запускать: {', '.join(BENCHMARKS)} (по умолчанию всё)")
+    parser.add_argument('--rows', type=int, default=5000, help="анкет в пиковой нагрузке")
+    parser.add_argument('--concurrency', type=int, default=50, help="одновременных пользователей")
+    parser.add_argument('--sessions', type=int, default=2000, help="активных FSM-сессий")
+    parser.add_argument('--fsm-reads', type=int, default=20000, help="чтений состояния из кэша")
+    parser.add_argument('--clients', type=int, default=200000, help="клиентов в базе для отчёта")
+    parser.add_argument('--index-rows', type=int, default=1_000_000, help="клиентов для сравнения индексов")
+    parser.add_argument('--export-rows', type=int, default=500_000, help="анкет в полной выгрузке")
+    parser.add_argument('--search-sizes', default="100000,1000000", help="размеры базы для поиска клиента, через запятую")
+    parser.add_argument('--restore-clients', type=int, default=500_000, help="клиентов в синтетическом отчёте")
+    parser.add_argument('--legacy-restore-clients', type=int, default=50_000,
+                        help="клиентов в отчёте для сравнения с построчной вставкой")
+    parser.add_argument('--restore-files', type=int, default=4, help="файлов, на которые делится отчёт для восстановления из каталога")
+    parser.add_argument('--repeat', type=int, default=20, help="повторов каждого запроса")
+    parser.add_argument('--workers', default="1,2,4", help="число воркеров в прогонах, через запятую")
+    parser.add_argument('--users', type=int, default=300, help="пользователей, проходящих анкету")
+    parser.add_argument('--duplicate-rate', type=float, default=0.02, help="доля повторных доставок")
+    parser.add_argument('--api-latency', type=float, default=0.05, help="задержка ответа заглушки Bot API, сек.")
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--port', type=int, default=18080, help="порт вебхука бота")
+    parser.add_argument('--warmup', type=float, default=2, help="пауза на запуск воркеров, сек.")
+    parser.add_argument('--timeout', type=float, default=120)
+    asyncio.run(main(parser.parse_args()))
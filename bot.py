@@ -1,13 +1,21 @@
 import os
 import asyncio
+import hashlib
+import json
 import logging
+import re
+import signal
 import sys
 import time
-from datetime import datetime
-from urllib.parse import urlparse
+from collections import Counter
+from datetime import datetime, timedelta
 
-import psycopg2
+from aiohttp import web
+from psycopg2.extras import execute_values
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -17,15 +25,31 @@ from aiogram.types import (
     KeyboardButton,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
-    ReplyKeyboardRemove
+    ReplyKeyboardRemove,
+    BufferedInputFile,
+    FSInputFile
 )
 
+from broadcast import BROADCAST_CHANNEL, Broadcaster, BroadcastQueue
+from client_index import ClientIndex
+from db import Database
+from export import EXPORT_FORMATS, XLSX_AVAILABLE, export_clients
+from fsm_storage import CachedDatabaseStorage, PostgresFSMBackend, SQLiteFSMBackend
+from metrics import CONTENT_TYPE, ERRORS, REGISTRY, SLOW_UPDATES, UPDATES, LogErrorsHandler, telegram_request_middleware
+from migrations import CLIENT_SEARCH_VECTOR, migrate
+from outbound import LANES, NOTIFY, OUTBOUND_LANE, OutboundScheduler
+from profiling import UPDATE_DB_TIME, UpdateProfiler
+from report_cache import ReportCache
+from restore_clients import TRUNCATED_MARK
+from update_queue import UpdateQueue
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
 logger = logging.getLogger(__name__)
+logging.getLogger().addHandler(LogErrorsHandler())
 
 # Инициализация бота
 API_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -35,37 +59,53 @@ if not API_TOKEN:
 
 SUPER_ADMIN_ID = int(os.getenv("SUPER_ADMIN_ID", "0"))
 
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+# Для локальных прогонов бота можно направить в заглушку Bot API (fake_bot_api.py)
+API_URL = os.getenv('TELEGRAM_API_URL')
+if API_URL:
+    bot = Bot(token=API_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(API_URL)))
+else:
+    bot = Bot(token=API_TOKEN)
+# Все исходящие сообщения делят лимит Telegram (около 30 в секунду на бота; 25 —
+# с запасом на всплеск) по приоритету: ответы в диалогах, уведомления админам,
+# рассылки. Лимит на процесс: при WORKERS > 1 OUTBOUND_RATE делится между процессами.
+# OUTBOUND_RATE=0 — без планировщика (заглушка Bot API без лимитов в loadsim.py)
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", "25"))
+outbound = OutboundScheduler(
+    rate=OUTBOUND_RATE or 1,
+    chat_interval=float(os.getenv("OUTBOUND_CHAT_INTERVAL", "1"))
+)
+# Планировщик снаружи: время в очереди не попадает в замер запроса к Bot API
+if OUTBOUND_RATE:
+    bot.session.middleware(outbound.middleware)
+bot.session.middleware(telegram_request_middleware)
+# Пул соединений с PostgreSQL (создаётся в main())
+db = Database(
+    minconn=int(os.getenv("DB_POOL_MIN", "1")),
+    maxconn=int(os.getenv("DB_POOL_MAX", "10")),
+    statement_timeout=int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+)
 
-# Функция для подключения к PostgreSQL
-def get_db_connection():
-    db_url = os.getenv('DATABASE_URL')
-    if not db_url:
-        raise ValueError("DATABASE_URL environment variable is not set")
+# Состояния анкеты и админских диалогов переживают перезапуск:
+# postgres (по умолчанию), sqlite (FSM_SQLITE_PATH) или memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+if FSM_STORAGE == "memory":
+    storage = MemoryStorage()
+elif FSM_STORAGE == "sqlite":
+    storage = CachedDatabaseStorage(
+        SQLiteFSMBackend(os.getenv("FSM_SQLITE_PATH", "fsm_states.db")),
+        cache_size=FSM_CACHE_SIZE
+    )
+else:
+    storage = CachedDatabaseStorage(PostgresFSMBackend(db), cache_size=FSM_CACHE_SIZE)
+dp = Dispatcher(storage=storage)
 
-    try:
-        if db_url.startswith('postgresql://'):
-            result = urlparse(db_url)
-            conn = psycopg2.connect(
-                dbname=result.path[1:],
-                user=result.username,
-                password=result.password,
-                host=result.hostname,
-                port=result.port,
-                connect_timeout=5
-            )
-        else:
-            conn = psycopg2.connect(db_url, sslmode='require')
-        
-        return conn
-    except psycopg2.OperationalError as e:
-        logger.error(f"Ошибка подключения к PostgreSQL: {e}")
-        raise
-    except Exception as e:
-        logger.error(f"Неизвестная ошибка при подключении к БД: {e}")
-        raise
+# Рассылка: собственный потолок скорости в пределах общего лимита отправок
+broadcaster = Broadcaster(
+    bot,
+    rate=float(os.getenv("BROADCAST_RATE", "25")),
+    concurrency=int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+)
 
 # Клавиатуры
 def make_keyboard(items, row_width=2):
@@ -89,6 +129,8 @@ ADMIN_KEYBOARD = make_keyboard([
     "📢 Сделать рассылку",
     "💬 Чат с клиентом",
     "📋 Подробный отчёт",
+    "📤 Выгрузка базы",
+    "📈 Статус рассылок",
     "🔙 Назад"
 ])
 REGULAR_ADMIN_KEYBOARD = make_keyboard([
@@ -97,6 +139,8 @@ REGULAR_ADMIN_KEYBOARD = make_keyboard([
     "📢 Сделать рассылку",
     "💬 Чат с клиентом",
     "📋 Подробный отчёт",
+    "📤 Выгрузка базы",
+    "📈 Статус рассылок",
     "🔙 Назад"
 ])
 CANCEL_KEYBOARD = make_keyboard(["❌ Отмена"])
@@ -126,44 +170,20 @@ def init_db():
     retry_delay = 2  # секунды
     
     for attempt in range(max_retries):
-        conn = None
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS admins (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                added_by BIGINT,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            ''')
-            
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS clients (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                full_name TEXT,
-                appreciate TEXT,
-                dislike TEXT,
-                improve TEXT,
-                gender TEXT,
-                age_group TEXT,
-                visit_freq TEXT,
-                is_admin BOOLEAN DEFAULT FALSE,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            ''')
+            db.open()
+            with db.connection() as conn:
+                # Схема БД описана миграциями в migrations.py
+                migrate(conn)
+                cursor = conn.cursor()
+                
+                # Добавляем основного админа
+                cursor.execute('''
+                INSERT INTO admins (user_id, username, added_by)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (user_id) DO NOTHING
+                ''', (641521378, "sarkis_20032", 641521378))
             
-            # Добавляем основного админа
-            cursor.execute('''
-            INSERT INTO admins (user_id, username, added_by)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (user_id) DO NOTHING
-            ''', (641521378, "sarkis_20032", 641521378))
-            
-            conn.commit()
             logger.info("База данных успешно инициализирована")
             return True
             
@@ -171,73 +191,318 @@ def init_db():
             logger.error(f"Ошибка инициализации БД (попытка {attempt + 1}): {e}")
             if attempt < max_retries - 1:
                 time.sleep(retry_delay)
-        finally:
-            if conn:
-                conn.close()
     
     logger.critical("Не удалось инициализировать базу данных после нескольких попыток")
     return False
 
+# Тексты отчётов админ-панели: сбрасываются при записи анкет, изменении списка
+# админов и очистке базы. TTL страхует от правок из других процессов (воркеры пишут
+# анкеты сами) и недоставленных уведомлений в списке админов
+REPORT_CACHE_TTL = float(os.getenv("REPORT_CACHE_TTL", "60"))  # секунды
+DATABASE_REPORT = "database"
+ADMINS_REPORT = "admins"
+report_cache = ReportCache(ttl=REPORT_CACHE_TTL)
+
+# Список админов в памяти процесса. Загружается при старте, обновляется
+# сразу при изменениях через бота и периодически перечитывается из БД.
+# Число админов есть и в отчёте по базе, поэтому изменения сбрасывают оба отчёта
+class AdminRegistry:
+    def __init__(self):
+        self._ids = frozenset()
+        self._generation = 0
+
+    def __contains__(self, user_id):
+        return user_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def ids(self):
+        return self._ids
+
+    def add(self, user_id):
+        self._ids = self._ids | {user_id}
+        self._generation += 1
+        report_cache.invalidate(ADMINS_REPORT, DATABASE_REPORT)
+
+    def replace(self, user_ids):
+        self._ids = frozenset(user_ids)
+        self._generation += 1
+        report_cache.invalidate(ADMINS_REPORT, DATABASE_REPORT)
+
+    async def refresh(self):
+        generation = self._generation
+        rows = await db.fetchall('SELECT user_id FROM admins')
+        # Пока шёл запрос, список могли изменить через бота — тогда снимок уже устарел
+        ids = frozenset(row[0] for row in rows)
+        if generation == self._generation and ids != self._ids:
+            self._ids = ids
+            report_cache.invalidate(ADMINS_REPORT, DATABASE_REPORT)
+
+admin_registry = AdminRegistry()
+# Канал PostgreSQL, по которому процессы узнают об изменении списка админов
+ADMINS_CHANNEL = "admins_changed"
+ADMIN_REFRESH_INTERVAL = int(os.getenv("ADMIN_REFRESH_INTERVAL", "60"))  # секунды
+
+# Периодическая синхронизация на случай правок таблицы admins в обход бота
+async def refresh_admins_periodically():
+    while True:
+        await asyncio.sleep(ADMIN_REFRESH_INTERVAL)
+        try:
+            await admin_registry.refresh()
+        except Exception as e:
+            logger.error(f"Ошибка обновления списка админов: {e}")
+
 # Проверка прав администратора
 def is_admin(user_id: int) -> bool:
     if user_id == 641521378:  # Принудительный доступ для основного админа
         return True
-        
-    conn = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT 1 FROM admins WHERE user_id = %s', (user_id,))
-        return cursor.fetchone() is not None
-    except Exception as e:
-        logger.error(f"Ошибка проверки админа: {e}")
-        return False
-    finally:
-        if conn:
-            conn.close()
+    return user_id in admin_registry
 
 # Проверка на главного администратора
 def is_super_admin(user_id: int) -> bool:
     return user_id == SUPER_ADMIN_ID
 
-# Уведомление админов
-async def notify_admins(text: str, exclude_id=None):
-    conn = None
+# Фоновые задачи, запущенные из обработчиков (храним ссылки, чтобы их не собрал GC,
+# и дожидаемся при остановке)
+pending_tasks = set()
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    pending_tasks.add(task)
+    task.add_done_callback(pending_tasks.discard)
+    return task
+
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", "10"))
+notify_semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+# После 429 отправку один раз повторяет планировщик исходящих сообщений
+async def send_to_admin(admin_id, text):
+    async with notify_semaphore:
+        await bot.send_message(admin_id, text)
+
+# Рассылка уведомления всем админам параллельно; недоставленные сохраняем в БД.
+# Выполняется отдельной задачей (notify_admins), полоса уведомлений — только в ней
+async def send_to_admins(text: str, exclude_id=None):
+    OUTBOUND_LANE.set(NOTIFY)
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM admins')
-        admins = cursor.fetchall()
+        admin_ids = [admin_id for admin_id in admin_registry.ids() if admin_id != exclude_id]
+        results = await asyncio.gather(
+            *(send_to_admin(admin_id, text) for admin_id in admin_ids),
+            return_exceptions=True
+        )
+        
+        failures = [
+            (admin_id, str(result)[:500], text[:1000])
+            for admin_id, result in zip(admin_ids, results)
+            if isinstance(result, Exception)
+        ]
+        if failures:
+            for admin_id, error, _ in failures:
+                logger.error(f"Не удалось отправить сообщение админу {admin_id}: {error}")
+            await db.run(lambda cursor: execute_values(
+                cursor,
+                'INSERT INTO admin_notify_failures (admin_id, error, message) VALUES %s',
+                failures
+            ))
+            # В списке админов есть счётчик недоставленных уведомлений
+            report_cache.invalidate(ADMINS_REPORT)
+    except Exception as e:
+        logger.error(f"Ошибка уведомления админов: {e}")
+
+# Уведомление админов. Не ждём отправки, чтобы обработчик апдейта завершался сразу
+def notify_admins(text: str, exclude_id=None):
+    return spawn(send_to_admins(text, exclude_id))
+
+# Склейка частей в сообщения, не превышающие лимит Telegram
+def split_text(parts, limit=4000, separator="\n"):
+    messages = []
+    current = ""
+    for part in parts:
+        if current and len(current) + len(separator) + len(part) > limit:
+            messages.append(current)
+            current = ""
+        current = current + separator + part if current else part
+    if current:
+        messages.append(current)
+    return messages
+
+# Режим дайджеста: новые анкеты копятся и уходят админам одной сводкой
+# раз в window секунд или по накоплении max_entries анкет (что наступит раньше)
+class QuestionnaireDigest:
+    def __init__(self, window=0, max_entries=20):
+        self.window = window
+        self.max_entries = max_entries
+        self._entries = []
+        self._timer = None
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def add(self, text):
+        self._entries.append(text)
+        if len(self._entries) >= self.max_entries:
+            self.flush()
+        elif self._timer is None:
+            self._timer = spawn(self._flush_later())
+
+    def configure(self, window, max_entries=None):
+        self.window = window
+        if max_entries:
+            self.max_entries = max_entries
+        # При выключении или уменьшении окна не держим уже накопленное
+        self.flush()
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        self.flush()
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        entries, self._entries = self._entries, []
+        if not entries:
+            return
         
-        for admin in admins:
-            admin_id = admin[0]
-            if admin_id == exclude_id:
-                continue
+        header = f"📝 Новые анкеты: {len(entries)}"
+        for text in split_text([header] + entries, separator="\n\n➖➖➖\n\n"):
+            notify_admins(text)
+
+questionnaire_digest = QuestionnaireDigest(
+    window=int(os.getenv("DIGEST_WINDOW", "0")),
+    max_entries=int(os.getenv("DIGEST_MAX_ENTRIES", "20"))
+)
+
+# Сохранение анкет пачками: одна многострочная вставка и один коммит
+# вместо отдельного соединения и коммита на каждую анкету
+UPSERT_CLIENTS_QUERY = '''
+INSERT INTO clients (
+    user_id, username, full_name, appreciate, dislike, 
+    improve, gender, age_group, visit_freq, is_admin
+) VALUES %s
+ON CONFLICT (user_id) DO UPDATE SET
+    username = EXCLUDED.username,
+    full_name = EXCLUDED.full_name,
+    appreciate = EXCLUDED.appreciate,
+    dislike = EXCLUDED.dislike,
+    improve = EXCLUDED.improve,
+    gender = EXCLUDED.gender,
+    age_group = EXCLUDED.age_group,
+    visit_freq = EXCLUDED.visit_freq,
+    is_admin = EXCLUDED.is_admin,
+    timestamp = CURRENT_TIMESTAMP
+'''
+
+def upsert_clients(cursor, rows):
+    execute_values(cursor, UPSERT_CLIENTS_QUERY, rows, page_size=len(rows))
+
+# Буфер анкет с отложенной записью: сбрасывается раз в flush_interval секунд
+# или при накоплении max_batch анкет, а также при остановке бота
+class ClientWriter:
+    def __init__(self, flush_interval=0.5, max_batch=500):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        # user_id -> строка; повторная анкета того же клиента заменяет предыдущую
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._writing = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, row):
+        self._pending[row[0]] = row
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return 0
+            rows, self._pending = list(self._pending.values()), {}
+            # Запись идёт в потоке и отменой задачи не прерывается: close() её дожидается
+            self._writing = asyncio.ensure_future(db.run(upsert_clients, rows))
             try:
-                await bot.send_message(admin_id, text)
+                await asyncio.shield(self._writing)
+            except BaseException:
+                # Возвращаем в буфер всё, что не было перезаписано более новой анкетой
+                # (и при отмене на остановке — запись могла не дойти до БД, повторный
+                # upsert безвреден)
+                for row in rows:
+                    self._pending.setdefault(row[0], row)
+                raise
+            report_cache.invalidate(DATABASE_REPORT)
+            return len(rows)
+
+    async def run_forever(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
             except Exception as e:
-                logger.error(f"Не удалось отправить сообщение админу {admin_id}: {e}")
+                logger.error(f"Ошибка сохранения анкет ({len(self._pending)} в буфере): {e}")
+                await asyncio.sleep(self.flush_interval)
+
+    # Финальный сброс при остановке: если БД недоступна, анкеты хотя бы попадут в лог
+    async def close(self):
+        if self._writing:
+            await asyncio.gather(self._writing, return_exceptions=True)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.critical(f"Не удалось сохранить анкеты при остановке: {e}")
+            for row in self._pending.values():
+                logger.critical(f"Несохранённая анкета: {row}")
+
+client_writer = ClientWriter(
+    flush_interval=float(os.getenv("CLIENT_FLUSH_INTERVAL", "0.5")),
+    max_batch=int(os.getenv("CLIENT_FLUSH_BATCH", "500"))
+)
+
+# Все клиенты в памяти: проверка «проходил ли анкету» не ходит в БД.
+# Пополняется при заполнении анкеты (ещё до записи в БД), очищается вместе с базой.
+# Правки clients в обход бота (restore_clients.py) подхватываются по CLIENTS_CHANNEL
+# и периодической перезагрузкой
+client_index = ClientIndex(db)
+CLIENTS_CHANNEL = "clients_changed"
+CLIENT_INDEX_REFRESH_INTERVAL = int(os.getenv("CLIENT_INDEX_REFRESH_INTERVAL", "600"))  # секунды
+
+# Сначала дописываем буфер анкет, иначе свежих клиентов не будет в снимке из БД
+async def refresh_client_index():
+    try:
+        await client_writer.flush()
+        await client_index.refresh()
+        report_cache.invalidate(DATABASE_REPORT)
     except Exception as e:
-        logger.error(f"Ошибка уведомления админов: {e}")
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Ошибка обновления индекса клиентов: {e}")
+
+async def refresh_client_index_periodically():
+    while True:
+        await asyncio.sleep(CLIENT_INDEX_REFRESH_INTERVAL)
+        await refresh_client_index()
+
+# Клиент уже проходил анкету (в том числе ещё не записанную в БД)
+def is_client(user_id: int) -> bool:
+    return user_id in client_index
 
 # ========== ОБРАБОТЧИКИ КОМАНД ==========
 
 @dp.message(Command('start'))
 async def cmd_start(message: types.Message, state: FSMContext):
-    conn = None
     try:
         await state.clear()
         user_id = message.from_user.id
         admin_status = is_admin(user_id)
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT 1 FROM clients WHERE user_id = %s', (user_id,))
-        
-        if cursor.fetchone():
+        if is_client(user_id):
             if not admin_status:
                 await message.answer("Вы уже проходили анкету. Хотите пройти её ещё раз?", 
                                    reply_markup=YES_NO_KEYBOARD)
@@ -264,9 +529,6 @@ async def cmd_start(message: types.Message, state: FSMContext):
     except Exception as e:
         logger.error(f"Ошибка в команде /start: {e}")
         await message.answer("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.")
-    finally:
-        if conn:
-            conn.close()
 
 @dp.message(Command('admin'))
 async def admin_panel(message: types.Message):
@@ -290,6 +552,97 @@ async def admin_panel(message: types.Message):
         logger.error(f"Ошибка админ-панели: {e}")
         await message.answer("⚠️ Ошибка доступа к админ-панели")
 
+# Настройка дайджеста новых анкет: /digest, /digest 60 [20], /digest off
+@dp.message(Command('digest'))
+async def configure_digest(message: types.Message):
+    try:
+        if not is_super_admin(message.from_user.id):
+            await message.answer("⛔ У вас недостаточно прав для этой операции")
+            return
+        
+        args = message.text.split()[1:]
+        if args and args[0].lower() in ('off', '0'):
+            questionnaire_digest.configure(0)
+        elif args:
+            try:
+                window = int(args[0])
+                max_entries = int(args[1]) if len(args) > 1 else None
+            except ValueError:
+                await message.answer("Использование: /digest <секунд> [анкет] или /digest off")
+                return
+            if window < 0 or (max_entries is not None and max_entries < 1):
+                await message.answer("Использование: /digest <секунд> [анкет] или /digest off")
+                return
+            questionnaire_digest.configure(window, max_entries)
+        
+        if questionnaire_digest.enabled:
+            await message.answer(
+                f"📨 Дайджест анкет включён: раз в {questionnaire_digest.window} сек. "
+                f"или каждые {questionnaire_digest.max_entries} анкет"
+            )
+        else:
+            await message.answer("📨 Дайджест анкет выключен, анкеты приходят сразу")
+    except Exception as e:
+        logger.error(f"Ошибка настройки дайджеста: {e}")
+        await message.answer("⚠️ Ошибка. Попробуйте снова.")
+
+PROFILE_MAX_UPDATES = 10000
+PROFILE_USAGE = "Использование: /profile [обновлений] [доля выборки 0-1] или /profile stop"
+
+async def send_profile(chat_id, report, captured):
+    try:
+        await bot.send_document(
+            chat_id,
+            BufferedInputFile(report.encode(), filename=f"profile_{datetime.now():%Y-%m-%d_%H%M}.txt"),
+            caption=f"🔬 Профиль обработки: {captured} обновлений"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка отправки профиля: {e}")
+
+# Захват cProfile для следующих обновлений этого процесса: /profile, /profile 500 0.1,
+# /profile stop (отчёт по уже снятым). Отчёт приходит документом
+@dp.message(Command('profile'))
+async def configure_profile(message: types.Message):
+    try:
+        if not is_super_admin(message.from_user.id):
+            await message.answer("⛔ У вас недостаточно прав для этой операции")
+            return
+        
+        chat_id = message.chat.id
+        args = message.text.split()[1:]
+        if args and args[0].lower() == 'stop':
+            if not profiler.capturing:
+                await message.answer("🔬 Профилирование не запущено")
+                return
+            profiler.stop()
+            return
+        if profiler.capturing:
+            await message.answer("⏳ Профилирование уже идёт. Остановить: /profile stop")
+            return
+        
+        try:
+            updates = int(args[0]) if args else 200
+            sample_rate = float(args[1]) if len(args) > 1 else 1.0
+        except ValueError:
+            await message.answer(PROFILE_USAGE)
+            return
+        if not 1 <= updates <= PROFILE_MAX_UPDATES or not 0 < sample_rate <= 1:
+            await message.answer(PROFILE_USAGE)
+            return
+        
+        profiler.start(
+            updates, sample_rate,
+            on_done=lambda report, captured: spawn(send_profile(chat_id, report, captured))
+        )
+        logger.info(f"Суперадмин {message.from_user.id} запустил профилирование ({updates} обновлений)")
+        await message.answer(
+            f"🔬 Профилирую {updates} обновлений: каждое следующее попадает "
+            f"в выборку с вероятностью {sample_rate:g}. Отчёт придёт файлом"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка настройки профилирования: {e}")
+        await message.answer("⚠️ Ошибка. Попробуйте снова.")
+
 # ========== ОБРАБОТЧИКИ АНКЕТЫ ==========
 
 @dp.message(Questionnaire.WANT_HELP)
@@ -394,7 +747,6 @@ async def process_age(message: types.Message, state: FSMContext):
 
 @dp.message(Questionnaire.VISIT_FREQ)
 async def process_visit_freq(message: types.Message, state: FSMContext):
-    conn = None
     try:
         if message.text not in ["До 3 раз", "3-8 раз", "Более 8 раз"]:
             await message.answer("Пожалуйста, выберите вариант из предложенных.")
@@ -402,27 +754,8 @@ async def process_visit_freq(message: types.Message, state: FSMContext):
         
         user_data = await state.get_data()
         
-        # Сохраняем данные в базу
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO clients (
-            user_id, username, full_name, appreciate, dislike, 
-            improve, gender, age_group, visit_freq, is_admin
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (user_id) DO UPDATE SET
-            username = EXCLUDED.username,
-            full_name = EXCLUDED.full_name,
-            appreciate = EXCLUDED.appreciate,
-            dislike = EXCLUDED.dislike,
-            improve = EXCLUDED.improve,
-            gender = EXCLUDED.gender,
-            age_group = EXCLUDED.age_group,
-            visit_freq = EXCLUDED.visit_freq,
-            is_admin = EXCLUDED.is_admin,
-            timestamp = CURRENT_TIMESTAMP
-        ''', (
+        # Сохраняем данные в базу (пачкой вместе с другими анкетами)
+        client_writer.add((
             message.from_user.id,
             user_data.get('username'),
             user_data.get('full_name'),
@@ -434,12 +767,11 @@ async def process_visit_freq(message: types.Message, state: FSMContext):
             message.text,
             user_data.get('is_admin', False)
         ))
-        conn.commit()
+        client_index.add(message.from_user.id)
         
         # Формируем сообщение для админов (только если пользователь не админ)
         if not user_data.get('is_admin', False):
-            admin_message = (
-                "📝 Новая анкета:\n\n"
+            questionnaire_text = (
                 f"👤 Пользователь: @{user_data.get('username', 'без username')} ({user_data.get('full_name', 'без имени')})\n"
                 f"🆔 ID: {message.from_user.id}\n"
                 f"👍 Что нравится: {user_data.get('appreciate', 'не указано')}\n"
@@ -449,7 +781,10 @@ async def process_visit_freq(message: types.Message, state: FSMContext):
                 f"📊 Возраст: {user_data.get('age_group', 'не указана')}\n"
                 f"🛒 Частота посещений: {message.text}"
             )
-            await notify_admins(admin_message)
+            if questionnaire_digest.enabled:
+                questionnaire_digest.add(questionnaire_text)
+            else:
+                notify_admins("📝 Новая анкета:\n\n" + questionnaire_text)
         
         # Первое сообщение - благодарность и контакты
         await message.answer(
@@ -476,100 +811,114 @@ async def process_visit_freq(message: types.Message, state: FSMContext):
     except Exception as e:
         logger.error(f"Ошибка в обработке VISIT_FREQ: {e}")
         await message.answer("⚠️ Произошла ошибка. Пожалуйста, попробуйте снова.")
-    finally:
-        if conn:
-            conn.close()
 
 # ========== АДМИН-ПАНЕЛЬ ==========
 
-@dp.message(lambda m: m.text == "📊 Отчёт по базе" and is_admin(m.from_user.id))
-async def database_report(message: types.Message):
-    conn = None
+# Кнопки админ-панели: текст кнопки -> (обработчик, только для суперадмина, текст отказа)
+ADMIN_COMMANDS = {}
+
+def admin_command(text, super_admin_only=False, denied_text="⛔ У вас недостаточно прав для этой операции"):
+    def decorator(handler):
+        ADMIN_COMMANDS[text] = (handler, super_admin_only, denied_text)
+        return handler
+    return decorator
+
+# Один фильтр на все кнопки: поиск по словарю и одна проверка прав на апдейт.
+# Асинхронный, чтобы aiogram не гонял его через пул потоков
+async def admin_command_filter(message: types.Message):
+    command = ADMIN_COMMANDS.get(message.text)
+    if command is None or not is_admin(message.from_user.id):
+        return False
+    return {"admin_command": command}
+
+@dp.message(admin_command_filter)
+async def admin_menu(message: types.Message, state: FSMContext, admin_command):
+    handler, super_admin_only, denied_text = admin_command
+    if super_admin_only and not is_super_admin(message.from_user.id):
+        await message.answer(denied_text)
+        return
+    await handler(message, state)
+
+# Отчёт строится по сводке client_segments (десятки строк) и индексу по timestamp,
+# поэтому время не зависит от числа клиентов
+def collect_report_stats(cursor):
+    cursor.execute('''
+    SELECT total, NULLIF(gender, ''), NULLIF(age_group, ''), NULLIF(visit_freq, '')
+    FROM client_segments
+    WHERE total > 0
+    ORDER BY gender, age_group, visit_freq
+    ''')
+    stats = cursor.fetchall()
+    
+    cursor.execute('SELECT MIN(timestamp), MAX(timestamp) FROM clients')
+    first_date, last_date = cursor.fetchone()
+    
+    return sum(row[0] for row in stats), first_date, last_date, stats
+
+def render_database_report(total_clients, total_admins, first_date, last_date, stats):
+    parts = [
+        "📊 Отчёт по базе:\n"
+        f"👥 Всего клиентов: {total_clients}\n"
+        f"👨‍💻 Всего админов: {total_admins}\n"
+        f"📅 Первая анкета: {first_date}\n"
+        f"📅 Последняя анкета: {last_date}\n\n"
+        "📈 Статистика по клиентам:\n"
+    ]
+    parts.extend(f"• {row[1]}, {row[2]}, посещает {row[3]}: {row[0]} чел.\n" for row in stats)
+    return "".join(parts)
+
+async def build_database_report():
+    total_clients, first_date, last_date, stats = await db.run(collect_report_stats)
+    return render_database_report(total_clients, len(admin_registry), first_date, last_date, stats)
+
+@admin_command("📊 Отчёт по базе")
+async def database_report(message: types.Message, state: FSMContext):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT COUNT(*) FROM clients')
-        total_clients = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM admins')
-        total_admins = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT MIN(timestamp), MAX(timestamp) FROM clients')
-        first_date, last_date = cursor.fetchone()
-        
-        cursor.execute('''
-        SELECT 
-            COUNT(*) as total,
-            gender,
-            age_group,
-            visit_freq
-        FROM clients
-        GROUP BY gender, age_group, visit_freq
-        ''')
-        
-        stats = cursor.fetchall()
-        
-        report = (
-            "📊 Отчёт по базе:\n"
-            f"👥 Всего клиентов: {total_clients}\n"
-            f"👨‍💻 Всего админов: {total_admins}\n"
-            f"📅 Первая анкета: {first_date}\n"
-            f"📅 Последняя анкета: {last_date}\n\n"
-            "📈 Статистика по клиентам:\n"
-        )
-        
-        for row in stats:
-            report += f"• {row[1]}, {row[2]}, посещает {row[3]}: {row[0]} чел.\n"
-        
-        await message.answer(report)
+        await message.answer(await report_cache.get(DATABASE_REPORT, build_database_report))
     except Exception as e:
         await message.answer(f"⚠️ Ошибка формирования отчёта: {str(e)}")
-    finally:
-        if conn:
-            conn.close()
 
-@dp.message(lambda m: m.text == "👥 Список админов" and is_admin(m.from_user.id))
-async def list_admins(message: types.Message):
-    conn = None
+def render_admins(admins):
+    parts = ["👨‍💻 Список админов:\n\n"]
+    for admin in admins:
+        parts.append(
+            f"🆔 ID: {admin[0]}\n"
+            f"👤 @{admin[1]}\n"
+            f"➕ Добавил: @{admin[2]}\n"
+            f"📅 Дата: {admin[3]}\n"
+        )
+        if admin[4]:
+            parts.append(f"⚠️ Недоставлено уведомлений за неделю: {admin[4]}\n")
+        parts.append("\n")
+    return "".join(parts)
+
+async def build_admins_report():
+    admins = await db.fetchall('''
+    SELECT a.user_id, a.username, u.username as added_by_username, a.added_at,
+           (SELECT COUNT(*) FROM admin_notify_failures f
+            WHERE f.admin_id = a.user_id AND f.created_at > NOW() - INTERVAL '7 days')
+    FROM admins a
+    LEFT JOIN admins u ON a.added_by = u.user_id
+    ORDER BY a.added_at DESC
+    ''')
+    return render_admins(admins) if admins else None
+
+@admin_command("👥 Список админов")
+async def list_admins(message: types.Message, state: FSMContext):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT a.user_id, a.username, u.username as added_by_username, a.added_at
-        FROM admins a
-        LEFT JOIN admins u ON a.added_by = u.user_id
-        ORDER BY a.added_at DESC
-        ''')
-        admins = cursor.fetchall()
-        
-        if not admins:
+        report = await report_cache.get(ADMINS_REPORT, build_admins_report)
+        if report is None:
             await message.answer("Нет зарегистрированных админов")
             return
         
-        response = "👨‍💻 Список админов:\n\n"
-        for admin in admins:
-            response += (
-                f"🆔 ID: {admin[0]}\n"
-                f"👤 @{admin[1]}\n"
-                f"➕ Добавил: @{admin[2]}\n"
-                f"📅 Дата: {admin[3]}\n\n"
-            )
-        
-        await message.answer(response)
+        await message.answer(report)
     except Exception as e:
         await message.answer(f"⚠️ Ошибка получения списка админов: {str(e)}")
-    finally:
-        if conn:
-            conn.close()
 
-@dp.message(lambda m: m.text == "➕ Добавить админа" and is_admin(m.from_user.id))
+@admin_command("➕ Добавить админа", super_admin_only=True,
+               denied_text="⛔ Только главный администратор может добавлять новых админов")
 async def add_admin_start(message: types.Message, state: FSMContext):
     try:
-        if not is_super_admin(message.from_user.id):
-            await message.answer("⛔ Только главный администратор может добавлять новых админов")
-            return
-            
         await message.answer(
             "Введите ID пользователя, которого хотите сделать админом:",
             reply_markup=CANCEL_KEYBOARD
@@ -581,7 +930,6 @@ async def add_admin_start(message: types.Message, state: FSMContext):
 
 @dp.message(AdminStates.ADD_ADMIN)
 async def add_admin_finish(message: types.Message, state: FSMContext):
-    conn = None
     try:
         if message.text == "❌ Отмена":
             await message.answer("Действие отменено", reply_markup=ADMIN_KEYBOARD)
@@ -604,24 +952,22 @@ async def add_admin_finish(message: types.Message, state: FSMContext):
             new_admin_username = "неизвестно"
             new_admin_fullname = "неизвестно"
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT 1 FROM admins WHERE user_id = %s', (new_admin_id,))
-        if cursor.fetchone():
-            await message.answer("Этот пользователь уже является админом", reply_markup=ADMIN_KEYBOARD)
-            await state.clear()
-            return
-        
-        cursor.execute('''
+        inserted = await db.execute('''
         INSERT INTO admins (user_id, username, added_by)
         VALUES (%s, %s, %s)
+        ON CONFLICT (user_id) DO NOTHING
         ''', (
             new_admin_id,
             new_admin_username,
             message.from_user.id
         ))
-        conn.commit()
+        admin_registry.add(new_admin_id)
+        if not inserted:
+            await message.answer("Этот пользователь уже является админом", reply_markup=ADMIN_KEYBOARD)
+            await state.clear()
+            return
+        # Остальные процессы перечитают список админов
+        await db.execute(f'NOTIFY {ADMINS_CHANNEL}')
         
         # Отправляем сообщение новому админу
         try:
@@ -654,7 +1000,7 @@ async def add_admin_finish(message: types.Message, state: FSMContext):
             f"➕ Добавил: @{message.from_user.username} (ID: {message.from_user.id})\n\n"
             f"ℹ️ Новый админ не имеет прав на удаление других администраторов"
         )
-        await notify_admins(admin_message)
+        notify_admins(admin_message)
         
         await message.answer(
             f"✅ Пользователь @{new_admin_username} добавлен как админ\n"
@@ -665,17 +1011,11 @@ async def add_admin_finish(message: types.Message, state: FSMContext):
         logger.error(f"Ошибка добавления админа: {e}")
         await message.answer("⚠️ Ошибка добавления админа. Попробуйте снова.")
     finally:
-        if conn:
-            conn.close()
         await state.clear()
 
-@dp.message(lambda m: m.text == "🗑️ Очистить админов" and is_admin(m.from_user.id))
-async def clear_admins_start(message: types.Message):
+@admin_command("🗑️ Очистить админов", super_admin_only=True)
+async def clear_admins_start(message: types.Message, state: FSMContext):
     try:
-        if not is_super_admin(message.from_user.id):
-            await message.answer("⛔ У вас недостаточно прав для этой операции")
-            return
-            
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="✅ Да, очистить", callback_data="confirm_clear_admins")],
             [InlineKeyboardButton(text="❌ Нет, отменить", callback_data="cancel_clear_admins")]
@@ -697,11 +1037,7 @@ async def confirm_clear_admins(callback: types.CallbackQuery):
         await callback.answer("⛔ У вас недостаточно прав", show_alert=True)
         return
         
-    conn = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
+    def clear_admins(cursor):
         # Удаляем всех админов, кроме текущего
         cursor.execute('DELETE FROM admins WHERE user_id != %s', (callback.from_user.id,))
         
@@ -711,8 +1047,11 @@ async def confirm_clear_admins(callback: types.CallbackQuery):
         VALUES (%s, %s, %s)
         ON CONFLICT (user_id) DO NOTHING
         ''', (callback.from_user.id, callback.from_user.username, callback.from_user.id))
-        
-        conn.commit()
+        cursor.execute(f'NOTIFY {ADMINS_CHANNEL}')
+    
+    try:
+        await db.run(clear_admins)
+        admin_registry.replace({callback.from_user.id})
         
         await callback.message.edit_text(
             "✅ База админов очищена. Вы остались единственным администратором.",
@@ -725,8 +1064,6 @@ async def confirm_clear_admins(callback: types.CallbackQuery):
             reply_markup=None
         )
     finally:
-        if conn:
-            conn.close()
         await callback.answer()
 
 @dp.callback_query(lambda c: c.data == "cancel_clear_admins")
@@ -741,13 +1078,9 @@ async def cancel_clear_admins(callback: types.CallbackQuery):
     finally:
         await callback.answer()
 
-@dp.message(lambda m: m.text == "🧹 Очистить базу" and is_admin(m.from_user.id))
-async def clear_database_start(message: types.Message):
+@admin_command("🧹 Очистить базу", super_admin_only=True)
+async def clear_database_start(message: types.Message, state: FSMContext):
     try:
-        if not is_super_admin(message.from_user.id):
-            await message.answer("⛔ У вас недостаточно прав для этой операции")
-            return
-            
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="✅ Да, очистить", callback_data="confirm_clear")],
             [InlineKeyboardButton(text="❌ Нет, отменить", callback_data="cancel_clear")]
@@ -768,12 +1101,18 @@ async def confirm_clear_db(callback: types.CallbackQuery):
         await callback.answer("⛔ У вас недостаточно прав", show_alert=True)
         return
         
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM clients')
-        conn.commit()
+        # Сначала дописываем буфер, чтобы очистка затронула и свежие анкеты
+        await client_writer.flush()
+        
+        def clear_clients(cursor):
+            cursor.execute('DELETE FROM clients')
+            # Остальные процессы перечитают индекс клиентов
+            cursor.execute(f'NOTIFY {CLIENTS_CHANNEL}')
+        
+        await db.run(clear_clients)
+        client_index.clear()
+        report_cache.invalidate(DATABASE_REPORT)
         
         await callback.message.edit_text(
             "✅ База клиентов очищена",
@@ -786,8 +1125,6 @@ async def confirm_clear_db(callback: types.CallbackQuery):
             reply_markup=None
         )
     finally:
-        if conn:
-            conn.close()
         await callback.answer()
 
 @dp.callback_query(lambda c: c.data == "cancel_clear")
@@ -802,7 +1139,7 @@ async def cancel_clear_db(callback: types.CallbackQuery):
     finally:
         await callback.answer()
 
-@dp.message(lambda m: m.text == "📢 Сделать рассылку" and is_admin(m.from_user.id))
+@admin_command("📢 Сделать рассылку")
 async def start_broadcast(message: types.Message, state: FSMContext):
     await message.answer(
         "Введите сообщение для рассылки всем клиентам:",
@@ -810,6 +1147,55 @@ async def start_broadcast(message: types.Message, state: FSMContext):
     )
     await state.set_state(AdminStates.SEND_BROADCAST)
 
+def format_broadcast_progress(stats):
+    eta = f"{int(stats.eta)} сек." if stats.eta is not None else "—"
+    return (
+        f"⏳ Рассылка: {stats.done} из {stats.total}\n"
+        f"• Успешно: {stats.sent}\n"
+        f"• Не удалось: {stats.failed}\n"
+        f"• Скорость: {stats.rate:.1f} сообщ./сек.\n"
+        f"• Осталось примерно: {eta}"
+    )
+
+# Прогресс показываем, редактируя одно и то же сообщение
+async def show_broadcast_progress(job, stats):
+    job_id, chat_id, status_message_id = job[0], job[3], job[4]
+    if chat_id and status_message_id:
+        await bot.edit_message_text(
+            f"#{job_id} " + format_broadcast_progress(stats),
+            chat_id=chat_id,
+            message_id=status_message_id
+        )
+
+async def finish_broadcast(job, stats):
+    job_id, text, chat_id, status_message_id, username = job[0], job[1], job[3], job[4], job[5]
+    report = (
+        f"✅ Рассылка #{job_id} завершена:\n"
+        f"• Успешно: {stats.sent}\n"
+        f"• Не удалось: {stats.failed}\n"
+        f"• Всего: {stats.total}"
+    )
+    
+    if chat_id and status_message_id:
+        try:
+            await bot.edit_message_text(report, chat_id=chat_id, message_id=status_message_id)
+        except Exception as e:
+            logger.error(f"Ошибка обновления прогресса рассылки: {e}")
+    
+    # Уведомляем других админов
+    notify_admins(
+        f"Администратор @{username} выполнил рассылку:\n\n"
+        f"{text}\n\n"
+        f"{report}"
+    )
+
+broadcast_queue = BroadcastQueue(
+    db,
+    broadcaster,
+    on_progress=show_broadcast_progress,
+    on_finish=finish_broadcast
+)
+
 @dp.message(AdminStates.SEND_BROADCAST)
 async def process_broadcast(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
@@ -817,95 +1203,205 @@ async def process_broadcast(message: types.Message, state: FSMContext):
         await state.clear()
         return
     
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM clients WHERE is_admin = FALSE')
-        clients = cursor.fetchall()
-        
-        total = len(clients)
-        success = 0
-        failed = 0
-        
-        await message.answer(f"⏳ Начинаю рассылку для {total} клиентов...")
-        
-        for client in clients:
-            try:
-                await bot.send_message(
-                    client[0],
-                    f"📢 Важное сообщение от сети магазинов 'Дым':\n\n{message.text}"
-                )
-                success += 1
-            except Exception as e:
-                logger.error(f"Ошибка отправки сообщения клиенту {client[0]}: {e}")
-                failed += 1
-            await asyncio.sleep(0.1)  # Задержка для избежания ограничений Telegram
-        
-        report = (
-            f"✅ Рассылка завершена:\n"
-            f"• Успешно: {success}\n"
-            f"• Не удалось: {failed}\n"
-            f"• Всего: {total}"
+        status = await message.answer("⏳ Готовлю рассылку...")
+        # Получатели берутся из БД, поэтому свежие анкеты дописываем заранее
+        await client_writer.flush()
+        job_id, total = await broadcast_queue.create(
+            f"📢 Важное сообщение от сети магазинов 'Дым':\n\n{message.text}",
+            message.from_user.id,
+            message.from_user.username,
+            status.chat.id,
+            status.message_id
         )
+        broadcast_queue.wake()
         
-        await message.answer(report, reply_markup=ADMIN_KEYBOARD)
-        
-        # Уведомляем других админов
-        await notify_admins(
-            f"Администратор @{message.from_user.username} выполнил рассылку:\n\n"
-            f"{message.text}\n\n"
-            f"{report}"
+        await status.edit_text(f"⏳ Рассылка #{job_id} для {total} клиентов поставлена в очередь...")
+        await message.answer(
+            "Рассылка идёт в фоне, прогресс — в сообщении выше и по кнопке «📈 Статус рассылок»",
+            reply_markup=ADMIN_KEYBOARD
         )
-        
     except Exception as e:
         logger.error(f"Ошибка рассылки: {e}")
         await message.answer("⚠️ Произошла ошибка при рассылке", reply_markup=ADMIN_KEYBOARD)
     finally:
-        if conn:
-            conn.close()
         await state.clear()
 
-@dp.message(lambda m: m.text == "💬 Чат с клиентом" and is_admin(m.from_user.id))
+@admin_command("📈 Статус рассылок")
+async def broadcast_status(message: types.Message, state: FSMContext):
+    try:
+        jobs = await broadcast_queue.running_jobs()
+        if not jobs:
+            await message.answer("Активных рассылок нет")
+            return
+        
+        parts = ["📈 Активные рассылки:"]
+        for job_id, total, username, created_at, sent, failed in jobs:
+            stats = broadcast_queue.active.get(job_id)
+            if stats:
+                parts.append(f"#{job_id} от @{username} ({created_at:%d.%m %H:%M})\n" + format_broadcast_progress(stats))
+            else:
+                parts.append(
+                    f"#{job_id} от @{username} ({created_at:%d.%m %H:%M})\n"
+                    f"⏸ В очереди: {sent + failed} из {total}"
+                )
+        await message.answer("\n\n".join(parts))
+    except Exception as e:
+        logger.error(f"Ошибка получения статуса рассылок: {e}")
+        await message.answer("⚠️ Ошибка получения статуса рассылок")
+
+# Выбор клиента для чата: поиск по началу слов имени, username или ID.
+# Результат кэшируется на админа, страницы листаются из памяти
+CLIENT_SEARCH_PAGE_SIZE = 10
+CLIENT_SEARCH_LIMIT = 100
+CLIENT_SEARCH_MIN_LENGTH = 2
+CLIENT_SEARCH_PROBE = 5000  # свежих анкет, среди которых сначала ищем частые совпадения
+CLIENT_SEARCH_TTL = 60  # секунды
+client_search_cache = {}  # admin_id -> (запрос, истекает, клиенты)
+
+# Слова режем так же, как парсер PostgreSQL: по всему, кроме букв и цифр ("@user_1" -> user, 1)
+def search_words(text):
+    return re.findall(r"[^\W_]+", text.lower())
+
+RECENT_CLIENTS_QUERY = '''
+SELECT user_id, full_name, username, timestamp FROM clients
+WHERE is_admin = FALSE
+ORDER BY COALESCE(timestamp, '-infinity') DESC, user_id DESC
+LIMIT %s
+'''
+
+# Планировщик не умеет оценивать префиксный поиск и для редких слов выбирает проход
+# по всему индексу свежих анкет. Поэтому план выбираем сами: частое слово находится
+# среди последних CLIENT_SEARCH_PROBE анкет, редкое — по индексу clients_search_idx
+# (MATERIALIZED не даёт планировщику заменить его сортированным проходом).
+# Лишняя строка показывает, что совпадений больше лимита
+def search_clients(cursor, query):
+    if not query:
+        cursor.execute(RECENT_CLIENTS_QUERY, (CLIENT_SEARCH_LIMIT + 1,))
+        return [row[:3] for row in cursor.fetchall()]
+    
+    # "Мария ив" -> 'мария':* & 'ив':* — каждое слово как начало слова
+    tsquery = " & ".join(f"'{word}':*" for word in search_words(query))
+    cursor.execute(f'''
+    SELECT user_id, full_name, username FROM ({RECENT_CLIENTS_QUERY}) recent
+    WHERE {CLIENT_SEARCH_VECTOR} @@ to_tsquery('simple', %s)
+    ORDER BY COALESCE(timestamp, '-infinity') DESC, user_id DESC
+    LIMIT %s
+    ''', (CLIENT_SEARCH_PROBE, tsquery, CLIENT_SEARCH_LIMIT + 1))
+    clients = cursor.fetchall()
+    if len(clients) > CLIENT_SEARCH_LIMIT:
+        return clients
+    
+    cursor.execute(f'''
+    WITH matches AS MATERIALIZED (
+        SELECT user_id, full_name, username, timestamp FROM clients
+        WHERE is_admin = FALSE AND {CLIENT_SEARCH_VECTOR} @@ to_tsquery('simple', %s)
+    )
+    SELECT user_id, full_name, username FROM matches
+    ORDER BY COALESCE(timestamp, '-infinity') DESC, user_id DESC
+    LIMIT %s
+    ''', (tsquery, CLIENT_SEARCH_LIMIT + 1))
+    return cursor.fetchall()
+
+async def find_clients(admin_id, query):
+    cached = client_search_cache.get(admin_id)
+    if cached and cached[0] == query and cached[1] > time.monotonic():
+        return cached[2]
+    clients = await db.run(search_clients, query)
+    client_search_cache[admin_id] = (query, time.monotonic() + CLIENT_SEARCH_TTL, clients)
+    return clients
+
+def render_client_picker(clients, query, page):
+    pages = max(1, -(-min(len(clients), CLIENT_SEARCH_LIMIT) // CLIENT_SEARCH_PAGE_SIZE))
+    if query:
+        found = f"больше {CLIENT_SEARCH_LIMIT}, уточните запрос" if len(clients) > CLIENT_SEARCH_LIMIT else len(clients)
+        text = f"🔍 Поиск «{query}»: найдено {found}"
+    else:
+        text = "Последние клиенты"
+    text += (
+        f" (страница {page + 1}/{pages})\n\n"
+        "Выберите клиента для чата или отправьте начало имени, username или ID для поиска:"
+    )
+    
+    start = page * CLIENT_SEARCH_PAGE_SIZE
+    keyboard = [
+        [InlineKeyboardButton(
+            text=f"{full_name} (@{username}, ID: {client_id})" if username else f"{full_name} (ID: {client_id})",
+            callback_data=f"admin_chat_{client_id}"
+        )] for client_id, full_name, username in clients[start:min(start + CLIENT_SEARCH_PAGE_SIZE, CLIENT_SEARCH_LIMIT)]
+    ]
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"chat_search:{page - 1}"))
+    if page + 1 < pages:
+        navigation.append(InlineKeyboardButton(text="Далее ➡️", callback_data=f"chat_search:{page + 1}"))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_chat_select")])
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+@admin_command("💬 Чат с клиентом")
 async def chat_with_client_start(message: types.Message, state: FSMContext):
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id, full_name FROM clients WHERE is_admin = FALSE ORDER BY timestamp DESC LIMIT 50')
-        clients = cursor.fetchall()
+        clients = await find_clients(message.from_user.id, "")
         
         if not clients:
             await message.answer("Нет клиентов для чата")
             return
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(
-                text=f"{full_name} (ID: {client_id})",
-                callback_data=f"admin_chat_{client_id}"
-            )] for client_id, full_name in clients
-        ])
-        
-        keyboard.inline_keyboard.append(
-            [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_chat_select")]
-        )
-        
-        await message.answer(
-            "Выберите клиента для чата:",
-            reply_markup=keyboard
-        )
+        text, keyboard = render_client_picker(clients, "", 0)
+        await message.answer(text, reply_markup=keyboard)
         await state.set_state(AdminStates.CHAT_WITH_CLIENT)
+        await state.update_data(client_search="")
     except Exception as e:
         logger.error(f"Ошибка начала чата с клиентом: {e}")
         await message.answer("⚠️ Ошибка. Попробуйте снова.")
-    finally:
-        if conn:
-            conn.close()
+
+@dp.message(AdminStates.CHAT_WITH_CLIENT)
+async def search_client(message: types.Message, state: FSMContext):
+    query = " ".join(search_words(message.text or ""))
+    if len(query) < CLIENT_SEARCH_MIN_LENGTH:
+        await message.answer(f"🔍 Введите начало имени, username или ID (от {CLIENT_SEARCH_MIN_LENGTH} символов)")
+        return
+    
+    try:
+        clients = await find_clients(message.from_user.id, query)
+        if not clients:
+            await message.answer(f"🔍 По запросу «{query}» никого не найдено. Попробуйте другой запрос.")
+            return
+        
+        text, keyboard = render_client_picker(clients, query, 0)
+        await message.answer(text, reply_markup=keyboard)
+        await state.update_data(client_search=query)
+    except Exception as e:
+        logger.error(f"Ошибка поиска клиента: {e}")
+        await message.answer("⚠️ Ошибка поиска. Попробуйте снова.")
+
+@dp.callback_query(lambda c: c.data.startswith("chat_search:"))
+async def client_picker_page(callback: types.CallbackQuery, state: FSMContext):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("⛔ Доступ запрещён", show_alert=True)
+        return
+    
+    try:
+        page = int(callback.data.split(":")[1])
+        query = (await state.get_data()).get("client_search", "")
+        clients = await find_clients(callback.from_user.id, query)
+        text, keyboard = render_client_picker(clients, query, page)
+        await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.answer()
+    except TelegramBadRequest as e:
+        logger.warning(f"Не удалось обновить список клиентов: {e}")
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Ошибка листания списка клиентов: {e}")
+        await callback.answer("⚠️ Ошибка загрузки страницы", show_alert=True)
 
 @dp.callback_query(lambda c: c.data.startswith('admin_chat_'))
 async def start_client_chat(callback: types.CallbackQuery, state: FSMContext):
     try:
         client_id = int(callback.data.split('_')[2])
+        client_search_cache.pop(callback.from_user.id, None)
         await state.update_data(client_id=client_id)
         
         keyboard = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="❌ Завершить чат")]], resize_keyboard=True)
@@ -930,6 +1426,7 @@ async def cancel_chat_select(callback: types.CallbackQuery, state: FSMContext):
             "❌ Выбор чата отменён",
             reply_markup=None
         )
+        client_search_cache.pop(callback.from_user.id, None)
         await state.clear()
     except Exception as e:
         logger.error(f"Ошибка отмены выбора чата: {e}")
@@ -959,65 +1456,255 @@ async def forward_to_client(message: types.Message, state: FSMContext):
         logger.error(f"Ошибка пересылки сообщения: {e}")
         await message.answer("⚠️ Ошибка отправки сообщения. Попробуйте снова.")
 
-@dp.message(lambda m: m.text == "📋 Подробный отчёт" and is_admin(m.from_user.id))
-async def detailed_clients_report(message: types.Message):
-    conn = None
+# Подробный отчёт постранично: одно сообщение, листается кнопками.
+# Страница — диапазон индекса clients_report_keyset_idx после/до ключа (timestamp, user_id).
+# Ответы выводятся целиком (restore_clients.py восстанавливает базу из этого текста),
+# поэтому на странице до CLIENTS_PAGE_SIZE анкет — сколько влезет в одно сообщение
+CLIENTS_PAGE_SIZE = int(os.getenv("CLIENTS_PAGE_SIZE", "5"))
+MESSAGE_LIMIT = 4096
+EPOCH = datetime(1970, 1, 1)
+
+def encode_page_key(timestamp, user_id):
+    # Анкеты без даты сортируются последними, как '-infinity'
+    key = "-" if timestamp is None else str((timestamp - EPOCH) // timedelta(microseconds=1))
+    return f"{key}:{user_id}"
+
+def decode_page_key(key, user_id):
+    timestamp = "-infinity" if key == "-" else EPOCH + timedelta(microseconds=int(key))
+    return timestamp, int(user_id)
+
+CLIENTS_PAGE_QUERY = '''
+SELECT user_id, username, full_name, timestamp, appreciate, dislike,
+       improve, gender, age_group, visit_freq
+FROM clients
+WHERE is_admin = FALSE
+'''
+
+async def fetch_clients_page(after=None, before=None):
+    if before:
+        # Назад: берём ближайшие более новые анкеты и разворачиваем
+        rows = await db.fetchall(CLIENTS_PAGE_QUERY + '''
+        AND (COALESCE(timestamp, '-infinity'), user_id) > (%s::timestamp, %s)
+        ORDER BY COALESCE(timestamp, '-infinity') ASC, user_id ASC
+        LIMIT %s
+        ''', (*before, CLIENTS_PAGE_SIZE))
+        return rows[::-1]
+    
+    condition, params = "", ()
+    if after:
+        condition = "AND (COALESCE(timestamp, '-infinity'), user_id) < (%s::timestamp, %s)"
+        params = after
+    # Лишняя строка показывает, есть ли следующая страница
+    return await db.fetchall(CLIENTS_PAGE_QUERY + condition + '''
+    ORDER BY COALESCE(timestamp, '-infinity') DESC, user_id DESC
+    LIMIT %s
+    ''', (*params, CLIENTS_PAGE_SIZE + 1))
+
+# Telegram считает длину сообщения в UTF-16: эмодзи занимают две единицы и больше
+def message_length(text):
+    return len(text.encode("utf-16-le")) // 2
+
+def render_client(client, answers=None):
+    appreciate, dislike, improve = answers or client[4:7]
+    return "\n".join([
+        f"👤 {client[2]} (@{client[1]})",
+        f"🆔 ID: {client[0]}",
+        f"📅 Дата: {client[3]}",
+        f"🧑‍🤝‍🧑 Пол: {client[7]}",
+        f"📊 Возраст: {client[8]}",
+        f"🛒 Посещения: {client[9]}",
+        f"👍 Нравится: {appreciate}",
+        f"👎 Не нравится: {dislike}",
+        f"💡 Предложения: {improve}",
+        "="*40
+    ])
+
+# Анкета, которая одна не влезает в сообщение: короткие ответы выводятся целиком,
+# длинные делят остаток поровну и помечаются TRUNCATED_MARK — restore_clients.py
+# такие ответы пропускает
+def render_long_client(client, room):
+    marked = f"\n{TRUNCATED_MARK}"
+    room -= message_length(render_client(client, ("", "", "")))
+    answers = list(client[4:7])
+    order = sorted(range(3), key=lambda i: message_length(str(answers[i])))
+    for left, i in zip((3, 2, 1), order):
+        share = room // left
+        size = message_length(str(answers[i]))
+        if size > share:
+            share -= message_length(marked)
+            answers[i] = answers[i].encode("utf-16-le")[:share * 2].decode("utf-16-le", "ignore") + marked
+            size = message_length(answers[i])
+        room -= size
+    return render_client(client, answers)
+
+# Место под заголовок страницы с самыми длинными номерами
+PAGE_HEADER_ROOM = message_length("📋 Подробный отчёт по клиентам: 9999999999–9999999999\n\n")
+
+# Анкеты страницы: добавляются, пока страница влезает в одно сообщение (хотя бы
+# одна). При листании назад (from_end) остаются ближайшие к текущей странице.
+# Возвращает (тексты анкет, показанные анкеты)
+def fit_clients_page(clients, from_end=False):
+    room = MESSAGE_LIMIT - PAGE_HEADER_ROOM
+    blocks = []
+    for client in (clients[::-1] if from_end else clients):
+        block = render_client(client)
+        size = message_length(block) + (1 if blocks else 0)
+        if size > room:
+            if not blocks:
+                blocks.append(render_long_client(client, room))
+            break
+        blocks.append(block)
+        room -= size
+    
+    if from_end:
+        blocks.reverse()
+        return blocks, clients[-len(blocks):]
+    return blocks, clients[:len(blocks)]
+
+def render_clients_page(blocks, first):
+    header = f"📋 Подробный отчёт по клиентам: {first}–{first + len(blocks) - 1}\n"
+    return header + "\n" + "\n".join(blocks)
+
+# В кнопке — номер первой анкеты страницы, с которой начинается листание
+def clients_page_keyboard(clients, first, has_next):
+    buttons = []
+    if first > 1:
+        newest = clients[0]
+        buttons.append(InlineKeyboardButton(
+            text="⬅️ Новее",
+            callback_data=f"clients_page:prev:{first}:{encode_page_key(newest[3], newest[0])}"
+        ))
+    if has_next:
+        last = clients[-1]
+        buttons.append(InlineKeyboardButton(
+            text="Старее ➡️",
+            callback_data=f"clients_page:next:{first + len(clients)}:{encode_page_key(last[3], last[0])}"
+        ))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+@admin_command("📋 Подробный отчёт")
+async def detailed_clients_report(message: types.Message, state: FSMContext):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        clients = await fetch_clients_page()
+        if not clients:
+            await message.answer("В базе нет клиентов")
+            return
         
-        cursor.execute('''
-        SELECT user_id, username, full_name, timestamp, appreciate, dislike, 
-               improve, gender, age_group, visit_freq
-        FROM clients
-        WHERE is_admin = FALSE
-        ORDER BY timestamp DESC
-        LIMIT 50
-        ''')
+        blocks, shown = fit_clients_page(clients[:CLIENTS_PAGE_SIZE])
+        await message.answer(
+            render_clients_page(blocks, 1),
+            reply_markup=clients_page_keyboard(shown, 1, len(clients) > len(shown))
+        )
+    except Exception as e:
+        logger.error(f"Ошибка формирования отчёта: {e}")
+        await message.answer("⚠️ Произошла непредвиденная ошибка")
+
+@dp.callback_query(lambda c: c.data.startswith("clients_page:"))
+async def clients_report_page(callback: types.CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("⛔ Доступ запрещён", show_alert=True)
+        return
+    
+    try:
+        _, direction, first, key, user_id = callback.data.split(":")
+        first = int(first)
+        cursor = decode_page_key(key, user_id)
         
-        clients = cursor.fetchall()
+        if direction == "next":
+            clients = await fetch_clients_page(after=cursor)
+        else:
+            clients = await fetch_clients_page(before=cursor)
         
         if not clients:
-            await message.answer("В базе нет клиентов")
+            await callback.answer("Больше анкет нет")
             return
-            
-        # Формируем отчет
-        report_parts = ["📋 Подробный отчёт по клиентам (последние 50)\n"]
-        for client in clients:
-            client_info = [
-                f"👤 {client[2]} (@{client[1]})",
-                f"🆔 ID: {client[0]}",
-                f"📅 Дата: {client[3]}",
-                f"🧑‍🤝‍🧑 Пол: {client[7]}",
-                f"📊 Возраст: {client[8]}",
-                f"🛒 Посещения: {client[9]}",
-                f"👍 Нравится: {client[4]}",
-                f"👎 Не нравится: {client[5]}",
-                f"💡 Предложения: {client[6]}",
-                "="*40
-            ]
-            report_parts.extend(client_info)
         
-        # Разбиваем отчет на части, чтобы избежать ограничения длины сообщения
-        current_message = ""
-        for part in report_parts:
-            if len(current_message) + len(part) > 4000:
-                await message.answer(current_message)
-                current_message = part + "\n"
-            else:
-                current_message += part + "\n"
+        if direction == "next":
+            blocks, shown = fit_clients_page(clients[:CLIENTS_PAGE_SIZE])
+            has_next = len(clients) > len(shown)
+        else:
+            # Назад: first — номер первой анкеты текущей страницы
+            blocks, shown = fit_clients_page(clients, from_end=True)
+            first = max(1, first - len(shown))
+            has_next = True
         
-        if current_message:
-            await message.answer(current_message)
-
+        await callback.message.edit_text(
+            render_clients_page(blocks, first),
+            reply_markup=clients_page_keyboard(shown, first, has_next)
+        )
+        await callback.answer()
+    except TelegramBadRequest as e:
+        # Страница не изменилась (двойное нажатие) — не ошибка
+        logger.warning(f"Не удалось обновить страницу отчёта: {e}")
+        await callback.answer()
     except Exception as e:
-        logger.error(f"Ошибка формирования отчёта: {e}")
-        await message.answer("⚠️ Произошла непредвиденная ошибка")
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Ошибка листания отчёта: {e}")
+        await callback.answer("⚠️ Ошибка загрузки страницы", show_alert=True)
+
+# Полная выгрузка базы одним документом. Файл собирается в потоке БД
+# серверным курсором, поэтому память не зависит от числа анкет
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # лимит Bot API на отправку документа
+export_lock = asyncio.Lock()
+
+@admin_command("📤 Выгрузка базы")
+async def export_database_start(message: types.Message, state: FSMContext):
+    buttons = [InlineKeyboardButton(text="📄 CSV (.csv.gz)", callback_data="export:csv")]
+    if XLSX_AVAILABLE:
+        buttons.append(InlineKeyboardButton(text="📊 Excel (.xlsx)", callback_data="export:xlsx"))
+    await message.answer(
+        "Выберите формат выгрузки:",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[buttons])
+    )
 
-@dp.message(lambda m: m.text == "🔙 Назад" and is_admin(m.from_user.id))
+@dp.callback_query(lambda c: c.data.startswith("export:"))
+async def export_database(callback: types.CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("⛔ Доступ запрещён", show_alert=True)
+        return
+    
+    fmt = callback.data.split(":", 1)[1]
+    if fmt not in EXPORT_FORMATS or (fmt == "xlsx" and not XLSX_AVAILABLE):
+        await callback.answer("⚠️ Формат недоступен", show_alert=True)
+        return
+    # Выгрузка держит соединение из пула, поэтому одновременно — только одна
+    if export_lock.locked():
+        await callback.answer("⏳ Выгрузка уже готовится, подождите", show_alert=True)
+        return
+    
+    await callback.answer()
+    async with export_lock:
+        path = None
+        try:
+            await callback.message.edit_text("⏳ Готовлю выгрузку...", reply_markup=None)
+            await client_writer.flush()
+            started = time.monotonic()
+            path, count = await db.run(export_clients, fmt)
+            size = os.path.getsize(path)
+            if size > EXPORT_MAX_BYTES:
+                await callback.message.edit_text(
+                    f"⚠️ Файл выгрузки слишком большой для Telegram: {size / 1024 / 1024:.1f} МБ"
+                )
+                return
+            
+            filename = f"clients_{datetime.now():%Y-%m-%d_%H%M}{EXPORT_FORMATS[fmt]}"
+            await bot.send_document(
+                callback.message.chat.id,
+                FSInputFile(path, filename=filename),
+                caption=f"📤 Выгрузка базы: {count} анкет"
+            )
+            await callback.message.edit_text(
+                f"✅ Выгрузка готова: {count} анкет, {size / 1024:.0f} КБ "
+                f"за {time.monotonic() - started:.1f} с"
+            )
+            logger.info(f"Админ {callback.from_user.id} выгрузил базу ({fmt}, {count} анкет)")
+        except Exception as e:
+            logger.error(f"Ошибка выгрузки базы: {e}")
+            await callback.message.edit_text("⚠️ Ошибка выгрузки базы")
+        finally:
+            if path:
+                os.remove(path)
+
+@admin_command("🔙 Назад")
 async def back_to_admin_menu(message: types.Message, state: FSMContext):
     try:
         await state.clear()
@@ -1032,29 +1719,249 @@ async def back_to_admin_menu(message: types.Message, state: FSMContext):
 
 @dp.message()
 async def forward_client_message(message: types.Message):
-    conn = None
     try:
         if message.chat.type != 'private' or message.text.startswith('/'):
             return
             
         user_id = message.from_user.id
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT 1 FROM clients WHERE user_id = %s', (user_id,))
-        is_client = cursor.fetchone() is not None
-        
-        if is_client and not is_admin(user_id):
+        if is_client(user_id) and not is_admin(user_id):
             user_info = f"👤 {message.from_user.full_name} (@{message.from_user.username}, ID: {user_id})"
-            await notify_admins(
+            notify_admins(
                 f"✉️ Сообщение от клиента:\n{user_info}\n\n{message.text}",
                 exclude_id=user_id
             )
     except Exception as e:
         logger.error(f"Ошибка пересылки сообщения: {e}")
+
+# ========== МЕТРИКИ ==========
+
+# /metrics в формате Prometheus. METRICS_TOKEN — требовать заголовок
+# Authorization: Bearer <token>. Воркеры (WORKER_ID) отдают свои метрики
+# на METRICS_PORT + номер шарда, если порт задан
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+METRICS_PORT = os.getenv("METRICS_PORT")
+BOT_COMMANDS = ("/start", "/admin", "/digest", "/profile")
+CALLBACK_NAME = re.compile(r"[^:\d]*")
+
+# Метка обработчика: кнопка админа, состояние FSM, команда или вид callback.
+# Набор значений ограничен кодом бота — свободный текст клиентов меток не плодит
+def update_handler_label(update, raw_state):
+    message = update.message
+    if message:
+        text = message.text or ""
+        if text in ADMIN_COMMANDS:
+            return text
+        if raw_state:
+            return raw_state
+        if text.startswith("/"):
+            command = text.split(maxsplit=1)[0].split("@")[0]
+            return command if command in BOT_COMMANDS else "command"
+        return "message"
+    if update.callback_query:
+        return "callback:" + CALLBACK_NAME.match(update.callback_query.data or "").group(0).rstrip("_")
+    return update.event_type
+
+# Обновления дольше SLOW_UPDATE_THRESHOLD секунд пишутся в журнал с временем в БД
+# (0 — не писать)
+profiler = UpdateProfiler(slow_threshold=float(os.getenv("SLOW_UPDATE_THRESHOLD", "1")))
+
+# Снаружи всех обработчиков, но внутри middleware FSM: состояние уже известно
+async def track_update(handler, event, data):
+    db_time = [0.0]
+    token = UPDATE_DB_TIME.set(db_time)
+    started = time.perf_counter()
+    try:
+        if profiler.capturing:
+            return await profiler.run(handler, event, data)
+        return await handler(event, data)
+    except Exception as e:
+        ERRORS.inc("handler", type(e).__name__)
+        raise
     finally:
-        if conn:
-            conn.close()
+        elapsed = time.perf_counter() - started
+        UPDATE_DB_TIME.reset(token)
+        label = update_handler_label(event, data.get("raw_state"))
+        UPDATES.observe(elapsed, label)
+        if profiler.check_slow(event.update_id, label, elapsed, db_time[0]):
+            SLOW_UPDATES.inc(label)
+
+dp.update.outer_middleware(track_update)
+
+# Сессии в кэше FSM этого процесса по состояниям (сколько человек на каком шаге анкеты)
+def fsm_sessions():
+    if isinstance(storage, CachedDatabaseStorage):
+        states = storage.states()
+    else:
+        states = (record.state for record in storage.storage.values())
+    return [((state,), count) for state, count in Counter(state for state in states if state).items()]
+
+def fsm_cache_requests():
+    if not isinstance(storage, CachedDatabaseStorage):
+        return []
+    return [(("hit",), storage.hits), (("miss",), storage.misses)]
+
+def broadcast_recipients():
+    for job_id, stats in broadcast_queue.active.items():
+        yield (str(job_id), "total"), stats.total
+        yield (str(job_id), "sent"), stats.sent
+        yield (str(job_id), "failed"), stats.failed
+        yield (str(job_id), "retried"), stats.retried
+
+REGISTRY.collected("bot_fsm_sessions", "Активные сессии FSM в кэше процесса по состояниям",
+                   fsm_sessions, labels=("state",))
+REGISTRY.collected("bot_fsm_cache_requests_total", "Чтения состояния FSM: из кэша и из БД",
+                   fsm_cache_requests, labels=("result",), kind="counter")
+REGISTRY.collected("bot_broadcast_recipients", "Получатели идущих рассылок по статусу",
+                   broadcast_recipients, labels=("job", "status"))
+REGISTRY.collected("bot_broadcast_rate", "Скорость идущих рассылок, сообщений в секунду",
+                   lambda: [((str(job_id),), stats.rate) for job_id, stats in broadcast_queue.active.items()],
+                   labels=("job",))
+REGISTRY.collected("bot_client_writer_pending", "Анкеты в буфере, ещё не записанные в БД", lambda: len(client_writer))
+REGISTRY.collected("bot_clients_known", "Клиенты в индексе в памяти", lambda: len(client_index))
+REGISTRY.collected("bot_admins", "Админы в реестре процесса", lambda: len(admin_registry))
+REGISTRY.collected("bot_report_cache_requests_total",
+                   "Запросы отчётов админ-панели: из кэша, построены, дождались чужого построения",
+                   lambda: [(("hit",), report_cache.hits), (("miss",), report_cache.misses),
+                            (("coalesced",), report_cache.coalesced)],
+                   labels=("result",), kind="counter")
+REGISTRY.collected("bot_outbound_queue_depth", "Сообщения, ждущие отправки, по полосе приоритета",
+                   lambda: [((lane,), outbound.depth(lane)) for lane in LANES], labels=("lane",))
+REGISTRY.collected("bot_background_tasks", "Фоновые задачи обработчиков (уведомления админам)", lambda: len(pending_tasks))
+
+async def metrics_endpoint(request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=401)
+    return web.Response(body=REGISTRY.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+# ========== ВЕБХУК И HEALTHCHECK ==========
+
+# Вебхук включается, если задан публичный адрес сервиса (WEBHOOK_URL).
+# USE_POLLING=1 — запасной вариант: long polling, как раньше
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Telegram присылает секрет в заголовке, чужие запросы на вебхук отбрасываем
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(API_TOKEN.encode()).hexdigest()
+USE_POLLING = os.getenv("USE_POLLING", "").lower() in ("1", "true", "yes") or not WEBHOOK_URL
+PORT = os.getenv("PORT")
+
+# Несколько процессов: WORKERS — число воркеров (шардов), WORKER_ID — номер шарда
+# этого процесса. Процесс без WORKER_ID принимает обновления (вебхук или polling),
+# раскладывает их по шардам и ведёт рассылки
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_ID = int(os.getenv("WORKER_ID")) if os.getenv("WORKER_ID") else None
+update_queue = UpdateQueue(db, WORKERS)
+
+async def health(request):
+    # 200 OK — достаточно для UptimeRobot
+    return web.Response(text="ok")
+
+async def process_update(update):
+    try:
+        await dp.feed_raw_update(bot, update)
+    except Exception as e:
+        logger.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+
+async def handle_webhook(request):
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    try:
+        update = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    
+    if WORKERS > 1:
+        # Отвечаем только после записи в очередь: при ошибке Telegram повторит доставку
+        try:
+            await update_queue.put([update])
+        except Exception as e:
+            logger.error(f"Ошибка записи обновления в очередь: {e}")
+            return web.Response(status=500)
+        return web.Response()
+    
+    # Отвечаем Telegram сразу, обновление обрабатывается в фоне
+    # (апдейты одного пользователя — строго по порядку)
+    await update_queue.submit(update, process_update)
+    return web.Response()
+
+async def start_web_server(port, webhook=False):
+    app = web.Application()
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics_endpoint)
+    if webhook:
+        app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    logger.info(f"HTTP-сервер запущен на порту {port}")
+    return runner
+
+# Работаем до SIGTERM/SIGINT; dispatcher получает те же startup/shutdown, что и при polling
+async def serve_until_stopped(coro=None):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    await dp.emit_startup(dispatcher=dp, bot=bot, bots=[bot])
+    waiters = [asyncio.create_task(stop.wait())]
+    if coro:
+        waiters.append(asyncio.create_task(coro))
+    try:
+        done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        for finished in done:
+            finished.result()
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+        await dp.emit_shutdown(dispatcher=dp, bot=bot, bots=[bot])
+
+async def run_webhook():
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logger.info("Вебхук установлен, ждём обновления")
+    await serve_until_stopped()
+
+# Приёмник без вебхука: забирает обновления через getUpdates и кладёт в очередь
+async def receive_updates():
+    offset = None
+    allowed_updates = dp.resolve_used_update_types()
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            if updates:
+                await update_queue.put([
+                    json.loads(update.json(exclude_none=True, by_alias=True)) for update in updates
+                ])
+                offset = updates[-1].update_id + 1
+        except asyncio.CancelledError:
+            raise
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            logger.error(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(5)
+
+async def prune_update_queue_periodically():
+    while True:
+        try:
+            await update_queue.prune()
+        except Exception as e:
+            logger.error(f"Ошибка очистки очереди обновлений: {e}")
+        await asyncio.sleep(3600)
+
+async def run_worker(shard):
+    # После переподключения просто проверяем очередь: обновления лежат в БД
+    await db.listen(
+        [update_queue.channel(shard)],
+        lambda channel, payload: update_queue.wake(),
+        on_reconnect=update_queue.wake
+    )
+    logger.info(f"Воркер {shard} из {WORKERS} ждёт обновления")
+    await serve_until_stopped(update_queue.consume(shard, process_update))
 
 # ========== ЗАПУСК БОТА ==========
 
@@ -1063,11 +1970,78 @@ async def main():
         logger.critical("Не удалось подключиться к базе данных. Завершение работы.")
         return
     
+    background_tasks = []
+    runner = None
     try:
+        await admin_registry.refresh()
+        await client_index.refresh()
+        logger.info(f"Индекс клиентов загружен: {len(client_index)} ({client_index.nbytes / 1024:.0f} КБ)")
+        background_tasks.append(asyncio.create_task(refresh_admins_periodically()))
+        background_tasks.append(asyncio.create_task(refresh_client_index_periodically()))
+        background_tasks.append(asyncio.create_task(client_writer.run_forever()))
+        # Уведомления за время обрыва LISTEN потеряны: после переподключения
+        # перечитываем индекс клиентов и админов целиком
+        await db.listen(
+            [CLIENTS_CHANNEL],
+            lambda channel, payload: spawn(refresh_client_index()),
+            on_reconnect=lambda: spawn(refresh_client_index())
+        )
+        if WORKERS > 1:
+            await db.listen(
+                [ADMINS_CHANNEL],
+                lambda channel, payload: spawn(admin_registry.refresh()),
+                on_reconnect=lambda: spawn(admin_registry.refresh())
+            )
+        
+        if WORKER_ID is not None:
+            if METRICS_PORT:
+                runner = await start_web_server(int(METRICS_PORT) + WORKER_ID)
+            await run_worker(WORKER_ID)
+            return
+        
+        # Продолжаем рассылки, прерванные перезапуском
+        background_tasks.append(asyncio.create_task(broadcast_queue.run_forever()))
+        if WORKERS > 1:
+            # Рассылки создают воркеры, а отправляет только этот процесс
+            await db.listen(
+                [BROADCAST_CHANNEL],
+                lambda channel, payload: broadcast_queue.wake(),
+                on_reconnect=broadcast_queue.wake
+            )
+            background_tasks.append(asyncio.create_task(prune_update_queue_periodically()))
+        
+        # /health, /metrics (и вебхук) в том же процессе, что и бот
+        if PORT or not USE_POLLING:
+            runner = await start_web_server(int(PORT or "10000"), webhook=not USE_POLLING)
+        
         logger.info("Бот запускается...")
-        await dp.start_polling(bot)
+        if USE_POLLING:
+            # Иначе getUpdates вернёт конфликт с ранее установленным вебхуком
+            await bot.delete_webhook()
+            if WORKERS > 1:
+                await serve_until_stopped(receive_updates())
+            else:
+                await dp.start_polling(bot, close_bot_session=False)
+        else:
+            await run_webhook()
     except Exception as e:
         logger.critical(f"Ошибка запуска бота: {e}")
+    finally:
+        if runner:
+            await runner.cleanup()
+        await update_queue.drain()
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        # Даём дослать уведомления, запущенные из обработчиков
+        questionnaire_digest.flush()
+        if pending_tasks:
+            await asyncio.wait(pending_tasks, timeout=10)
+        await client_writer.close()
+        await storage.close()
+        outbound.close()
+        await bot.session.close()
+        db.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
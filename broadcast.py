@@ -0,0 +1,331 @@
+import asyncio
+import logging
+import time
+
+from psycopg2.extras import execute_values
+from aiogram.exceptions import (
+    TelegramRetryAfter,
+    TelegramForbiddenError,
+    TelegramBadRequest,
+    TelegramNotFound,
+    TelegramUnauthorizedError
+)
+
+from outbound import BROADCAST, OUTBOUND_LANE, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых повторять отправку этому получателю бессмысленно
+PERMANENT_ERRORS = (
+    TelegramForbiddenError,
+    TelegramBadRequest,
+    TelegramNotFound,
+    TelegramUnauthorizedError
+)
+
+# Канал PostgreSQL: новая рассылка в очереди (её мог создать другой процесс)
+BROADCAST_CHANNEL = "broadcast_jobs"
+
+class BroadcastStats:
+    def __init__(self, total, sent=0, failed=0):
+        self.total = total
+        self.sent = sent
+        self.failed = failed
+        self.retried = 0
+        self.started_at = time.monotonic()
+        # При возобновлении рассылки скорость считаем только по текущему запуску
+        self._resumed_from = sent + failed
+
+    @property
+    def done(self):
+        return self.sent + self.failed
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    @property
+    def rate(self):
+        return (self.done - self._resumed_from) / self.elapsed if self.elapsed > 0 else 0.0
+
+    # Оценка оставшегося времени в секундах по средней скорости
+    @property
+    def eta(self):
+        if not self.rate:
+            return None
+        return (self.total - self.done) / self.rate
+
+# Рассылка с ограничением скорости, параллельными воркерами и повтором после 429
+class Broadcaster:
+    def __init__(self, bot, rate=25, concurrency=20, max_attempts=5, progress_interval=3):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.progress_interval = progress_interval
+
+    # on_result(chat_id, error) вызывается по каждому получателю (error=None при успехе)
+    async def run(self, chat_ids, text, on_progress=None, on_result=None, stats=None):
+        stats = stats or BroadcastStats(len(chat_ids))
+        queue = asyncio.Queue()
+        for chat_id in chat_ids:
+            queue.put_nowait((chat_id, 1))
+
+        workers = [
+            asyncio.create_task(self._worker(queue, text, stats, on_result))
+            for _ in range(min(self.concurrency, len(chat_ids)))
+        ]
+        progress = None
+        if on_progress:
+            progress = asyncio.create_task(self._report_progress(stats, on_progress))
+
+        try:
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            if progress:
+                progress.cancel()
+        return stats
+
+    async def _worker(self, queue, text, stats, on_result):
+        # Воркер — отдельная задача, полоса не выходит за её пределы
+        OUTBOUND_LANE.set(BROADCAST)
+        while True:
+            chat_id, attempt = await queue.get()
+            try:
+                await self.bucket.acquire()
+                await self.bot.send_message(chat_id, text)
+                stats.sent += 1
+                if on_result:
+                    on_result(chat_id, None)
+            except TelegramRetryAfter as e:
+                logger.warning(f"Flood control при рассылке, пауза {e.retry_after} сек.")
+                self.bucket.pause(e.retry_after)
+                self._retry(queue, stats, chat_id, attempt, e, on_result)
+            except PERMANENT_ERRORS as e:
+                self._fail(stats, chat_id, e, on_result)
+            except Exception as e:
+                self._retry(queue, stats, chat_id, attempt, e, on_result)
+            finally:
+                queue.task_done()
+
+    def _retry(self, queue, stats, chat_id, attempt, error, on_result):
+        if attempt < self.max_attempts:
+            stats.retried += 1
+            queue.put_nowait((chat_id, attempt + 1))
+        else:
+            self._fail(stats, chat_id, error, on_result)
+
+    def _fail(self, stats, chat_id, error, on_result):
+        logger.error(f"Ошибка отправки сообщения клиенту {chat_id}: {error}")
+        stats.failed += 1
+        if on_result:
+            on_result(chat_id, error)
+
+    async def _report_progress(self, stats, on_progress):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            try:
+                await on_progress(stats)
+            except Exception as e:
+                logger.error(f"Ошибка обновления прогресса рассылки: {e}")
+
+# Рассылки как задания в БД: получатели и их статусы хранятся в broadcast_recipients,
+# поэтому после перезапуска процесса рассылка продолжается с места остановки
+class BroadcastQueue:
+    def __init__(self, db, broadcaster, batch_size=100, checkpoint_interval=1,
+                 on_progress=None, on_finish=None):
+        self.db = db
+        self.broadcaster = broadcaster
+        self.batch_size = batch_size
+        self.checkpoint_interval = checkpoint_interval
+        self.on_progress = on_progress
+        self.on_finish = on_finish
+        # Статистика текущей рассылки: job_id -> BroadcastStats
+        self.active = {}
+        # Результаты отправок, которые не удалось записать в БД: job_id -> [(chat_id, error)].
+        # Следующая попытка сначала сохраняет их, иначе эти получатели остаются pending
+        # и получат сообщение повторно
+        self._unsaved = {}
+        self._wakeup = asyncio.Event()
+
+    # chat_id и status_message_id — сообщение, в котором показывается прогресс
+    # (его продолжаем редактировать и после перезапуска)
+    async def create(self, text, created_by, created_by_username, chat_id, status_message_id):
+        def create_job(cursor):
+            cursor.execute('''
+            INSERT INTO broadcast_jobs (text, created_by, created_by_username, chat_id, status_message_id)
+            VALUES (%s, %s, %s, %s, %s)
+            RETURNING id
+            ''', (text, created_by, created_by_username, chat_id, status_message_id))
+            job_id = cursor.fetchone()[0]
+            
+            cursor.execute('''
+            INSERT INTO broadcast_recipients (job_id, user_id)
+            SELECT %s, user_id FROM clients WHERE is_admin = FALSE
+            ''', (job_id,))
+            total = cursor.rowcount
+            
+            cursor.execute('UPDATE broadcast_jobs SET total = %s WHERE id = %s', (total, job_id))
+            cursor.execute(f'NOTIFY {BROADCAST_CHANNEL}')
+            return job_id, total
+        return await self.db.run(create_job)
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def running_jobs(self):
+        return await self.db.fetchall('''
+        SELECT j.id, j.total, j.created_by_username, j.created_at,
+               COUNT(*) FILTER (WHERE r.status = 'sent'),
+               COUNT(*) FILTER (WHERE r.status = 'failed')
+        FROM broadcast_jobs j
+        LEFT JOIN broadcast_recipients r ON r.job_id = j.id
+        WHERE j.status = 'running'
+        GROUP BY j.id
+        ORDER BY j.id
+        ''')
+
+    async def run_forever(self):
+        while True:
+            try:
+                job = await self.db.fetchone('''
+                SELECT id, text, total, chat_id, status_message_id, created_by_username
+                FROM broadcast_jobs
+                WHERE status = 'running'
+                ORDER BY id
+                LIMIT 1
+                ''')
+                if job:
+                    await self.process(job)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка обработки рассылки: {e}")
+                await asyncio.sleep(5)
+                continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=60)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process(self, job):
+        job_id, text, total = job[0], job[1], job[2]
+        results = self._unsaved.setdefault(job_id, [])
+        await self._checkpoint(job_id, results)
+        counts = dict(await self.db.fetchall(
+            'SELECT status, COUNT(*) FROM broadcast_recipients WHERE job_id = %s GROUP BY status',
+            (job_id,)
+        ))
+        stats = BroadcastStats(total, sent=counts.get('sent', 0), failed=counts.get('failed', 0))
+        if stats.done:
+            logger.info(f"Возобновляем рассылку #{job_id} с {stats.done} из {total}")
+        self.active[job_id] = stats
+
+        progress = None
+        if self.on_progress:
+            progress = asyncio.create_task(self._report_progress(job, stats))
+        try:
+            while True:
+                batch = await self.db.fetchall('''
+                SELECT user_id FROM broadcast_recipients
+                WHERE job_id = %s AND status = 'pending'
+                ORDER BY user_id
+                LIMIT %s
+                ''', (job_id, self.batch_size))
+                if not batch:
+                    break
+
+                checkpoint = asyncio.create_task(self._checkpoint_periodically(job_id, results))
+                try:
+                    await self.broadcaster.run(
+                        [row[0] for row in batch], text,
+                        on_result=lambda chat_id, error: results.append((chat_id, error)),
+                        stats=stats
+                    )
+                finally:
+                    checkpoint.cancel()
+                    await asyncio.gather(checkpoint, return_exceptions=True)
+                    # Ошибка записи не подменяет ошибку отправки
+                    saved = await self._final_checkpoint(job_id, results)
+                # Следующая пачка выбирается по pending: без сохранения в неё попали бы
+                # уже получившие сообщение
+                if not saved:
+                    raise RuntimeError(f"прогресс рассылки #{job_id} не сохранён ({len(results)} отправок)")
+
+            await self.db.execute(
+                "UPDATE broadcast_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = %s",
+                (job_id,)
+            )
+        finally:
+            if progress:
+                progress.cancel()
+            self.active.pop(job_id, None)
+            if not results:
+                self._unsaved.pop(job_id, None)
+
+        if self.on_finish:
+            try:
+                await self.on_finish(job, stats)
+            except Exception as e:
+                logger.error(f"Ошибка завершения рассылки #{job_id}: {e}")
+
+    # Сохраняем статусы отправленных сообщений пачками, чтобы после падения
+    # повторно получили сообщение не больше нескольких человек
+    async def _checkpoint(self, job_id, results):
+        if not results:
+            return
+        chunk = results[:]
+        del results[:len(chunk)]
+
+        def save(cursor):
+            execute_values(cursor, '''
+            UPDATE broadcast_recipients AS r
+            SET status = v.status, error = v.error, updated_at = CURRENT_TIMESTAMP
+            FROM (VALUES %s) AS v(job_id, user_id, status, error)
+            WHERE r.job_id = v.job_id AND r.user_id = v.user_id
+            ''', [
+                (job_id, chat_id, 'sent' if error is None else 'failed',
+                 None if error is None else str(error)[:500])
+                for chat_id, error in chunk
+            ])
+        try:
+            await self.db.run(save)
+        except BaseException:
+            # Не потеряем результаты: вернём их в очередь на следующую запись (и при
+            # отмене — запись могла не дойти до БД, повторный UPDATE безвреден)
+            results[:0] = chunk
+            raise
+
+    # Запись в конце пачки: несколько попыток, ошибки только в журнал. False — не
+    # сохранено, результаты остаются в results до следующей попытки
+    async def _final_checkpoint(self, job_id, results, attempts=3):
+        for attempt in range(1, attempts + 1):
+            try:
+                await self._checkpoint(job_id, results)
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка сохранения прогресса рассылки #{job_id} (попытка {attempt}): {e}")
+                if attempt < attempts:
+                    await asyncio.sleep(attempt)
+        return False
+
+    async def _checkpoint_periodically(self, job_id, results):
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                await self._checkpoint(job_id, results)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения прогресса рассылки #{job_id}: {e}")
+
+    async def _report_progress(self, job, stats):
+        while True:
+            await asyncio.sleep(self.broadcaster.progress_interval)
+            try:
+                await self.on_progress(job, stats)
+            except Exception as e:
+                logger.error(f"Ошибка обновления прогресса рассылки: {e}")
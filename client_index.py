@@ -0,0 +1,64 @@
+import asyncio
+import bisect
+from array import array
+
+# user_id всех клиентов в памяти: отсортированный массив int64 — 8 байт на клиента
+# (set тратит около 60). Проверка — бинарный поиск, новый клиент — вставка со сдвигом
+# хвоста массива (анкеты приходят редко, при миллионе клиентов это доли миллисекунды)
+class ClientIndex:
+    def __init__(self, db, batch_size=10000):
+        self.db = db
+        self.batch_size = batch_size
+        self._ids = array('q')
+        self._generation = 0
+        # Клиенты, добавленные во время загрузки из БД: в снимок они могли не попасть
+        self._added = None
+        self._lock = asyncio.Lock()
+
+    def __contains__(self, user_id):
+        ids = self._ids
+        i = bisect.bisect_left(ids, user_id)
+        return i < len(ids) and ids[i] == user_id
+
+    def __len__(self):
+        return len(self._ids)
+
+    @property
+    def nbytes(self):
+        return len(self._ids) * self._ids.itemsize
+
+    def add(self, user_id):
+        ids = self._ids
+        i = bisect.bisect_left(ids, user_id)
+        if i == len(ids) or ids[i] != user_id:
+            ids.insert(i, user_id)
+        if self._added is not None:
+            self._added.append(user_id)
+
+    def clear(self):
+        self._ids = array('q')
+        self._generation += 1
+
+    # Серверный курсор: в памяти не бывает больше batch_size строк сразу
+    def _load(self, cursor):
+        ids = array('q')
+        with cursor.connection.cursor(name="client_index") as rows:
+            rows.itersize = self.batch_size
+            rows.execute('SELECT user_id FROM clients ORDER BY user_id')
+            ids.extend(row[0] for row in rows)
+        return ids
+
+    async def refresh(self):
+        async with self._lock:
+            generation = self._generation
+            self._added = []
+            try:
+                ids = await self.db.run(self._load)
+            finally:
+                added, self._added = self._added, None
+            # Пока шла загрузка, базу очистили — снимок уже устарел
+            if generation != self._generation:
+                return
+            self._ids = ids
+            for user_id in added:
+                self.add(user_id)
@@ -0,0 +1,288 @@
+import os
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import psycopg2
+from psycopg2 import pool
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from metrics import DB_QUERIES, ERRORS
+from profiling import add_db_time
+
+logger = logging.getLogger(__name__)
+
+# Параметры подключения к PostgreSQL из DATABASE_URL
+def connect_params(db_url=None, statement_timeout=None):
+    db_url = db_url or os.getenv('DATABASE_URL')
+    if not db_url:
+        raise ValueError("DATABASE_URL environment variable is not set")
+
+    if db_url.startswith('postgresql://'):
+        result = urlparse(db_url)
+        params = dict(
+            dbname=result.path[1:],
+            user=result.username,
+            password=result.password,
+            host=result.hostname,
+            port=result.port,
+            connect_timeout=5
+        )
+    else:
+        params = dict(dsn=db_url, sslmode='require')
+
+    # Ограничение времени выполнения запроса на уровне сессии
+    if statement_timeout:
+        params['options'] = f"-c statement_timeout={int(statement_timeout)}"
+    return params
+
+# Пул соединений. Запросы выполняются в потоках, чтобы не блокировать event loop
+class Database:
+    def __init__(self, minconn=1, maxconn=10, statement_timeout=5000,
+                 health_check_interval=30, checkout_timeout=30):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.statement_timeout = statement_timeout
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+        self._pool = None
+        self._last_used = {}
+        self._lock = threading.Lock()
+        # ThreadedConnectionPool не ждёт освобождения соединения, а бросает PoolError,
+        # поэтому число одновременно выданных соединений ограничиваем сами
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._semaphore = asyncio.Semaphore(maxconn)
+        self._listeners = []
+
+    @property
+    def is_open(self):
+        return self._pool is not None
+
+    def open(self):
+        with self._lock:
+            if self._pool is not None:
+                return
+            try:
+                self._pool = pool.ThreadedConnectionPool(
+                    self.minconn,
+                    self.maxconn,
+                    **connect_params(statement_timeout=self.statement_timeout)
+                )
+            except psycopg2.OperationalError as e:
+                logger.error(f"Ошибка подключения к PostgreSQL: {e}")
+                raise
+            logger.info(f"Пул соединений создан ({self.minconn}-{self.maxconn})")
+
+    def close(self):
+        for listener in self._listeners:
+            listener.close()
+        self._listeners.clear()
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+                self._last_used.clear()
+                logger.info("Пул соединений закрыт")
+
+    # Проверка соединения, которое долго простаивало в пуле
+    def _is_alive(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logger.warning(f"Соединение с БД недоступно, переподключаемся: {e}")
+            return False
+
+    def _checkout(self):
+        if self._pool is None:
+            raise RuntimeError("Пул соединений не инициализирован")
+
+        # Битые соединения выбрасываем, пока не получим рабочее
+        for _ in range(self.maxconn + 1):
+            conn = self._pool.getconn()
+            if self._is_alive(conn):
+                return conn
+            self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError("Не удалось получить рабочее соединение из пула")
+
+    @contextmanager
+    def connection(self):
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise pool.PoolError("Истекло время ожидания свободного соединения")
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    pass
+            raise
+        finally:
+            if conn.closed:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn, close=bool(conn.closed))
+            self._slots.release()
+
+    def _run_sync(self, func, *args):
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                return func(cursor, *args)
+
+    # Выполнить func(cursor, *args) в одной транзакции вне event loop.
+    # Время (с ожиданием соединения) попадает в метрики под именем функции
+    async def run(self, func, *args):
+        return await self._timed(func.__name__, func, *args)
+
+    async def _timed(self, operation, func, *args):
+        started = time.perf_counter()
+        try:
+            async with self._semaphore:
+                return await asyncio.to_thread(self._run_sync, func, *args)
+        except Exception as e:
+            ERRORS.inc("db", type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_QUERIES.observe(elapsed, operation)
+            add_db_time(elapsed)
+
+    # operation — имя запроса в метриках
+    async def fetchone(self, query, params=None, operation="fetchone"):
+        def fetch(cursor):
+            cursor.execute(query, params)
+            return cursor.fetchone()
+        return await self._timed(operation, fetch)
+
+    async def fetchall(self, query, params=None, operation="fetchall"):
+        def fetch(cursor):
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        return await self._timed(operation, fetch)
+
+    async def execute(self, query, params=None, operation="execute"):
+        def execute(cursor):
+            cursor.execute(query, params)
+            return cursor.rowcount
+        return await self._timed(operation, execute)
+
+    # LISTEN на отдельном соединении вне пула. callback(channel, payload) вызывается
+    # в event loop. После обрыва соединение восстанавливается само, а on_reconnect()
+    # сообщает подписчику, что уведомления за время разрыва потеряны
+    async def listen(self, channels, callback, on_reconnect=None):
+        listener = Listener(channels, callback, on_reconnect)
+        await listener.start()
+        self._listeners.append(listener)
+        return listener
+
+# Подписка LISTEN с переподключением. Keepalive TCP нужен, чтобы молча пропавшее
+# соединение (обрыв сети без FIN) тоже стало ошибкой чтения, а не тишиной
+class Listener:
+    def __init__(self, channels, callback, on_reconnect=None, max_backoff=60):
+        self.channels = list(channels)
+        self.callback = callback
+        self.on_reconnect = on_reconnect
+        self.max_backoff = max_backoff
+        self._loop = None
+        self._conn = None
+        self._fd = None
+        self._reconnecting = None
+        self._closed = False
+
+    @property
+    def name(self):
+        return ", ".join(self.channels)
+
+    # Выполняется в потоке: connect блокирует до connect_timeout
+    def _connect(self):
+        conn = psycopg2.connect(
+            **connect_params(),
+            keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3
+        )
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cursor:
+            for channel in self.channels:
+                cursor.execute(f'LISTEN "{channel}"')
+        return conn
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._attach(await asyncio.to_thread(self._connect))
+
+    def _attach(self, conn):
+        self._conn = conn
+        self._fd = conn.fileno()
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    def _detach(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        self._loop.remove_reader(self._fd)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _on_readable(self):
+        try:
+            self._conn.poll()
+        except psycopg2.Error as e:
+            logger.error(f"Соединение LISTEN {self.name} потеряно: {e}")
+            self._detach()
+            if not self._closed:
+                self._reconnecting = self._loop.create_task(self._reconnect())
+            return
+        while self._conn.notifies:
+            notify = self._conn.notifies.pop(0)
+            try:
+                self.callback(notify.channel, notify.payload)
+            except Exception as e:
+                logger.error(f"Ошибка обработки уведомления {notify.channel}: {e}")
+
+    async def _reconnect(self):
+        delay = 1
+        while not self._closed:
+            await asyncio.sleep(delay)
+            try:
+                conn = await asyncio.to_thread(self._connect)
+            except psycopg2.Error as e:
+                logger.error(f"Не удалось восстановить LISTEN {self.name}: {e}")
+                delay = min(delay * 2, self.max_backoff)
+                continue
+            if self._closed:
+                conn.close()
+                return
+            self._attach(conn)
+            logger.info(f"Соединение LISTEN {self.name} восстановлено")
+            if self.on_reconnect:
+                try:
+                    self.on_reconnect()
+                except Exception as e:
+                    logger.error(f"Ошибка обновления после переподключения LISTEN {self.name}: {e}")
+            return
+
+    def close(self):
+        self._closed = True
+        if self._reconnecting:
+            self._reconnecting.cancel()
+        self._detach()
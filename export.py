@@ -0,0 +1,68 @@
+import csv
+import gzip
+import os
+import tempfile
+
+try:
+    from openpyxl import Workbook
+except ImportError:  # XLSX — необязательная зависимость
+    Workbook = None
+
+# Колонки выгрузки совпадают с колонками таблицы clients
+EXPORT_COLUMNS = (
+    "user_id", "username", "full_name", "timestamp", "gender", "age_group",
+    "visit_freq", "appreciate", "dislike", "improve", "is_admin",
+)
+EXPORT_QUERY = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM clients ORDER BY user_id"
+EXPORT_FORMATS = {
+    "csv": ".csv.gz",
+    "xlsx": ".xlsx",
+}
+XLSX_AVAILABLE = Workbook is not None
+
+def write_csv(rows, path):
+    count = 0
+    # utf-8-sig: Excel открывает кириллицу без выбора кодировки
+    with gzip.open(path, "wt", encoding="utf-8-sig", newline="", compresslevel=6) as file:
+        writer = csv.writer(file)
+        writer.writerow(EXPORT_COLUMNS)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+def write_xlsx(rows, path):
+    # write_only: строки сразу уходят во временный XML, в памяти не копятся
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Клиенты")
+    sheet.append(EXPORT_COLUMNS)
+    count = 0
+    for row in rows:
+        sheet.append(row)
+        count += 1
+    workbook.save(path)
+    return count
+
+WRITERS = {
+    "csv": write_csv,
+    "xlsx": write_xlsx,
+}
+
+# Выгрузка всей таблицы clients во временный файл. Вызывается через db.run:
+# строки читаются серверным (именованным) курсором пачками по batch_size,
+# так что память не растёт с размером базы. Возвращает (путь, число строк)
+def export_clients(cursor, fmt="csv", batch_size=5000):
+    if fmt == "xlsx" and not XLSX_AVAILABLE:
+        raise RuntimeError("Для выгрузки в XLSX нужен пакет openpyxl")
+
+    fd, path = tempfile.mkstemp(prefix="clients_", suffix=EXPORT_FORMATS[fmt])
+    os.close(fd)
+    try:
+        with cursor.connection.cursor(name="clients_export") as rows:
+            rows.itersize = batch_size
+            rows.execute(EXPORT_QUERY)
+            count = WRITERS[fmt](rows, path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, count
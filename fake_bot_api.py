@@ -0,0 +1,276 @@
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import sys
+import time
+from collections import Counter, defaultdict, deque
+
+from aiohttp import web
+
+# Локальная заглушка Telegram Bot API для проверки рассылок и нагрузочных тестов.
+# Умеет эмулировать лимиты Telegram и отвечать 429 с retry_after.
+class FakeBotAPI:
+    def __init__(self, rate_limit=None, flood_rate=0.0, retry_after=1, latency=0.0):
+        self.rate_limit = rate_limit
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.latency = latency
+        self.calls = Counter()
+        self.floods = 0
+        self.messages = defaultdict(list)
+        self.updates = asyncio.Queue()
+        self._message_ids = itertools.count(1)
+        self._recent_sends = deque()
+        self._runner = None
+
+    @property
+    def sent(self):
+        return sum(len(texts) for texts in self.messages.values())
+
+    def _is_flooded(self):
+        if self.flood_rate and random.random() < self.flood_rate:
+            return True
+        if self.rate_limit:
+            now = time.monotonic()
+            while self._recent_sends and now - self._recent_sends[0] > 1:
+                self._recent_sends.popleft()
+            if len(self._recent_sends) >= self.rate_limit:
+                return True
+            self._recent_sends.append(now)
+        return False
+
+    def _message(self, data):
+        chat_id = int(data.get('chat_id', 0))
+        return {
+            "message_id": int(data.get('message_id') or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": data.get('text', '')
+        }
+
+    async def _get_updates(self, data):
+        timeout = min(float(data.get('timeout', 0) or 0), 1.0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout or 0.01))
+        except asyncio.TimeoutError:
+            return []
+        while not self.updates.empty() and len(updates) < 100:
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        self.calls[method] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method in ('sendMessage', 'sendDocument') and self._is_flooded():
+            self.floods += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            }, status=429)
+
+        if method == 'getMe':
+            result = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+        elif method == 'getUpdates':
+            result = await self._get_updates(data)
+        elif method == 'getChat':
+            chat_id = int(data.get('chat_id', 0))
+            result = {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"}
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self._message(data)
+            if method == 'sendMessage':
+                self.messages[result['chat']['id']].append(result['text'])
+        elif method == 'sendDocument':
+            result = self._message(data)
+            result['document'] = {"file_id": "fake", "file_unique_id": "fake"}
+            self.messages[result['chat']['id']].append("<document>")
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    # Обновления для getUpdates от генератора нагрузки из другого процесса (loadsim.py)
+    async def push_updates(self, request):
+        for update in await request.json():
+            self.updates.put_nowait(update)
+        return web.json_response({"ok": True})
+
+    def app(self):
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        app.router.add_post('/updates', self.push_updates)
+        return app
+
+    async def start(self, host='127.0.0.1', port=8081):
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+# Создать бота, который ходит в заглушку вместо api.telegram.org
+def make_bot(base_url, token="123456:FAKE"):
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    return Bot(token=token, session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)))
+
+# Ответы админа в диалогах во время рассылки: interactive сообщений в секунду
+# в 50 разных чатов, у каждого своя задержка до ответа Bot API
+async def send_replies(bot, rate, latencies, errors):
+    async def reply(chat_id):
+        started = time.monotonic()
+        try:
+            await bot.send_message(chat_id, "reply")
+            latencies.append(time.monotonic() - started)
+        except Exception as e:
+            errors[type(e).__name__] += 1
+
+    tasks = set()
+    try:
+        for i in itertools.count():
+            task = asyncio.create_task(reply(10 ** 9 + i % 50))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            await asyncio.sleep(1 / rate)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def latency_ms(latencies, q):
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000, 1)
+
+async def run_broadcast_check(args):
+    from broadcast import Broadcaster
+    from outbound import OutboundScheduler
+
+    api = FakeBotAPI(rate_limit=args.rate_limit, flood_rate=args.flood_rate, latency=args.latency)
+    base_url = await api.start(port=args.port)
+    bot = make_bot(base_url)
+    if args.outbound_rate:
+        bot.session.middleware(OutboundScheduler(rate=args.outbound_rate).middleware)
+    latencies, errors = [], Counter()
+    replies = None
+    try:
+        broadcaster = Broadcaster(bot, rate=args.rate, concurrency=args.concurrency, progress_interval=1)
+        if args.interactive:
+            replies = asyncio.create_task(send_replies(bot, args.interactive, latencies, errors))
+
+        async def show_progress(stats):
+            print(f"{stats.done}/{stats.total} sent={stats.sent} failed={stats.failed} "
+                  f"retried={stats.retried} rate={stats.rate:.1f}/s")
+
+        stats = await broadcaster.run(list(range(1, args.broadcast + 1)), "test", on_progress=show_progress)
+        if replies:
+            replies.cancel()
+        delivered = sum(1 for chat_id, texts in api.messages.items() if texts and chat_id <= args.broadcast)
+        print(json.dumps({
+            "recipients": stats.total,
+            "sent": stats.sent,
+            "failed": stats.failed,
+            "retried": stats.retried,
+            "flood_responses": api.floods,
+            "delivered_unique": delivered,
+            "duplicates": sum(len(api.messages[chat_id]) for chat_id in range(1, args.broadcast + 1)) - delivered,
+            "seconds": round(stats.elapsed, 2),
+            "msg_per_sec": round(stats.rate, 1),
+            "interactive": {
+                "sent": len(latencies),
+                "errors": dict(errors),
+                "p50_ms": latency_ms(latencies, 0.5),
+                "p95_ms": latency_ms(latencies, 0.95),
+                "max_ms": latency_ms(latencies, 1.0)
+            } if args.interactive else None
+        }, indent=2))
+    finally:
+        if replies:
+            replies.cancel()
+        await bot.session.close()
+        await api.stop()
+
+# Планировщик исходящих: отправитель, отменённый в очереди, не должен задерживать
+# остальных, а запросы без отправки сообщений (getChat) не ждут очереди.
+# Код возврата 1, если проверка не прошла
+async def run_scheduler_check(args):
+    from outbound import OutboundScheduler
+
+    api = FakeBotAPI(latency=args.latency)
+    base_url = await api.start(port=args.port)
+    bot = make_bot(base_url)
+    scheduler = OutboundScheduler(rate=5)
+    bot.session.middleware(scheduler.middleware)
+    try:
+        # Запас токенов расходуется сразу, дальше разрешения раз в 0,2 с
+        await bot.send_message(1, "burst")
+        senders = [asyncio.create_task(bot.send_message(chat_id, "queued")) for chat_id in range(10, 15)]
+        await asyncio.sleep(0.05)
+        senders[0].cancel()
+        started = time.monotonic()
+        await bot.get_chat(11)
+        lookup = time.monotonic() - started
+        done, pending = await asyncio.wait(senders[1:], timeout=10)
+        for task in pending:
+            task.cancel()
+        failed = [task for task in done if task.exception()]
+        delivered = sorted(chat_id for chat_id in range(10, 15) if api.messages.get(chat_id))
+        # Без обхода getChat ждал бы разрешения после всех отправок (около 0,8 с)
+        ok = not pending and not failed and delivered == [11, 12, 13, 14] and lookup < 0.15
+        print(json.dumps({
+            "delivered": delivered,
+            "stuck": len(pending),
+            "get_chat_ms": round(lookup * 1000, 1),
+            "errors": [repr(task.exception()) for task in failed],
+            "dispatcher_alive": not scheduler._dispatcher.done(),
+            "ok": ok
+        }, indent=2))
+        return ok
+    finally:
+        scheduler.close()
+        await bot.session.close()
+        await api.stop()
+
+async def serve(args):
+    api = FakeBotAPI(rate_limit=args.rate_limit, flood_rate=args.flood_rate, latency=args.latency)
+    base_url = await api.start(port=args.port)
+    print(f"Fake Bot API: {base_url} (TELEGRAM_API_URL={base_url})")
+    await asyncio.Event().wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Локальная заглушка Telegram Bot API")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--rate-limit', type=int, default=30, help="сообщений в секунду до ответа 429 (0 — без лимита)")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="доля случайных ответов 429")
+    parser.add_argument('--latency', type=float, default=0.05, help="задержка ответа, сек.")
+    parser.add_argument('--broadcast', type=int, default=0, help="прогнать рассылку на N получателей")
+    parser.add_argument('--scheduler-check', action='store_true',
+                        help="проверить, что отменённый в очереди отправитель не блокирует остальных")
+    parser.add_argument('--rate', type=float, default=25, help="лимит рассылки, сообщений в секунду")
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--interactive', type=float, default=0,
+                        help="ответов в диалогах в секунду во время рассылки (задержка каждого в отчёте)")
+    parser.add_argument('--outbound-rate', type=float, default=0,
+                        help="пропускать отправки через планировщик с этим общим лимитом (0 — напрямую, как раньше)")
+    args = parser.parse_args()
+
+    if args.scheduler_check:
+        sys.exit(0 if asyncio.run(run_scheduler_check(args)) else 1)
+    asyncio.run(run_broadcast_check(args) if args.broadcast else serve(args))
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+# Состояние FSM в PostgreSQL (таблица fsm_states создаётся в init_db)
+class PostgresFSMBackend:
+    def __init__(self, db):
+        self.db = db
+
+    async def load(self, key):
+        row = await self.db.fetchone(
+            'SELECT state, data FROM fsm_states WHERE bot_id = %s AND chat_id = %s AND user_id = %s AND destiny = %s',
+            (key.bot_id, key.chat_id, key.user_id, key.destiny),
+            operation="fsm_load"
+        )
+        if row is None:
+            return None, {}
+        return row[0], row[1] or {}
+
+    async def save(self, key, state, data):
+        if state is None and not data:
+            await self.db.execute(
+                'DELETE FROM fsm_states WHERE bot_id = %s AND chat_id = %s AND user_id = %s AND destiny = %s',
+                (key.bot_id, key.chat_id, key.user_id, key.destiny),
+                operation="fsm_delete"
+            )
+            return
+        await self.db.execute('''
+        INSERT INTO fsm_states (bot_id, chat_id, user_id, destiny, state, data)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (bot_id, chat_id, user_id, destiny) DO UPDATE SET
+            state = EXCLUDED.state,
+            data = EXCLUDED.data,
+            updated_at = CURRENT_TIMESTAMP
+        ''', (key.bot_id, key.chat_id, key.user_id, key.destiny, state, json.dumps(data, ensure_ascii=False)),
+        operation="fsm_save")
+
+    async def close(self):
+        pass
+
+# Состояние FSM в файле SQLite — для локального запуска без PostgreSQL
+class SQLiteFSMBackend:
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                bot_id INTEGER,
+                chat_id INTEGER,
+                user_id INTEGER,
+                destiny TEXT,
+                state TEXT,
+                data TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (bot_id, chat_id, user_id, destiny)
+            )
+            ''')
+            self._conn.commit()
+
+    def _load(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT state, data FROM fsm_states WHERE bot_id = ? AND chat_id = ? AND user_id = ? AND destiny = ?',
+                (key.bot_id, key.chat_id, key.user_id, key.destiny)
+            ).fetchone()
+        if row is None:
+            return None, {}
+        return row[0], json.loads(row[1]) if row[1] else {}
+
+    def _save(self, key, state, data):
+        with self._lock:
+            if state is None and not data:
+                self._conn.execute(
+                    'DELETE FROM fsm_states WHERE bot_id = ? AND chat_id = ? AND user_id = ? AND destiny = ?',
+                    (key.bot_id, key.chat_id, key.user_id, key.destiny)
+                )
+            else:
+                self._conn.execute('''
+                INSERT INTO fsm_states (bot_id, chat_id, user_id, destiny, state, data)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (bot_id, chat_id, user_id, destiny) DO UPDATE SET
+                    state = excluded.state,
+                    data = excluded.data,
+                    updated_at = CURRENT_TIMESTAMP
+                ''', (key.bot_id, key.chat_id, key.user_id, key.destiny, state, json.dumps(data, ensure_ascii=False)))
+            self._conn.commit()
+
+    async def load(self, key):
+        return await asyncio.to_thread(self._load, key)
+
+    async def save(self, key, state, data):
+        await asyncio.to_thread(self._save, key, state, data)
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+# Хранилище FSM в БД с LRU-кэшем в памяти. Запись сквозная (сразу в БД),
+# чтение горячих сессий — из памяти. Кэш согласован, пока апдейты одного
+# пользователя обрабатывает один процесс
+class CachedDatabaseStorage(BaseStorage):
+    def __init__(self, backend, cache_size=10000):
+        self.backend = backend
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    async def _get(self, key):
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return record
+
+        self.misses += 1
+        record = await self.backend.load(key)
+        self._remember(key, record)
+        return record
+
+    def _remember(self, key, record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _put(self, key, state, data):
+        # Ничего не изменилось (например, state.clear() без активной анкеты) — в БД не пишем
+        if self._cache.get(key) == (state, data):
+            return
+        await self.backend.save(key, state, data)
+        self._remember(key, (state, data))
+
+    # Состояния сессий в кэше (для метрик)
+    def states(self):
+        return (state for state, _ in self._cache.values())
+
+    async def set_state(self, bot, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        _, data = await self._get(key)
+        await self._put(key, state, data)
+
+    async def get_state(self, bot, key):
+        state, _ = await self._get(key)
+        return state
+
+    async def set_data(self, bot, key, data):
+        state, _ = await self._get(key)
+        await self._put(key, state, data.copy())
+
+    async def get_data(self, bot, key):
+        _, data = await self._get(key)
+        return data.copy()
+
+    async def close(self):
+        self._cache.clear()
+        await self.backend.close()
@@ -0,0 +1,323 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import aiohttp
+
+# Нагрузочный прогон одного процесса бота целиком, без сети: заглушка Bot API
+# (fake_bot_api.py) запускается отдельным процессом, бот в этом процессе забирает
+# обновления через getUpdates, как при USE_POLLING=1. Синтетические клиенты
+# проходят анкету от /start до частоты посещений и пишут в чат, админы нажимают
+# кнопки отчётов. Каждый следующий шаг клиент делает только после обработки
+# предыдущего — как живой человек, который ждёт ответа бота.
+# Нужна отдельная база BENCH_DATABASE_URL: clients, admins и fsm_states в ней очищаются
+BENCH_DATABASE_URL = os.getenv('BENCH_DATABASE_URL')
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+GENDERS = ["Мужской", "Женский"]
+AGES = ["До 22", "22-30", "Более 30"]
+VISITS = ["До 3 раз", "3-8 раз", "Более 8 раз"]
+ADMIN_BUTTONS = ["📊 Отчёт по базе", "👥 Список админов", "📋 Подробный отчёт", "📈 Статус рассылок"]
+FIRST_USER_ID = 3_000_000
+FIRST_ADMIN_ID = 9_000_000
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def latency_stats(latencies):
+    if not latencies:
+        return {"count": 0}
+    return {
+        "count": len(latencies),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2),
+    }
+
+def questionnaire_answers():
+    return [
+        "/start", "Да", "Да",
+        "Ассортимент и вежливый персонал", "Очереди по вечерам", "Больше акций",
+        random.choice(GENDERS), random.choice(AGES), random.choice(VISITS),
+    ]
+
+def telegram_user(user_id, name):
+    return {"id": user_id, "is_bot": False, "first_name": name, "username": f"user{user_id}"}
+
+def message_update(update_id, user_id, text, name="Клиент"):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": telegram_user(user_id, name),
+            "text": text,
+        },
+    }
+
+def callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": telegram_user(user_id, "Админ"),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "📋 Подробный отчёт по клиентам",
+            },
+        },
+    }
+
+class LoadSimulation:
+    def __init__(self, bot, api_url, args):
+        self.bot = bot
+        self.api_url = api_url
+        self.args = args
+        self.update_ids = itertools.count(1)
+        self._outbox = []
+        self._wakeup = asyncio.Event()
+        self._sent = {}  # update_id -> (вид, время отправки)
+        self._waiters = {}
+        self.reset()
+
+    def reset(self):
+        self.handler = {"survey": [], "chat": [], "admin": []}
+        self.response = {"survey": [], "chat": [], "admin": []}
+        self.errors = 0
+        self.timeouts = 0
+
+    # Внешний middleware диспетчера: время обработки каждого обновления.
+    # Ответ (response) — от отправки в заглушку до конца обработки, с ожиданием в getUpdates
+    async def track(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            finished = time.perf_counter()
+            sent = self._sent.pop(event.update_id, None)
+            if sent:
+                kind, sent_at = sent
+                self.handler[kind].append(finished - started)
+                self.response[kind].append(finished - sent_at)
+            waiter = self._waiters.pop(event.update_id, None)
+            if waiter and not waiter.done():
+                waiter.set_result(None)
+
+    # Отправка пачками: всё, что накопилось, уходит в заглушку одним запросом
+    async def push_forever(self, session):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            batch, self._outbox = self._outbox, []
+            now = time.perf_counter()
+            for kind, update in batch:
+                self._sent[update["update_id"]] = (kind, now)
+            async with session.post(f"{self.api_url}/updates", json=[update for _, update in batch]) as response:
+                response.raise_for_status()
+
+    async def send(self, kind, update):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[update["update_id"]] = waiter
+        self._outbox.append((kind, update))
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(waiter, self.args.step_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._waiters.pop(update["update_id"], None)
+
+    async def think(self):
+        if self.args.think_time:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.args.think_time)
+
+    async def survey_user(self, user_id, delay):
+        await asyncio.sleep(delay)
+        for text in questionnaire_answers():
+            await self.think()
+            await self.send("survey", message_update(next(self.update_ids), user_id, text))
+        for i in range(self.args.chat_messages):
+            await self.think()
+            await self.send("chat", message_update(next(self.update_ids), user_id, f"Вопрос {i + 1}: есть ли доставка?"))
+
+    async def admin_user(self, admin_id, stopped):
+        while not stopped.is_set():
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.args.admin_interval)
+            update_id = next(self.update_ids)
+            if random.random() < 0.25:
+                # «Старее ➡️» в подробном отчёте: страница после самой свежей анкеты
+                key = self.bot.encode_page_key(datetime.now(), 0)
+                await self.send("admin", callback_update(update_id, admin_id, f"clients_page:next:{self.bot.CLIENTS_PAGE_SIZE + 1}:{key}"))
+            else:
+                await self.send("admin", message_update(update_id, admin_id, random.choice(ADMIN_BUTTONS), "Админ"))
+
+    # Один уровень нагрузки: users клиентов входят равномерно за ramp секунд
+    async def run_level(self, users, first_user_id):
+        self.reset()
+        await self.bot.client_writer.flush()
+        stopped = asyncio.Event()
+        admins = [
+            asyncio.create_task(self.admin_user(FIRST_ADMIN_ID + i, stopped))
+            for i in range(self.args.admins)
+        ]
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(
+                self.survey_user(first_user_id + i, self.args.ramp * i / users)
+                for i in range(users)
+            ))
+        finally:
+            stopped.set()
+            await asyncio.gather(*admins)
+        elapsed = time.perf_counter() - started
+
+        updates = sum(len(latencies) for latencies in self.handler.values())
+        return {
+            "users": users,
+            "admins": self.args.admins,
+            "updates": updates,
+            "seconds": round(elapsed, 2),
+            "updates_per_sec": round(updates / elapsed, 1),
+            "handler": latency_stats(list(itertools.chain(*self.handler.values()))),
+            "response": latency_stats(list(itertools.chain(*self.response.values()))),
+            "by_kind": {
+                kind: {"handler": latency_stats(self.handler[kind]), "response": latency_stats(self.response[kind])}
+                for kind in self.handler
+            },
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+        }
+
+async def prepare_database(bot, admins):
+    await bot.db.execute('TRUNCATE clients, fsm_states, admins, admin_notify_failures')
+    bot.client_index.clear()
+    for admin_id in range(FIRST_ADMIN_ID, FIRST_ADMIN_ID + admins):
+        await bot.db.execute(
+            'INSERT INTO admins (user_id, username, added_by) VALUES (%s, %s, %s)',
+            (admin_id, f"admin{admin_id}", FIRST_ADMIN_ID)
+        )
+    await bot.admin_registry.refresh()
+
+async def wait_for_api(api_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.post(f"{api_url}/bot0:0/getMe") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Заглушка Bot API {api_url} не ответила за {timeout} сек.")
+
+async def simulate(bot, api_url, args):
+    await wait_for_api(api_url)
+    simulation = LoadSimulation(bot, api_url, args)
+    bot.dp.update.outer_middleware(simulation.track)
+    started = asyncio.Event()
+
+    async def on_startup():
+        started.set()
+    bot.dp.startup.register(on_startup)
+
+    bot_task = asyncio.create_task(bot.main())
+    await asyncio.wait([asyncio.create_task(started.wait()), bot_task], return_when=asyncio.FIRST_COMPLETED)
+    if bot_task.done():
+        raise SystemExit("Бот не запустился, подробности в логе выше")
+
+    results = {}
+    try:
+        await prepare_database(bot, args.admins)
+        async with aiohttp.ClientSession() as session:
+            pusher = asyncio.create_task(simulation.push_forever(session))
+            try:
+                first_user_id = FIRST_USER_ID
+                for users in [int(n) for n in args.users.split(",")]:
+                    results[f"users_{users}"] = await simulation.run_level(users, first_user_id)
+                    first_user_id += users
+                    print(f"{users} клиентов: {results[f'users_{users}']['updates_per_sec']} обновлений/с, "
+                          f"p95 ответа {results[f'users_{users}']['response'].get('p95_ms')} мс", file=sys.stderr)
+            finally:
+                pusher.cancel()
+        await prepare_database(bot, 0)
+    finally:
+        await bot.dp.stop_polling()
+        await bot_task
+    return results
+
+def main(args):
+    if not BENCH_DATABASE_URL:
+        raise SystemExit("Укажите BENCH_DATABASE_URL (отдельная база, её таблицы будут очищены)")
+
+    api = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "fake_bot_api.py"), "--port", str(args.api_port),
+         "--latency", str(args.api_latency), "--rate-limit", "0"],
+        cwd=HERE, stdout=subprocess.DEVNULL
+    )
+    api_url = f"http://127.0.0.1:{args.api_port}"
+    # Один процесс бота в режиме polling, все запросы к Bot API — в заглушку
+    os.environ.update(
+        DATABASE_URL=BENCH_DATABASE_URL,
+        TELEGRAM_API_URL=api_url,
+        USE_POLLING="1",
+        WORKERS="1",
+        SUPER_ADMIN_ID=str(FIRST_ADMIN_ID),
+        OUTBOUND_RATE=str(args.outbound_rate),
+    )
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:LOADSIM')
+    for name in ("WEBHOOK_URL", "PORT", "WORKER_ID"):
+        os.environ.pop(name, None)
+    try:
+        import bot
+        random.seed(42)
+        results = asyncio.run(simulate(bot, api_url, args))
+    finally:
+        api.send_signal(signal.SIGTERM)
+        try:
+            api.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            api.kill()
+
+    report = json.dumps({"loadsim": results}, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон анкеты через заглушку Bot API")
+    parser.add_argument('--users', default="100,500,2000", help="клиентов одновременно на каждом уровне нагрузки, через запятую")
+    parser.add_argument('--ramp', type=float, default=5, help="за сколько секунд входят все клиенты уровня")
+    parser.add_argument('--think-time', type=float, default=0.5, help="пауза клиента перед каждым ответом, сек. (±50%%)")
+    parser.add_argument('--chat-messages', type=int, default=1, help="сообщений в чат после анкеты")
+    parser.add_argument('--admins', type=int, default=3, help="админов, нажимающих кнопки отчётов")
+    parser.add_argument('--admin-interval', type=float, default=2, help="пауза админа между нажатиями, сек. (±50%%)")
+    parser.add_argument('--api-latency', type=float, default=0.05, help="задержка ответа заглушки Bot API, сек.")
+    parser.add_argument('--api-port', type=int, default=8082)
+    parser.add_argument('--outbound-rate', type=float, default=0,
+                        help="общий лимит исходящих сообщений бота в секунду (0 — без планировщика, как заглушка без лимитов)")
+    parser.add_argument('--step-timeout', type=float, default=60, help="сколько ждать обработки одного шага, сек.")
+    parser.add_argument('--output', help="записать результаты в JSON-файл вместо вывода")
+    main(parser.parse_args())
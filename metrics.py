@@ -0,0 +1,208 @@
+import bisect
+import logging
+import math
+import time
+
+# Метрики в текстовом формате Prometheus без внешних зависимостей. Рассчитаны на
+# горячий путь: замер — поиск серии в dict, bisect по границам и пара сложений.
+# Значения меняются только из event loop (и из logging.Handler под его блокировкой),
+# поэтому без собственных блокировок. Всё, что можно посчитать в момент запроса
+# /metrics (размер кэша FSM, прогресс рассылок), собирается колбэками и на горячем
+# пути не стоит ничего
+
+# Секунды: от быстрых проверок в памяти до долгих запросов и отправок с повторами
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Защита от взрыва числа серий: новые сочетания меток сверх лимита идут в "other"
+MAX_SERIES = 200
+OVERFLOW = "other"
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labels=(), max_series=MAX_SERIES):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.max_series = max_series
+        self._series = {}
+
+    def _slot(self, values):
+        series = self._series.get(values)
+        if series is None:
+            if len(self._series) >= self.max_series:
+                values = (OVERFLOW,) * len(self.labels)
+                series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = self._new()
+        return series
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return lines
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new(self):
+        return [0]
+
+    def inc(self, *labels, amount=1):
+        self._slot(labels)[0] += amount
+
+    def value(self, *labels):
+        series = self._series.get(labels)
+        return series[0] if series else 0
+
+    def _samples(self):
+        for values, series in self._series.items():
+            yield f"{self.name}{format_labels(self.labels, values)} {format_value(series[0])}"
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, max_series=MAX_SERIES):
+        super().__init__(name, help, labels, max_series)
+        self.buckets = tuple(sorted(buckets))
+
+    # Счётчики по корзинам без накопления (+1 — корзина +Inf), сумма и число замеров
+    def _new(self):
+        return [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+    def observe(self, value, *labels):
+        series = self._slot(labels)
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def _samples(self):
+        for values, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket
+                le = f'le="{format_value(float(bound))}"'
+                yield f"{self.name}_bucket{format_labels(self.labels, values, le)} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, values)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(self.labels, values)} {count}"
+
+# Значения считаются при каждом запросе /metrics: collect() возвращает число
+# (метрика без меток) или пары (значения меток, число)
+class Collected(Metric):
+    def __init__(self, name, help, collect, labels=(), kind="gauge"):
+        super().__init__(name, help, labels)
+        self.type = kind
+        self.collect = collect
+
+    def _samples(self):
+        result = self.collect()
+        if not self.labels:
+            result = [((), result)]
+        for values, value in result:
+            yield f"{self.name}{format_labels(self.labels, values)} {format_value(value)}"
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def collected(self, name, help, collect, labels=(), kind="gauge"):
+        return self.register(Collected(name, help, collect, labels, kind))
+
+    # Ошибка одного колбэка не ломает весь ответ: метрика пропускается и считается
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                ERRORS.inc("metrics", type(e).__name__)
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+START_TIME = time.time()
+
+REGISTRY.collected("process_start_time_seconds", "Время запуска процесса (unix)", lambda: START_TIME)
+UPDATES = REGISTRY.histogram(
+    "bot_update_duration_seconds",
+    "Обработка обновления: время по обработчику (состояние FSM, кнопка админа, команда, callback)",
+    labels=("handler",)
+)
+SLOW_UPDATES = REGISTRY.counter(
+    "bot_slow_updates_total",
+    "Обновления дольше порога SLOW_UPDATE_THRESHOLD, по обработчику",
+    labels=("handler",)
+)
+DB_QUERIES = REGISTRY.histogram(
+    "bot_db_query_duration_seconds",
+    "Запросы к БД через пул: ожидание соединения и выполнение, по операции",
+    labels=("operation",)
+)
+TELEGRAM_REQUESTS = REGISTRY.histogram(
+    "bot_telegram_request_duration_seconds",
+    "Запросы к Bot API по методу и результату (ok или класс исключения)",
+    labels=("method", "result")
+)
+ERRORS = REGISTRY.counter(
+    "bot_errors_total",
+    "Исключения по месту (handler, db, telegram, metrics) и классу",
+    labels=("source", "error")
+)
+LOG_ERRORS = REGISTRY.counter(
+    "bot_log_errors_total",
+    "Записи журнала уровня ERROR и выше (в том числе перехваченные ошибки обработчиков)",
+    labels=("level", "logger")
+)
+
+# Запросы к Bot API: middleware сессии aiogram (bot.session.middleware(...))
+async def telegram_request_middleware(make_request, bot, method):
+    started = time.perf_counter()
+    result = "ok"
+    try:
+        return await make_request(bot, method)
+    except Exception as e:
+        result = type(e).__name__
+        ERRORS.inc("telegram", result)
+        raise
+    finally:
+        TELEGRAM_REQUESTS.observe(time.perf_counter() - started, type(method).__name__, result)
+
+# Считает ошибки, которые обработчики перехватывают и только пишут в журнал
+class LogErrorsHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+
+    def emit(self, record):
+        LOG_ERRORS.inc(record.levelname, record.name)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+from array import array
+from datetime import datetime, timedelta
+
+# Микробенчмарки отдельных компонентов: без сети и без Bot API. Анкеты пишутся
+# в PostgreSQL из BENCH_DATABASE_URL (таблица clients в ней очищается) или,
+# если база не указана, в SQLite в памяти тем же запросом
+BENCH_DATABASE_URL = os.getenv('BENCH_DATABASE_URL')
+if BENCH_DATABASE_URL:
+    os.environ['DATABASE_URL'] = BENCH_DATABASE_URL
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCH')
+
+import psycopg2
+from aiogram import types
+
+import bot
+from bench import AGES, GENDERS, VISITS, synthetic_row, write_synthetic_report
+from client_index import ClientIndex
+from db import connect_params
+from metrics import Histogram
+from migrations import migrate
+from report_cache import ReportCache
+from restore_clients import parse_clients
+
+# Медиана и минимум времени одного вызова по нескольким повторам. Число вызовов
+# в повторе подбирается, как в python -m timeit (повтор не короче 0,2 с).
+# Минимум меньше всего зависит от шума соседних процессов
+def measure(func, repeat, scale=1):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    runs = [t / number / scale for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "median_us": round(statistics.median(runs) * 1e6, 3),
+        "min_us": round(min(runs) * 1e6, 3),
+        "ops_per_sec": round(1 / min(runs)),
+        "calls": number * repeat,
+    }
+
+def synthetic_client(user_id, answer_length=80):
+    answer = ("Ассортимент и вежливый персонал. " * (answer_length // 30 + 1))[:answer_length]
+    return (
+        user_id, f"user{user_id}", f"Клиент {user_id}",
+        datetime(2024, 1, 1) + timedelta(minutes=user_id),
+        answer, answer, answer,
+        random.choice(GENDERS), random.choice(AGES), random.choice(VISITS),
+    )
+
+def bench_parse(args):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "clients_report.txt")
+        write_synthetic_report(path, args.report_clients, 0.02)
+        with open(path, "r", encoding="utf-8") as f:
+            report = f.read()
+    clients = sum(1 for _ in parse_clients(io.StringIO(report)))
+    result = measure(lambda: sum(1 for _ in parse_clients(io.StringIO(report))), args.repeat, scale=clients)
+    result["clients_per_sec"] = result.pop("ops_per_sec")
+    result["mb_per_sec"] = round(len(report.encode()) / 1024 / 1024 * result["clients_per_sec"] / clients, 1)
+    return {"parse_clients": result}
+
+def bench_keyboards(args):
+    menu = [f"Пункт {i}" for i in range(9)]
+    picker = [(user_id, f"Клиент {user_id}", f"user{user_id}") for user_id in range(1, bot.CLIENT_SEARCH_LIMIT + 1)]
+    page = [synthetic_client(user_id) for user_id in range(1, bot.CLIENTS_PAGE_SIZE + 1)]
+    return {
+        "make_keyboard": measure(lambda: bot.make_keyboard(menu), args.repeat),
+        "client_picker": measure(lambda: bot.render_client_picker(picker, "клиент", 3), args.repeat),
+        "clients_page_keyboard": measure(lambda: bot.clients_page_keyboard(page, 6, True), args.repeat),
+    }
+
+def bench_reports(args):
+    page = [synthetic_client(user_id, answer_length=500) for user_id in range(1, bot.CLIENTS_PAGE_SIZE + 1)]
+    admins = [
+        (user_id, f"admin{user_id}", "owner", datetime(2024, 1, 1), user_id % 3)
+        for user_id in range(1, args.admins + 1)
+    ]
+    # Все сочетания пол × возраст × частота посещений, как в client_segments
+    segments = [
+        (100 + i, gender, age, visit)
+        for i, (gender, age, visit) in enumerate(itertools.product(GENDERS, AGES, VISITS))
+    ]
+    cache = ReportCache(ttl=3600)
+    report = bot.render_database_report(10 ** 6, args.admins, datetime(2024, 1, 1), datetime(2025, 1, 1), segments)
+
+    async def build():
+        return report
+
+    asyncio.run(cache.get("database", build))
+    return {
+        "render_clients_page": measure(lambda: bot.render_clients_page(bot.fit_clients_page(page)[0], 6), args.repeat),
+        f"render_admins_{args.admins}": measure(lambda: bot.render_admins(admins), args.repeat),
+        "render_database_report": measure(
+            lambda: bot.render_database_report(10 ** 6, args.admins, datetime(2024, 1, 1), datetime(2025, 1, 1), segments),
+            args.repeat
+        ),
+        "report_cache_hit": measure(lambda: run_coroutine(cache.get("database", build)), args.repeat),
+    }
+
+def bench_checks(args):
+    bot.admin_registry.replace(range(1, args.admins + 1))
+    index = ClientIndex(None)
+    index._ids = array('q', range(7, args.index_clients * 7 + 1, 7))
+    bot.client_index, client_index = index, bot.client_index
+    try:
+        return {
+            "is_admin_hit": measure(lambda: bot.is_admin(args.admins // 2), args.repeat),
+            "is_admin_miss": measure(lambda: bot.is_admin(args.admins + 1), args.repeat),
+            "is_client_hit": measure(lambda: bot.is_client(7 * (args.index_clients // 2)), args.repeat),
+            "is_client_miss": measure(lambda: bot.is_client(8), args.repeat),
+        }
+    finally:
+        bot.client_index = client_index
+        bot.admin_registry.replace(())
+
+# Корутина без реального ожидания завершается на первом send(None)
+def run_coroutine(coro):
+    try:
+        coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+    raise RuntimeError("корутина ждёт ввода-вывода")
+
+# Цена метрик на горячем пути: замер гистограммы и middleware вокруг обработчика
+# (разница с вызовом того же обработчика напрямую — с выключенным и включённым
+# профилированием), а также сборка ответа /metrics
+def bench_metrics(args):
+    histogram = Histogram("bench_seconds", "bench", labels=("handler",))
+    update = types.Update(update_id=1, message=types.Message(
+        message_id=1, date=datetime.now(), chat=types.Chat(id=1, type="private"),
+        from_user=types.User(id=1, is_bot=False, first_name="Клиент"), text="Да"
+    ))
+    data = {"raw_state": "Questionnaire:WANT_HELP"}
+
+    async def handler(event, data):
+        return None
+
+    direct = measure(lambda: run_coroutine(handler(update, data)), args.repeat)
+    tracked = measure(lambda: run_coroutine(bot.track_update(handler, update, data)), args.repeat)
+    # То же с включённым захватом cProfile (каждое обновление в выборке)
+    bot.profiler.start(10 ** 9)
+    try:
+        profiled = measure(lambda: run_coroutine(bot.track_update(handler, update, data)), args.repeat)
+    finally:
+        bot.profiler.stop()
+    return {
+        "histogram_observe": measure(lambda: histogram.observe(0.012, "Questionnaire:WANT_HELP"), args.repeat),
+        "update_middleware": dict(tracked, overhead_us=round(tracked["min_us"] - direct["min_us"], 3)),
+        "update_middleware_profiling": dict(profiled, overhead_us=round(profiled["min_us"] - direct["min_us"], 3)),
+        "metrics_render": measure(bot.REGISTRY.render, args.repeat),
+    }
+
+# Тот же запрос, что в bot.upsert_clients, в синтаксисе параметров SQLite
+SQLITE_UPSERT_QUERY = bot.UPSERT_CLIENTS_QUERY.replace("VALUES %s", f"VALUES ({', '.join('?' * 10)})")
+
+def sqlite_connection():
+    conn = sqlite3.connect(":memory:")
+    conn.execute('''
+    CREATE TABLE clients (
+        user_id INTEGER PRIMARY KEY, username TEXT, full_name TEXT, appreciate TEXT,
+        dislike TEXT, improve TEXT, gender TEXT, age_group TEXT, visit_freq TEXT,
+        is_admin BOOLEAN DEFAULT FALSE, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    def upsert(rows):
+        conn.executemany(SQLITE_UPSERT_QUERY, rows)
+        conn.commit()
+    return conn, upsert
+
+def postgres_connection():
+    conn = psycopg2.connect(**connect_params())
+    migrate(conn)
+    with conn.cursor() as cursor:
+        cursor.execute('TRUNCATE clients')
+    conn.commit()
+    def upsert(rows):
+        with conn.cursor() as cursor:
+            bot.upsert_clients(cursor, rows)
+        conn.commit()
+    return conn, upsert
+
+# Новые анкеты (вставка) и повторные (обновление), по одной и пачкой, как у ClientWriter
+def bench_upsert(args):
+    conn, upsert = postgres_connection() if args.backend == "postgres" else sqlite_connection()
+    user_ids = itertools.count(1)
+    try:
+        results = {
+            "upsert_insert_single": measure(lambda: upsert([synthetic_row(next(user_ids))]), args.repeat),
+            f"upsert_insert_batch_{args.batch}": measure(
+                lambda: upsert([synthetic_row(next(user_ids)) for _ in range(args.batch)]),
+                args.repeat, scale=args.batch
+            ),
+        }
+        existing = [synthetic_row(user_id) for user_id in range(1, args.batch + 1)]
+        results["upsert_update_single"] = measure(lambda: upsert(existing[:1]), args.repeat)
+        results[f"upsert_update_batch_{args.batch}"] = measure(lambda: upsert(existing), args.repeat, scale=args.batch)
+        if args.backend == "postgres":
+            with conn.cursor() as cursor:
+                cursor.execute('TRUNCATE clients')
+            conn.commit()
+    finally:
+        conn.close()
+    for result in results.values():
+        result["backend"] = args.backend
+    return results
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "keyboards": bench_keyboards,
+    "reports": bench_reports,
+    "checks": bench_checks,
+    "metrics": bench_metrics,
+    "upsert": bench_upsert,
+}
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+# Сравнение с прошлым прогоном по минимальному времени вызова. Возвращает
+# строки отчёта и число замедлений сильнее threshold
+def compare(results, baseline, threshold):
+    lines = []
+    regressions = 0
+    previous = baseline.get("results", {})
+    for name, result in results.items():
+        if name not in previous:
+            lines.append(f"{name:<32} {result['min_us']:>12.3f} us   (новый)")
+            continue
+        old, new = previous[name]["min_us"], result["min_us"]
+        change = (new - old) / old if old else 0.0
+        mark = ""
+        if change > threshold:
+            mark = "  ⚠️ медленнее"
+            regressions += 1
+        elif change < -threshold:
+            mark = "  быстрее"
+        lines.append(f"{name:<32} {old:>12.3f} -> {new:>12.3f} us  {change:+7.1%}{mark}")
+    backends = {baseline.get("meta", {}).get("backend"), results_backend(results)} - {None}
+    if len(backends) > 1:
+        lines.append("Внимание: прошлый прогон записывал анкеты в другую базу")
+    return lines, regressions
+
+def results_backend(results):
+    return next((result["backend"] for result in results.values() if "backend" in result), None)
+
+def main(args):
+    if args.backend == "postgres" and not BENCH_DATABASE_URL:
+        raise SystemExit("Укажите BENCH_DATABASE_URL (отдельная база, таблица clients в ней будет очищена)")
+    random.seed(42)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        raise SystemExit(f"Неизвестные бенчмарки: {', '.join(sorted(unknown))}")
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        results.update(BENCHMARKS[name](args))
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": results_backend(results),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        lines, regressions = compare(results, baseline, args.threshold)
+        print(f"Сравнение с {args.compare} (коммит {baseline.get('meta', {}).get('commit')}):", file=sys.stderr)
+        for line in lines:
+            print(line, file=sys.stderr)
+        if regressions:
+            raise SystemExit(f"Замедлений больше {args.threshold:.0%}: {regressions}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Микробенчмарки компонентов бота")
+    parser.add_argument('benchmarks', nargs='*', help=f"что запускать: {', '.join(BENCHMARKS)} (по умолчанию всё)")
+    parser.add_argument('--output', help="записать результаты в JSON-файл вместо вывода")
+    parser.add_argument('--compare', help="JSON прошлого прогона для сравнения")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="допустимое замедление при сравнении (доля; разброс между прогонами на общей машине бывает 10–20%%)")
+    parser.add_argument('--backend', choices=("postgres", "sqlite"),
+                        default="postgres" if BENCH_DATABASE_URL else "sqlite",
+                        help="куда писать анкеты (по умолчанию postgres, если задан BENCH_DATABASE_URL)")
+    parser.add_argument('--repeat', type=int, default=5, help="повторов каждого замера")
+    parser.add_argument('--report-clients', type=int, default=5000, help="клиентов в отчёте для parse_clients")
+    parser.add_argument('--admins', type=int, default=50, help="админов в списке и в реестре")
+    parser.add_argument('--index-clients', type=int, default=100_000, help="клиентов в индексе для is_client")
+    parser.add_argument('--batch', type=int, default=500, help="анкет в пачке записи")
+    main(parser.parse_args())
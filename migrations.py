@@ -0,0 +1,294 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory lock: миграции применяет только один процесс (важно при WORKERS > 1)
+MIGRATION_LOCK_ID = 4_215_030
+# Соединения пула работают с коротким statement_timeout (DB_STATEMENT_TIMEOUT_MS),
+# а заполнение сводок и построение индексов на большой clients идут минутами.
+# На время миграций лимит снимается (0) или заменяется этим значением
+MIGRATION_STATEMENT_TIMEOUT_MS = int(os.getenv("MIGRATION_STATEMENT_TIMEOUT_MS", "0"))
+
+# Слова, по началу которых ищется клиент для чата. Конфигурация 'simple' без стемминга:
+# имена и username только приводятся к нижнему регистру. Встроенный GIN, расширения не нужны
+CLIENT_SEARCH_VECTOR = (
+    "to_tsvector('simple', user_id::text || ' ' || COALESCE(full_name, '') || ' ' || COALESCE(username, ''))"
+)
+
+# Индексы под горячие запросы к clients (чат с клиентом, подробный отчёт, отчёт по базе, рассылка)
+HOT_PATH_INDEXES = {
+    # WHERE is_admin = FALSE ORDER BY timestamp DESC LIMIT ... (+ user_id для постраничного вывода)
+    "clients_recent_idx": '''
+    CREATE INDEX IF NOT EXISTS clients_recent_idx
+    ON clients (timestamp DESC, user_id DESC) WHERE is_admin = FALSE
+    ''',
+    # Первая и последняя анкета в отчёте по базе: MIN/MAX(timestamp) без полного прохода
+    "clients_timestamp_idx": '''
+    CREATE INDEX IF NOT EXISTS clients_timestamp_idx ON clients (timestamp)
+    ''',
+    # Получатели рассылки: SELECT user_id ... WHERE is_admin = FALSE (index-only scan)
+    "clients_recipients_idx": '''
+    CREATE INDEX IF NOT EXISTS clients_recipients_idx
+    ON clients (user_id) WHERE is_admin = FALSE
+    ''',
+}
+
+# Миграции схемы: (версия, описание, SQL-шаги). Каждая применяется один раз в своей
+# транзакции и записывается в schema_version. Новые — только в конец списка,
+# уже применённые не менять. Шаги идемпотентны: первые миграции повторяют
+# схему, созданную прежним init_db, и безопасны для существующих баз
+MIGRATIONS = [
+    (1, "Таблицы admins и clients", [
+        '''
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            added_by BIGINT,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS clients (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            appreciate TEXT,
+            dislike TEXT,
+            improve TEXT,
+            gender TEXT,
+            age_group TEXT,
+            visit_freq TEXT,
+            is_admin BOOLEAN DEFAULT FALSE,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, "Рассылки и статусы доставки по каждому получателю", [
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            text TEXT NOT NULL,
+            created_by BIGINT,
+            created_by_username TEXT,
+            chat_id BIGINT,
+            status_message_id BIGINT,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id BIGINT REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+            user_id BIGINT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            updated_at TIMESTAMP,
+            PRIMARY KEY (job_id, user_id)
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS broadcast_recipients_pending_idx
+        ON broadcast_recipients (job_id, user_id) WHERE status = 'pending'
+        ''',
+    ]),
+    (3, "Недоставленные уведомления админам", [
+        '''
+        CREATE TABLE IF NOT EXISTS admin_notify_failures (
+            id BIGSERIAL PRIMARY KEY,
+            admin_id BIGINT NOT NULL,
+            error TEXT,
+            message TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS admin_notify_failures_admin_idx
+        ON admin_notify_failures (admin_id, created_at)
+        ''',
+    ]),
+    (4, "Состояния FSM (анкета, диалоги админов)", [
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            bot_id BIGINT,
+            chat_id BIGINT,
+            user_id BIGINT,
+            destiny TEXT,
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (bot_id, chat_id, user_id, destiny)
+        )
+        ''',
+    ]),
+    (5, "Очередь обновлений для работы в несколько процессов", [
+        # update_id — первичный ключ, повторные доставки отбрасываются
+        '''
+        CREATE TABLE IF NOT EXISTS update_queue (
+            update_id BIGINT PRIMARY KEY,
+            shard INTEGER NOT NULL,
+            payload JSONB NOT NULL,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed_at TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS update_queue_pending_idx
+        ON update_queue (shard, update_id) WHERE processed_at IS NULL
+        ''',
+    ]),
+    (6, "Сводка client_segments для отчёта по базе", [
+        '''
+        CREATE TABLE IF NOT EXISTS client_segments (
+            gender TEXT NOT NULL,
+            age_group TEXT NOT NULL,
+            visit_freq TEXT NOT NULL,
+            total BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (gender, age_group, visit_freq)
+        )
+        ''',
+        # NULL в сегменте храним как '' (в первичном ключе NULL недопустим).
+        # Строки сортируются, чтобы параллельные транзакции блокировали их в одном порядке
+        '''
+        CREATE OR REPLACE FUNCTION client_segments_refresh() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                DELETE FROM client_segments;
+                RETURN NULL;
+            END IF;
+
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO client_segments AS s (gender, age_group, visit_freq, total)
+                SELECT COALESCE(gender, ''), COALESCE(age_group, ''), COALESCE(visit_freq, ''), COUNT(*)
+                FROM new_rows GROUP BY 1, 2, 3 ORDER BY 1, 2, 3
+                ON CONFLICT (gender, age_group, visit_freq) DO UPDATE SET total = s.total + EXCLUDED.total;
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE client_segments s SET total = s.total - d.total
+                FROM (
+                    SELECT COALESCE(gender, '') AS gender, COALESCE(age_group, '') AS age_group,
+                           COALESCE(visit_freq, '') AS visit_freq, COUNT(*) AS total
+                    FROM old_rows GROUP BY 1, 2, 3
+                ) d
+                WHERE s.gender = d.gender AND s.age_group = d.age_group AND s.visit_freq = d.visit_freq;
+            ELSE
+                -- Повторная анкета: клиент переходит из старого сегмента в новый
+                INSERT INTO client_segments AS s (gender, age_group, visit_freq, total)
+                SELECT gender, age_group, visit_freq, SUM(delta)
+                FROM (
+                    SELECT COALESCE(gender, '') AS gender, COALESCE(age_group, '') AS age_group,
+                           COALESCE(visit_freq, '') AS visit_freq, -1 AS delta
+                    FROM old_rows
+                    UNION ALL
+                    SELECT COALESCE(gender, ''), COALESCE(age_group, ''), COALESCE(visit_freq, ''), 1
+                    FROM new_rows
+                ) d
+                GROUP BY 1, 2, 3
+                HAVING SUM(delta) <> 0
+                ORDER BY 1, 2, 3
+                ON CONFLICT (gender, age_group, visit_freq) DO UPDATE SET total = s.total + EXCLUDED.total;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        # Триггеры пересоздаём и заполняем сводку заново под блокировкой записи в clients
+        'LOCK TABLE clients IN SHARE ROW EXCLUSIVE MODE',
+        'DROP TRIGGER IF EXISTS clients_segments_insert ON clients',
+        'DROP TRIGGER IF EXISTS clients_segments_update ON clients',
+        'DROP TRIGGER IF EXISTS clients_segments_delete ON clients',
+        'DROP TRIGGER IF EXISTS clients_segments_truncate ON clients',
+        '''
+        CREATE TRIGGER clients_segments_insert AFTER INSERT ON clients
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION client_segments_refresh()
+        ''',
+        '''
+        CREATE TRIGGER clients_segments_update AFTER UPDATE ON clients
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION client_segments_refresh()
+        ''',
+        '''
+        CREATE TRIGGER clients_segments_delete AFTER DELETE ON clients
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION client_segments_refresh()
+        ''',
+        '''
+        CREATE TRIGGER clients_segments_truncate AFTER TRUNCATE ON clients
+        FOR EACH STATEMENT EXECUTE FUNCTION client_segments_refresh()
+        ''',
+        'DELETE FROM client_segments',
+        '''
+        INSERT INTO client_segments (gender, age_group, visit_freq, total)
+        SELECT COALESCE(gender, ''), COALESCE(age_group, ''), COALESCE(visit_freq, ''), COUNT(*)
+        FROM clients GROUP BY 1, 2, 3
+        ''',
+    ]),
+    (7, "Индексы горячих запросов к clients", list(HOT_PATH_INDEXES.values())),
+    (8, "Индекс для постраничного подробного отчёта", [
+        # Ключ страницы (timestamp, user_id); анкеты без даты (восстановленные) — в конце
+        '''
+        CREATE INDEX IF NOT EXISTS clients_report_keyset_idx
+        ON clients ((COALESCE(timestamp, '-infinity')) DESC, user_id DESC) WHERE is_admin = FALSE
+        ''',
+    ]),
+    (9, "Полнотекстовый индекс для поиска клиента по имени, username и ID", [
+        # Индекс используется, только если запрос поиска содержит то же выражение
+        f'''
+        CREATE INDEX IF NOT EXISTS clients_search_idx
+        ON clients USING gin ({CLIENT_SEARCH_VECTOR}) WHERE is_admin = FALSE
+        ''',
+    ]),
+]
+
+# Применить недостающие миграции. conn — соединение из Database.connection()
+def migrate(conn):
+    with conn.cursor() as cursor:
+        # До блокировки: ожидание миграций другого процесса — тоже долгий запрос.
+        # SET фиксируется сразу, чтобы откат неудачной миграции его не отменил
+        cursor.execute('SET statement_timeout = %s', (MIGRATION_STATEMENT_TIMEOUT_MS,))
+        conn.commit()
+        try:
+            cursor.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK_ID,))
+        except Exception:
+            conn.rollback()
+            cursor.execute('RESET statement_timeout')
+            conn.commit()
+            raise
+        try:
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''')
+            cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+            current = cursor.fetchone()[0]
+            conn.commit()
+
+            applied = []
+            for version, description, steps in MIGRATIONS:
+                if version <= current:
+                    continue
+                try:
+                    for step in steps:
+                        cursor.execute(step)
+                    cursor.execute(
+                        'INSERT INTO schema_version (version, description) VALUES (%s, %s)',
+                        (version, description)
+                    )
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    logger.error(f"Ошибка миграции {version} ({description}): {e}")
+                    raise
+                logger.info(f"Применена миграция {version}: {description}")
+                applied.append(version)
+            return applied
+        finally:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK_ID,))
+            # Соединение вернётся в пул: лимит пула снова действует
+            cursor.execute('RESET statement_timeout')
+            conn.commit()
@@ -0,0 +1,213 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Полосы по убыванию приоритета: ответы в диалогах, уведомления админам, рассылки
+INTERACTIVE = "interactive"
+NOTIFY = "notify"
+BROADCAST = "broadcast"
+LANES = (INTERACTIVE, NOTIFY, BROADCAST)
+
+# Полоса запросов текущей задачи. По умолчанию — интерактивная: всё, что отвечает
+# обработчик апдейта. Фоновые задачи выставляют свою полосу в начале (asyncio копирует
+# контекст в новую задачу, так что значение не утекает наружу)
+OUTBOUND_LANE = contextvars.ContextVar("outbound_lane", default=INTERACTIVE)
+
+# Лимиты Telegram на отправку расходуют только сообщения: отправка, правка,
+# пересылка и копирование. Остальные запросы с chat_id (getChat, deleteMessage,
+# sendChatAction) идут в обход планировщика и не занимают место отправок в чат
+MESSAGE_METHOD_PREFIXES = ("Send", "Edit", "Copy", "Forward")
+NOT_MESSAGE_METHODS = {"SendChatAction"}
+
+def is_message_method(method):
+    name = type(method).__name__
+    return name.startswith(MESSAGE_METHOD_PREFIXES) and name not in NOT_MESSAGE_METHODS
+
+OUTBOUND_WAIT = REGISTRY.histogram(
+    "bot_outbound_wait_seconds",
+    "Ожидание разрешения на отправку в Bot API по полосе приоритета",
+    labels=("lane",)
+)
+
+# Лимит скорости отправки (token bucket)
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        # Небольшой запас на всплеск, чтобы не превысить лимит в первую же секунду
+        self.capacity = capacity or max(1, rate / 5)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    # После 429 Telegram запрещает любые отправки на retry_after секунд
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# Общий бюджет отправок бота на все полосы. Разрешения выдаются по одному: когда
+# глобальный лимит даёт очередной токен, его получает самый приоритетный ожидающий,
+# чей чат не упёрся в свой лимит. Поэтому ответ в диалоге ждёт не дольше одного
+# интервала глобального лимита, сколько бы получателей ни стояло в рассылке.
+# Лимит на чат — GCRA: chat_burst сообщений подряд, дальше не чаще chat_interval.
+# Порядок сообщений в один чат внутри полосы сохраняется
+class OutboundScheduler:
+    def __init__(self, rate=25, chat_interval=1.0, chat_burst=3, max_chats=10000):
+        self.bucket = TokenBucket(rate)
+        self.chat_interval = chat_interval
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self._lanes = {lane: deque() for lane in LANES}
+        # chat_id -> теоретическое время следующей отправки (GCRA)
+        self._chat_tat = {}
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+
+    def depth(self, lane):
+        return len(self._lanes[lane])
+
+    def pause(self, seconds):
+        self.bucket.pause(seconds)
+
+    async def acquire(self, chat_id, lane=None):
+        lane = lane or OUTBOUND_LANE.get()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        waiter = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        self._lanes[lane].append((chat_id, waiter))
+        self._wakeup.set()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # При отмене задачи отменён и сам waiter: убираем его из полосы, чтобы
+            # разрешение не досталось мёртвому ожидающему
+            try:
+                self._lanes[lane].remove((chat_id, waiter))
+            except ValueError:
+                pass
+            raise
+        finally:
+            OUTBOUND_WAIT.observe(time.perf_counter() - started, lane)
+
+    def close(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+        for queue in self._lanes.values():
+            while queue:
+                queue.popleft()[1].cancel()
+
+    def _chat_delay(self, chat_id, now):
+        tat = self._chat_tat.get(chat_id)
+        if tat is None:
+            return 0.0
+        return max(0.0, tat - (self.chat_burst - 1) * self.chat_interval - now)
+
+    # Первый ожидающий самой приоритетной полосы, чей чат свободен; иначе — через
+    # сколько секунд освободится ближайший. Отменённых по пути выбрасываем
+    def _next(self, now):
+        soonest = None
+        for queue in self._lanes.values():
+            i = 0
+            while i < len(queue):
+                chat_id, waiter = queue[i]
+                if waiter.done():
+                    del queue[i]
+                    continue
+                delay = self._chat_delay(chat_id, now)
+                if delay == 0:
+                    return queue, i, None
+                soonest = delay if soonest is None else min(soonest, delay)
+                i += 1
+        return None, None, soonest
+
+    # False — ожидающий успел отмениться, разрешение никому не выдано
+    def _grant(self, queue, i, now):
+        chat_id, waiter = queue[i]
+        del queue[i]
+        if waiter.done():
+            return False
+        if chat_id is not None:
+            tat = self._chat_tat.get(chat_id, now)
+            self._chat_tat[chat_id] = max(tat, now) + self.chat_interval
+            if len(self._chat_tat) > self.max_chats:
+                self._forget_idle_chats(now)
+        waiter.set_result(None)
+        return True
+
+    # Чат, у которого весь запас восстановился, ничем не отличается от нового
+    def _forget_idle_chats(self, now):
+        for chat_id in [chat_id for chat_id, tat in self._chat_tat.items() if tat <= now]:
+            del self._chat_tat[chat_id]
+
+    # Ошибка одной выдачи не должна останавливать диспетчер: иначе все остальные
+    # ожидающие повиснут до следующего acquire
+    async def _dispatch(self):
+        while True:
+            try:
+                await self._dispatch_one()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка планировщика отправок: {e}")
+                await asyncio.sleep(0.1)
+
+    async def _dispatch_one(self):
+        self._wakeup.clear()
+        queue, i, soonest = self._next(time.monotonic())
+        if queue is None:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=soonest)
+            except asyncio.TimeoutError:
+                pass
+            return
+
+        await self.bucket.acquire()
+        # Пока ждали токен, мог прийти ожидающий с более высоким приоритетом.
+        # Никого не осталось, только если все ожидающие отменились: токен пропадает
+        while True:
+            now = time.monotonic()
+            queue, i, _ = self._next(now)
+            if queue is None or self._grant(queue, i, now):
+                return
+
+    # Middleware сессии aiogram: через планировщик идут сообщения в чат (отправка,
+    # редактирование, документы). 429 ставит на паузу все полосы; интерактивные и
+    # уведомления после паузы повторяются один раз, рассылка повторяет сама
+    async def middleware(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not is_message_method(method):
+            return await make_request(bot, method)
+        lane = OUTBOUND_LANE.get()
+        for attempt in (1, 2):
+            await self.acquire(chat_id, lane)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                logger.warning(f"Flood control ({lane}), пауза {e.retry_after} сек.")
+                self.pause(e.retry_after)
+                if lane == BROADCAST or attempt == 2:
+                    raise
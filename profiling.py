@@ -0,0 +1,116 @@
+import cProfile
+import contextvars
+import io
+import logging
+import pstats
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+# Время запросов к БД за текущее обновление. Middleware кладёт сюда список из одного
+# числа, Database прибавляет к нему длительность каждого запроса (с ожиданием пула).
+# Фоновые задачи, запущенные из обработчика, наследуют контекст и досчитываются в тот
+# же список уже после замера — в журнал медленных обновлений они не попадают
+UPDATE_DB_TIME = contextvars.ContextVar("update_db_time", default=None)
+
+def add_db_time(seconds):
+    spent = UPDATE_DB_TIME.get()
+    if spent is not None:
+        spent[0] += seconds
+
+# Замер обновлений: журнал медленных и захват cProfile по запросу суперадмина.
+# Пока захват выключен, на обновление приходится пара вызовов perf_counter и
+# установка ContextVar. cProfile один на процесс (второй профилировщик Python не
+# даёт включить): он работает, пока идёт хотя бы одно выбранное обновление, поэтому
+# в отчёт попадает и всё, что event loop выполнял параллельно. Запросы к БД идут в
+# потоках пула и в профиль не попадают — для них есть время БД в журнале
+class UpdateProfiler:
+    def __init__(self, slow_threshold=1.0, top=40):
+        self.slow_threshold = slow_threshold
+        self.top = top
+        self._profile = None
+        self._remaining = 0
+        self._sample_rate = 1.0
+        self._running = 0
+        self._captured = 0
+        self._started = None
+        self._on_done = None
+
+    @property
+    def capturing(self):
+        return self._profile is not None
+
+    # on_done(report, captured) вызывается после последнего выбранного обновления
+    def start(self, updates, sample_rate=1.0, on_done=None):
+        if self.capturing:
+            raise RuntimeError("Профилирование уже идёт")
+        self._profile = cProfile.Profile()
+        self._remaining = updates
+        self._sample_rate = sample_rate
+        self._captured = 0
+        self._started = time.monotonic()
+        self._on_done = on_done
+
+    # Останавливает захват и возвращает отчёт по уже снятым обновлениям
+    def stop(self):
+        if not self.capturing:
+            return None
+        profile, self._profile = self._profile, None
+        if self._running:
+            profile.disable()
+            self._running = 0
+        on_done, self._on_done = self._on_done, None
+        try:
+            report = self.report(profile)
+        except Exception as e:
+            logger.error(f"Ошибка построения отчёта профилирования: {e}")
+            report = f"Не удалось построить отчёт профилирования: {e}\n"
+        if on_done:
+            on_done(report, self._captured)
+        return report
+
+    def report(self, profile):
+        out = io.StringIO()
+        out.write(
+            f"Обновлений в профиле: {self._captured} "
+            f"(доля выборки {self._sample_rate:g}), "
+            f"{time.monotonic() - self._started:.1f} с с начала захвата\n\n"
+        )
+        # pstats.Stats падает на пустом профиле (TypeError: no stats available)
+        if not self._captured or not profile.getstats():
+            out.write("Ни одно обновление не попало в выборку — профиль пуст\n")
+            return out.getvalue()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats("cumulative").print_stats(self.top)
+        stats.sort_stats("tottime").print_stats(self.top)
+        return out.getvalue()
+
+    async def run(self, handler, event, data):
+        if not self.capturing or self._remaining <= 0 or random.random() >= self._sample_rate:
+            return await handler(event, data)
+        profile = self._profile
+        self._remaining -= 1
+        if not self._running:
+            profile.enable()
+        self._running += 1
+        try:
+            return await handler(event, data)
+        finally:
+            # Захват могли остановить, пока шло обновление
+            if self._profile is profile:
+                self._running -= 1
+                self._captured += 1
+                if not self._running:
+                    profile.disable()
+                    if self._remaining <= 0:
+                        self.stop()
+
+    def check_slow(self, update_id, label, elapsed, db_time):
+        if self.slow_threshold and elapsed >= self.slow_threshold:
+            logger.warning(
+                f"Медленное обновление {update_id} ({label}): {elapsed * 1000:.0f} мс, "
+                f"из них БД {db_time * 1000:.0f} мс"
+            )
+            return True
+        return False
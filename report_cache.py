@@ -0,0 +1,56 @@
+import asyncio
+import time
+
+# Готовые тексты админских отчётов. Запись сбрасывается хуками при изменении данных
+# (invalidate) и в любом случае живёт не дольше ttl секунд — на случай правок в обход
+# этого процесса. Одновременные запросы одного отчёта ждут одно вычисление
+class ReportCache:
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        # ключ -> (значение, момент устаревания)
+        self._entries = {}
+        # ключ -> задача, которая сейчас строит отчёт
+        self._building = {}
+        # Растёт при каждом сбросе: отчёт, начатый до сброса, в кэш не попадает
+        self._generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Без ключей — сбросить всё
+    def invalidate(self, *keys):
+        for key in keys or list(self._generations):
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._entries.pop(key, None)
+            # Уже ждущие получат начатый отчёт, новые запросы построят свежий
+            self._building.pop(key, None)
+
+    # build — корутинная функция без аргументов; ошибка не кэшируется
+    async def get(self, key, build):
+        entry = self._entries.get(key)
+        if entry and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+
+        task = self._building.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._build(key, build, self._generations.get(key, 0)))
+            self._building[key] = task
+        else:
+            self.coalesced += 1
+        # Отмена одного ждущего не прерывает отчёт для остальных
+        return await asyncio.shield(task)
+
+    async def _build(self, key, build, generation):
+        try:
+            value = await build()
+        finally:
+            if self._building.get(key) is asyncio.current_task():
+                del self._building[key]
+        if generation == self._generations.get(key, 0):
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+        return value
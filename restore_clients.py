@@ -1,5 +1,9 @@
+import argparse
 import os
 import re
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 import psycopg2
 
@@ -10,40 +14,44 @@ PREFIXES = (
     "👍 Нравится:", "👎 Не нравится:", "💡 Предложения:"
 )
 
-def parse_clients(text: str):
-    lines = [ln.rstrip("\n") for ln in text.splitlines()]
-    clients = []
+CLIENT_HEADER = re.compile(r"^👤\s*(.+?)\s*\(@(.*?)\)\s*$")
+
+# Отдельная строка после ответа, который бот обрезал, чтобы страница отчёта влезла
+# в одно сообщение. Такой ответ не восстанавливаем: поле остаётся пустым
+TRUNCATED_MARK = "✂️ [ответ обрезан, полный текст — в выгрузке базы]"
+
+def new_client(name, username):
+    return {
+        "user_id": None,
+        "username": None if (username is None or username.lower() == "none") else username,
+        "full_name": name.strip(),
+        "timestamp": None,
+        "gender": None,
+        "age_group": None,
+        "visit_freq": None,
+        "appreciate": None,
+        "dislike": None,
+        "improve": None,
+    }
+
+def finish_client(cur):
+    # чистим переносы/пробелы
+    for k in ("appreciate", "dislike", "improve"):
+        if cur.get(k) is not None:
+            cur[k] = re.sub(r"\s+\n", "\n", cur[k]).strip()
+            if TRUNCATED_MARK in cur[k]:
+                cur[k] = None
+    return cur
+
+# Генератор: читает отчёт построчно (можно передать открытый файл) и отдаёт
+# клиентов по одному, так что память не зависит от размера отчёта
+def parse_clients(lines):
     cur = None
     cur_field = None
 
-    def flush():
-        nonlocal cur
-        if cur and cur.get("user_id"):
-            # чистим переносы/пробелы
-            for k in ("appreciate", "dislike", "improve"):
-                if cur.get(k) is not None:
-                    cur[k] = re.sub(r"\s+\n", "\n", cur[k]).strip()
-            clients.append(cur)
-        cur = None
-
-    def start_new(name, username):
-        nonlocal cur, cur_field
-        flush()
-        cur = {
-            "user_id": None,
-            "username": None if (username is None or username.lower() == "none") else username,
-            "full_name": name.strip(),
-            "timestamp": None,
-            "gender": None,
-            "age_group": None,
-            "visit_freq": None,
-            "appreciate": None,
-            "dislike": None,
-            "improve": None,
-        }
-        cur_field = None
-
     for ln in lines:
+        ln = ln.rstrip("\r\n")
+
         # пропускаем "шапки" чата
         if ln.startswith('"ДЫМ"') or ln.startswith("📋 Подробный отчёт"):
             continue
@@ -54,9 +62,12 @@ def parse_clients(text: str):
             continue
 
         # старт клиента: 👤 Имя (@username)
-        m = re.match(r"^👤\s*(.+?)\s*\(@(.*?)\)\s*$", ln)
+        m = CLIENT_HEADER.match(ln)
         if m:
-            start_new(m.group(1), m.group(2))
+            if cur and cur.get("user_id"):
+                yield finish_client(cur)
+            cur = new_client(m.group(1), m.group(2))
+            cur_field = None
             continue
 
         if cur is None:
@@ -96,72 +107,241 @@ def parse_clients(text: str):
             if cur_field in ("appreciate", "dislike", "improve") and ln.strip():
                 cur[cur_field] = (cur[cur_field] or "") + "\n" + ln.strip()
 
-    flush()
-    return clients
+    if cur and cur.get("user_id"):
+        yield finish_client(cur)
 
-def main():
-    db_url = os.getenv("DATABASE_URL")
-    if not db_url:
-        raise RuntimeError("DATABASE_URL is not set in environment")
+RESTORE_COLUMNS = (
+    "user_id", "username", "full_name", "appreciate", "dislike", "improve",
+    "gender", "age_group", "visit_freq", "timestamp",
+)
+# важно: не ломаем существующие записи — поля анкеты заполняем, только если они пустые;
+# имя, username и дату берём из отчёта, если они там есть
+FILL_EMPTY = ("appreciate", "dislike", "improve", "gender", "age_group", "visit_freq")
+PREFER_REPORT = ("username", "full_name", "timestamp")
 
-    with open(REPORT_PATH, "r", encoding="utf-8") as f:
-        report = f.read()
+def merged_value(column, new="EXCLUDED"):
+    if column in FILL_EMPTY:
+        return (f"CASE WHEN clients.{column} IS NULL OR clients.{column} = '' "
+                f"THEN {new}.{column} ELSE clients.{column} END")
+    return f"COALESCE({new}.{column}, clients.{column})"
 
-    clients = parse_clients(report)
-    print(f"Parsed clients: {len(clients)}")
+MERGE_SET = ",\n".join(f"{column} = {merged_value(column)}" for column in FILL_EMPTY + PREFER_REPORT)
 
-    conn = psycopg2.connect(db_url)
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                # важно: не ломаем существующие записи — заполняем только пустые поля
-                for c in clients:
-                    cur.execute("""
-                        INSERT INTO clients (
-                            user_id, username, full_name,
-                            appreciate, dislike, improve,
-                            gender, age_group, visit_freq,
-                            is_admin, timestamp
-                        ) VALUES (
-                            %(user_id)s, %(username)s, %(full_name)s,
-                            %(appreciate)s, %(dislike)s, %(improve)s,
-                            %(gender)s, %(age_group)s, %(visit_freq)s,
-                            FALSE, %(timestamp)s
-                        )
-                        ON CONFLICT (user_id) DO UPDATE SET
-                            username = COALESCE(EXCLUDED.username, clients.username),
-                            full_name = COALESCE(EXCLUDED.full_name, clients.full_name),
+def changed(new="EXCLUDED"):
+    return (f"({', '.join(f'clients.{column}' for column in FILL_EMPTY + PREFER_REPORT)}) "
+            f"IS DISTINCT FROM ({', '.join(merged_value(column, new) for column in FILL_EMPTY + PREFER_REPORT)})")
+
+# Клиент может встречаться в нескольких отчётах (и несколько раз в одном).
+# Берём самую полную запись: больше заполненных полей, при равенстве — более
+# свежая дата, затем более поздний файл и место в нём (source, position)
+COMPLETENESS = "num_nonnulls({})".format(", ".join(
+    f"NULLIF({column}, '')" if column != "timestamp" else column
+    for column in RESTORE_COLUMNS[1:]
+))
+SOURCE_QUERY = f'''
+SELECT DISTINCT ON (user_id) {", ".join(RESTORE_COLUMNS)}
+FROM clients_restore
+ORDER BY user_id, {COMPLETENESS} DESC, timestamp DESC NULLS LAST, source DESC, position DESC
+'''
+
+MERGE_QUERY = f'''
+WITH source AS ({SOURCE_QUERY}), merged AS (
+    INSERT INTO clients ({", ".join(RESTORE_COLUMNS)}, is_admin)
+    SELECT {", ".join(RESTORE_COLUMNS)}, FALSE FROM source
+    ORDER BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+    {MERGE_SET}
+    -- без изменений строку не трогаем: ни новой версии, ни работы триггеров
+    WHERE {changed()}
+    RETURNING xmax = 0 AS inserted
+)
+SELECT (SELECT COUNT(*) FROM source),
+       COUNT(*) FILTER (WHERE inserted),
+       COUNT(*) FILTER (WHERE NOT inserted)
+FROM merged
+'''
+
+# Пробный прогон: те же правила слияния, но clients только читается
+DRY_RUN_QUERY = f'''
+WITH source AS ({SOURCE_QUERY})
+SELECT COUNT(*),
+       COUNT(*) FILTER (WHERE clients.user_id IS NULL),
+       COUNT(*) FILTER (WHERE clients.user_id IS NOT NULL AND {changed("source")})
+FROM source LEFT JOIN clients ON clients.user_id = source.user_id
+'''
 
-                            appreciate = CASE
-                                WHEN clients.appreciate IS NULL OR clients.appreciate = '' THEN EXCLUDED.appreciate
-                                ELSE clients.appreciate END,
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
 
-                            dislike = CASE
-                                WHEN clients.dislike IS NULL OR clients.dislike = '' THEN EXCLUDED.dislike
-                                ELSE clients.dislike END,
+# Отчёты делятся на куски примерно по CHUNK_SIZE байт и разбираются параллельно
+CHUNK_SIZE = 16 * 1024 * 1024
+REPORT_SUFFIXES = (".txt",)
 
-                            improve = CASE
-                                WHEN clients.improve IS NULL OR clients.improve = '' THEN EXCLUDED.improve
-                                ELSE clients.improve END,
+# Файлы отчётов: пути к файлам и каталоги (в каталоге — все *.txt, рекурсивно)
+def report_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for root, _, names in os.walk(path):
+                found.extend(os.path.join(root, name) for name in names
+                             if name.lower().endswith(REPORT_SUFFIXES))
+            files.extend(sorted(found))
+        else:
+            files.append(path)
+    return files
 
-                            gender = CASE
-                                WHEN clients.gender IS NULL OR clients.gender = '' THEN EXCLUDED.gender
-                                ELSE clients.gender END,
+# Куски (source, путь, start, end) по CHUNK_SIZE байт. Граница уточняется при чтении
+def report_chunks(files, chunk_size=CHUNK_SIZE):
+    chunks = []
+    for source, path in enumerate(files):
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), chunk_size):
+            chunks.append((source, path, start, min(start + chunk_size, size)))
+    return chunks
 
-                            age_group = CASE
-                                WHEN clients.age_group IS NULL OR clients.age_group = '' THEN EXCLUDED.age_group
-                                ELSE clients.age_group END,
+# Строки куска: с первого клиента, начавшегося не раньше start, и до первого
+# клиента, начавшегося на end или позже. Так каждый клиент попадает ровно в один кусок
+def chunk_lines(path, start, end):
+    with open(path, "rb") as f:
+        if start:
+            f.seek(start - 1)
+            f.readline()
+        offset = f.tell()
+        for raw in f:
+            line = raw.decode("utf-8-sig" if offset == 0 else "utf-8")
+            if offset >= end and CLIENT_HEADER.match(line.rstrip("\r\n")):
+                break
+            offset += len(raw)
+            yield line
 
-                            visit_freq = CASE
-                                WHEN clients.visit_freq IS NULL OR clients.visit_freq = '' THEN EXCLUDED.visit_freq
-                                ELSE clients.visit_freq END,
+# Выполняется в процессе пула: разбирает кусок отчёта в файл формата COPY text.
+# position — смещение куска плюс номер клиента в нём: растёт вместе с местом в файле
+def parse_chunk(source, path, start, end, out_dir):
+    started = time.perf_counter()
+    out_path = os.path.join(out_dir, f"{source}_{start}.copy")
+    count = 0
+    with open(out_path, "w", encoding="utf-8") as out:
+        for count, c in enumerate(parse_clients(chunk_lines(path, start, end)), 1):
+            out.write("\t".join(copy_value(c[column]) for column in RESTORE_COLUMNS))
+            out.write(f"\t{source}\t{start + count}\n")
+    return out_path, count, end - start, time.perf_counter() - started
 
-                            timestamp = COALESCE(EXCLUDED.timestamp, clients.timestamp);
-                    """, c)
+def print_progress(done, total, path, count, elapsed):
+    print(f"[{done}/{total}] {path}: {count} clients, {elapsed:.1f} s")
 
-        print("OK: clients restored (safe upsert).")
+# Разбор отчётов в пуле процессов, COPY во временную таблицу и одно слияние
+# с clients. Готовые куски загружаются, пока остальные ещё разбираются.
+# dry_run: clients не меняется, считается только результат слияния.
+# Возвращает словарь с числом клиентов, итогами слияния и временем этапов
+def restore(conn, paths, dry_run=False, workers=None, chunk_size=CHUNK_SIZE, progress=None):
+    files = report_files(paths)
+    chunks = report_chunks(files, chunk_size)
+    workers = workers or min(len(chunks), os.cpu_count() or 1) or 1
+    started = time.perf_counter()
+    parsed = 0
+    size = 0
+    try:
+        with conn.cursor() as cur, tempfile.TemporaryDirectory(prefix="restore_") as out_dir:
+            cur.execute("""
+                CREATE TEMP TABLE clients_restore (
+                    user_id BIGINT NOT NULL,
+                    username TEXT,
+                    full_name TEXT,
+                    appreciate TEXT,
+                    dislike TEXT,
+                    improve TEXT,
+                    gender TEXT,
+                    age_group TEXT,
+                    visit_freq TEXT,
+                    timestamp TIMESTAMP,
+                    source INTEGER NOT NULL,
+                    position BIGINT NOT NULL
+                ) ON COMMIT DROP
+            """)
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {
+                    pool.submit(parse_chunk, source, path, start, end, out_dir): path
+                    for source, path, start, end in chunks
+                }
+                for done, future in enumerate(as_completed(futures), 1):
+                    out_path, count, chunk_bytes, elapsed = future.result()
+                    with open(out_path, "r", encoding="utf-8") as f:
+                        cur.copy_expert(
+                            f"COPY clients_restore ({', '.join(RESTORE_COLUMNS)}, source, position) FROM STDIN",
+                            f, size=65536
+                        )
+                    os.remove(out_path)
+                    parsed += count
+                    size += chunk_bytes
+                    if progress:
+                        progress(done, len(chunks), futures[future], count, elapsed)
+            loaded = time.perf_counter()
+
+            cur.execute(DRY_RUN_QUERY if dry_run else MERGE_QUERY)
+            unique, inserted, updated = cur.fetchone()
+            if not dry_run:
+                # запущенный бот перечитает индекс клиентов
+                cur.execute("NOTIFY clients_changed")
+        if dry_run:
+            conn.rollback()
+        else:
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finished = time.perf_counter()
+    return {
+        "files": len(files),
+        "chunks": len(chunks),
+        "workers": workers,
+        "bytes": size,
+        "parsed": parsed,
+        "unique": unique,
+        "inserted": inserted,
+        "updated": updated,
+        "unchanged": unique - inserted - updated,
+        "load_seconds": loaded - started,
+        "merge_seconds": finished - loaded,
+        "seconds": finished - started,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Restore clients from chat report exports")
+    parser.add_argument("paths", nargs="*", default=[REPORT_PATH],
+                        help=f"report files or directories with *.txt reports (default: {REPORT_PATH})")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only report what would change, the clients table is not modified")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="parser processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    db_url = os.getenv("DATABASE_URL")
+    if not db_url:
+        raise RuntimeError("DATABASE_URL is not set in environment")
+
+    conn = psycopg2.connect(db_url)
+    try:
+        stats = restore(conn, args.paths, dry_run=args.dry_run, workers=args.workers,
+                        progress=print_progress)
     finally:
         conn.close()
 
+    seconds = stats["seconds"] or 1e-9
+    print(f"Parsed clients: {stats['parsed']} ({stats['unique']} unique) "
+          f"from {stats['files']} file(s) with {stats['workers']} worker(s)")
+    print(f"Throughput: {stats['parsed'] / seconds:.0f} clients/s, "
+          f"{stats['bytes'] / 1024 / 1024 / seconds:.1f} MB/s "
+          f"(parse+load {stats['load_seconds']:.1f} s, merge {stats['merge_seconds']:.1f} s)")
+    if args.dry_run:
+        print(f"DRY RUN: would insert {stats['inserted']}, update {stats['updated']}, "
+              f"leave {stats['unchanged']} unchanged. Database not modified.")
+    else:
+        print(f"OK: clients restored (safe upsert): {stats['inserted']} inserted, "
+              f"{stats['updated']} updated, {stats['unchanged']} unchanged.")
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+
+from psycopg2.extras import Json, execute_values
+
+logger = logging.getLogger(__name__)
+
+# Пользователь, от которого пришло обновление (message, callback_query и т.д.)
+def update_user_id(update):
+    for key, value in update.items():
+        if key != 'update_id' and isinstance(value, dict):
+            user = value.get('from') or value.get('chat') or {}
+            return user.get('id', 0)
+    return 0
+
+# Очередь обновлений в PostgreSQL для работы в несколько процессов.
+# Приёмник (вебхук или polling) раскладывает обновления по шардам по from_user.id,
+# каждый воркер читает свой шард — апдейты одного пользователя всегда обрабатывает
+# один процесс и строго по порядку, поэтому переходы анкеты не перемешиваются
+class UpdateQueue:
+    def __init__(self, db, shards, batch_size=100, max_in_flight=200, poll_interval=1):
+        self.db = db
+        self.shards = shards
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._wakeup = asyncio.Event()
+        # Последняя задача по каждому пользователю: следующая ждёт её завершения
+        self._tails = {}
+        self._in_flight = set()
+
+    def channel(self, shard):
+        return f"updates_{shard}"
+
+    def shard_for(self, update):
+        return update_user_id(update) % self.shards
+
+    def wake(self):
+        self._wakeup.set()
+
+    # Повторы по update_id (Telegram повторил вебхук, перезапуск приёмника) отбрасываются.
+    # Возвращает число новых обновлений
+    async def put(self, updates):
+        rows = {update['update_id']: (update['update_id'], self.shard_for(update), Json(update))
+                for update in updates}
+
+        def insert(cursor):
+            inserted = execute_values(cursor, '''
+            INSERT INTO update_queue (update_id, shard, payload)
+            VALUES %s
+            ON CONFLICT (update_id) DO NOTHING
+            RETURNING shard
+            ''', list(rows.values()), fetch=True)
+            # Уведомление уходит после коммита
+            for shard in {row[0] for row in inserted}:
+                cursor.execute('SELECT pg_notify(%s, %s)', (self.channel(shard), ''))
+            return len(inserted)
+        return await self.db.run(insert)
+
+    # Забираем пачку и сразу помечаем её обработанной: как и long polling,
+    # обновление, взятое в работу перед падением процесса, не повторяется
+    async def take(self, shard):
+        rows = await self.db.fetchall('''
+        UPDATE update_queue SET processed_at = CURRENT_TIMESTAMP
+        WHERE update_id IN (
+            SELECT update_id FROM update_queue
+            WHERE shard = %s AND processed_at IS NULL
+            ORDER BY update_id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING update_id, payload
+        ''', (shard, self.batch_size))
+        return [payload for _, payload in sorted(rows, key=lambda row: row[0])]
+
+    async def prune(self, keep_hours=24):
+        return await self.db.execute(
+            "DELETE FROM update_queue WHERE processed_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 hour'",
+            (keep_hours,)
+        )
+
+    async def consume(self, shard, handle):
+        while True:
+            self._wakeup.clear()
+            try:
+                batch = await self.take(shard)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка чтения очереди обновлений (шард {shard}): {e}")
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            if not batch:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for update in batch:
+                await self.submit(update, handle)
+
+    # Разные пользователи обрабатываются параллельно, апдейты одного — по очереди.
+    # Используется и без очереди в БД, когда процесс один
+    async def submit(self, update, handle):
+        await self._slots.acquire()
+        user_id = update_user_id(update)
+        task = asyncio.create_task(self._handle_after(self._tails.get(user_id), update, handle))
+        self._tails[user_id] = task
+        self._in_flight.add(task)
+
+        def done(task):
+            self._in_flight.discard(task)
+            if self._tails.get(user_id) is task:
+                del self._tails[user_id]
+        task.add_done_callback(done)
+
+    async def _handle_after(self, previous, update, handle):
+        try:
+            if previous:
+                await asyncio.wait([previous])
+            await handle(update)
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+        finally:
+            self._slots.release()
+
+    # При остановке даём дообработать уже взятые обновления
+    async def drain(self, timeout=10):
+        if self._in_flight:
+            await asyncio.wait(self._in_flight, timeout=timeout)